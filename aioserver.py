@@ -0,0 +1,116 @@
+import datetime
+import logging
+from http import HTTPStatus
+
+from aiohttp import web
+
+import modules.aioclients as aioclients
+import modules.aiocurrency as aiocurrency
+import modules.aiodb as aiodb
+import modules.aioorchestration as aioorchestration
+import modules.aiowithdrawals as aiowithdrawals
+import modules.balances as balances
+import modules.deposits as deposits
+import modules.recorder as recorder
+import modules.throttle as throttle
+import modules.triage as triage
+import modules.users as users
+from modules.settings import get_settings
+
+# asyncio engine: the routes of webhooks.py served by aiohttp, with async node, Telegram and Postgres clients.
+# Run with `python aioserver.py`, or under gunicorn with --worker-class aiohttp.GunicornWebWorker aioserver:create_app
+routes = web.RouteTableDef()
+
+# Settings of eventlet engine features this engine does not have, and the feature.  The engine starts without them
+# and says so.
+UNSUPPORTED = (
+    ('journal_dir', 'update journal'),
+    ('profile_sample', 'request profiling'),
+    ('profile_slow_ms', 'request profiling'),
+    ('trace_dir', 'update tracing'),
+    ('replica_hosts', 'read replicas'),
+    ('shards', 'sharding')
+)
+
+
+async def create_app():
+    """
+    App factory: parse the config once, connect the shared clients and register the routes
+    """
+    logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+async def on_startup(app):
+    settings = get_settings()
+    for name, feature in UNSUPPORTED:
+        if getattr(settings, name):
+            logging.warning("{}: {} is set, but the asyncio engine has no {}; ignoring it".format(
+                datetime.datetime.utcnow(), name, feature))
+    await aioclients.init_clients(settings)
+    await aiodb.listen_balances(settings)
+    aiowithdrawals.start_executor(settings)
+    recorder.start_recorder(settings)
+    if deposits.callbacks_enabled():
+        aiocurrency.spawn(aioorchestration.load_accounts())
+
+
+async def on_cleanup(app):
+    for task in list(aiocurrency.tasks):
+        task.cancel()
+    await aioclients.close_clients()
+
+
+@routes.get('/stats')
+async def stats(request):
+    return web.json_response({
+        'balances': balances.stats(),
+        'node': aioclients.rpc.stats(),
+        'withdrawals': aiowithdrawals.stats(),
+        'deposits': aiocurrency.deposit_stats(),
+        'recorder': recorder.stats(),
+        'triage': triage.stats(),
+        'throttle': throttle.stats(),
+        'tips': aiocurrency.tip_stats(),
+        'users': users.stats(),
+        'updates': aioorchestration.stats()
+    })
+
+
+@routes.get('/ready')
+async def ready(request):
+    # Nothing to warm up: the clients are connected before the first request is accepted
+    return web.Response(text='ok')
+
+
+@routes.post('/callback/{token}')
+async def node_callback(request):
+    """
+    Block callback from the node (callback_address/callback_target in the node config)
+    """
+    if not deposits.callbacks_enabled() or request.match_info['token'] != get_settings().callback_token:
+        return web.Response(status=HTTPStatus.NOT_FOUND)
+    try:
+        await aioorchestration.handle_callback(await request.json())
+    except Exception as e:
+        logging.error('Node callback error: {}'.format(e))
+    return web.Response(text='ok')
+
+
+@routes.post('/{path:.*}')
+async def telegram_event(request):
+    try:
+        update = await request.json()
+    except ValueError:
+        update = None
+    recorder.record(update)
+    await aioorchestration.handle_update(update)
+    return web.Response(text='ok')
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), port=8787)
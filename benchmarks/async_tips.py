@@ -0,0 +1,145 @@
+"""
+How many concurrent slow tips one asyncio worker holds.
+
+Starts the simulated node and Bot API on localhost, publishing blocks, generating work and accepting messages after
+--latency seconds, serves aioserver's app
+in this process and posts --tips tip updates at once, each from its own sender.  The Postgres database comes from
+the usual config (MY_CONF_DIR/webhooks.ini); benchmark users, chat members and tips are written to it and removed
+again.
+
+    MY_CONF_DIR=config python benchmarks/async_tips.py --tips 1000 --latency 1
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from aiohttp import ClientSession, TCPConnector
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aioserver
+import modules.aiocurrency as aiocurrency
+import modules.aioorchestration as aioorchestration
+import modules.db as db
+from modules.simulator import SimulatedNode, SimulatedTelegram, serve
+from modules.settings import get_settings
+
+CHAT_ID = -1009999999999
+FIRST_USER_ID = 2000000000
+
+# Raw receivable every benchmark account opens with, enough for any number of 1 BAN tips
+OPENING_BALANCE = 10 ** 34
+
+
+def tip_update(index):
+    sender_id = FIRST_USER_ID + index * 2
+    return {
+        'update_id': index,
+        'message': {
+            'message_id': index + 1,
+            'from': {'id': sender_id, 'is_bot': False, 'username': 'sender{}'.format(index)},
+            'chat': {'id': CHAT_ID, 'type': 'supergroup', 'title': 'benchmark'},
+            'text': '.tip 1 @receiver{}'.format(index)
+        }
+    }
+
+
+def benchmark_user_ids(count):
+    return list(range(FIRST_USER_ID, FIRST_USER_ID + count * 2))
+
+
+def set_up_db(count):
+    clean_up_db(count)
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    with db.database.connection_context():
+        db.User.insert_many([
+            {'user_id': user_id, 'user_name': 'user{}'.format(user_id), 'account': 'ban_bench{}'.format(user_id),
+             'register': 1, 'created_ts': now} for user_id in benchmark_user_ids(count)]).execute()
+        db.TelegramChatMember.insert_many([
+            {'chat_id': CHAT_ID, 'chat_name': 'benchmark', 'member_id': FIRST_USER_ID + index * 2 + 1,
+             'member_name': 'receiver{}'.format(index), 'created_ts': now} for index in range(count)]).execute()
+
+
+def clean_up_db(count):
+    user_ids = benchmark_user_ids(count)
+    with db.database.connection_context():
+        db.Tip.delete().where(db.Tip.sender << user_ids).execute()
+        db.TelegramChatMember.delete().where(db.TelegramChatMember.chat_id == CHAT_ID).execute()
+        db.User.delete().where(db.User.user_id << user_ids).execute()
+
+
+def percentile(samples, fraction):
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def run(count, latency):
+    settings = get_settings()
+    telegram = SimulatedTelegram(latency, flood_limits=False)
+    node = SimulatedNode(block_latency=latency, work_latency=latency, opening_balance=OPENING_BALANCE)
+    node_runner, settings.node_ip = await serve(node.app())
+    telegram_runner, settings.telegram_api = await serve(telegram.app())
+    bot_runner, bot_url = await serve(await aioserver.create_app())
+
+    peak = {'in_flight': 0}
+
+    async def sample():
+        while True:
+            peak['in_flight'] = max(peak['in_flight'], aioorchestration.counters['in_flight'])
+            await asyncio.sleep(0.01)
+
+    async def post(session, index):
+        started = time.monotonic()
+        async with session.post(bot_url + '/', json=tip_update(index)) as resp:
+            await resp.read()
+        return time.monotonic() - started
+
+    sampler = asyncio.get_event_loop().create_task(sample())
+    started = time.monotonic()
+    async with ClientSession(connector=TCPConnector(limit=0)) as session:
+        seconds = await asyncio.gather(*[post(session, index) for index in range(count)])
+    elapsed = time.monotonic() - started
+    sampler.cancel()
+
+    await bot_runner.cleanup()
+    await telegram_runner.cleanup()
+    await node_runner.cleanup()
+
+    print("tips posted:           {}".format(count))
+    print("node/telegram latency: {:.2f}s".format(latency))
+    # Sends hold a connection for their account lock, so the pool bounds the send rate, not the tips held
+    print("db connections:        {}".format(get_settings().db_connections))
+    print("peak concurrent tips:  {}".format(peak['in_flight']))
+    print("tips sent:             {}".format(aiocurrency.tip_counters['sent']))
+    print("telegram messages:     {}".format(len(telegram.sent)))
+    print("errors:                {}".format(aioorchestration.counters['errors']))
+    print("wall time:             {:.2f}s ({:.1f} tips/s)".format(elapsed, count / elapsed))
+    print("tip latency p50/p99:   {:.2f}s / {:.2f}s".format(percentile(seconds, 0.5), percentile(seconds, 0.99)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tips', type=int, default=1000, help='tip updates posted at once')
+    parser.add_argument('--latency', type=float, default=1.0, help='seconds the simulated node and Bot API take')
+    args = parser.parse_args()
+
+    settings = get_settings()
+    # Every tip comes from another sender in the same chat: lift the chat's token bucket
+    settings.throttle_chat_burst = args.tips
+    settings.throttle_chat_rate = args.tips
+    settings.min_tip = 1
+    settings.bot_id_telegram = '0'
+
+    db.init_db(settings)
+    db.create_tables()
+    db.migrate_tables()
+    set_up_db(args.tips)
+    try:
+        asyncio.get_event_loop().run_until_complete(run(args.tips, args.latency))
+    finally:
+        clean_up_db(args.tips)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""
+Post the same updates to both engines and compare their replies.
+
+Starts the simulated node and Bot API on localhost, then serves each engine in turn as a subprocess pointed at them
+(webhooks.py for the eventlet engine, aioserver.py for the asyncio one) and posts the same script of updates, one
+at a time: every DM command, a registration, group tips to a member, to a stranger and with a bad amount, a member
+joining and leaving.  The messages the bot sends for each update are compared, with accounts, block hashes and
+withdrawal ids replaced by placeholders numbered in order of appearance.  Exits with 1 when the engines differ.
+
+The Postgres database comes from the usual config (MY_CONF_DIR/webhooks.ini), which should be a scratch copy: the
+script's users and chat members are written to it before each engine runs and removed again.
+
+    MY_CONF_DIR=config python benchmarks/parity.py
+"""
+import argparse
+import asyncio
+import configparser
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientError, ClientSession
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import modules.db as db
+from modules.simulator import SimulatedNode, SimulatedTelegram, serve
+from modules.settings import get_settings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Engine name -> (script served, URL it takes updates on)
+ENGINES = {
+    'eventlet': ('webhooks.py', 'http://127.0.0.1:5000/'),
+    'asyncio': ('aioserver.py', 'http://127.0.0.1:8787/'),
+}
+
+CHAT_ID = -1009999999998
+SENDER_ID = 2100000000
+MEMBER_ID = 2100000001
+NEWCOMER_ID = 2100000002
+JOINER_ID = 2100000003
+USER_IDS = [SENDER_ID, MEMBER_ID, NEWCOMER_ID, JOINER_ID]
+
+# Raw receivable every account opens with on the simulated node
+OPENING_BALANCE = 10 ** 34
+
+# Config values both engines run with, next to the database settings of MY_CONF_DIR/webhooks.ini
+OVERRIDES = {
+    'min_tip': '1', 'bot_id_telegram': '0', 'read_nodes': '', 'journal_dir': '', 'warmup_budget': '0',
+    'replica_hosts': '', 'shards': '0', 'throttle_sender_burst': '1000', 'throttle_chat_burst': '1000',
+}
+
+ACCOUNT = re.compile(r'(ban|xrb|nano)_[13][13456789abcdefghijkmnopqrstuwxyz]{59}')
+BLOCK_HASH = re.compile(r'\b[0-9A-F]{64}\b')
+# Withdrawal ids come from the table's sequence, which the first engine moved on
+WITHDRAWAL_ID = re.compile(r'#\d+')
+
+
+def user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'user{}'.format(user_id),
+            'username': 'user{}'.format(user_id)}
+
+
+def dm(sender_id, text):
+    return {'from': user(sender_id), 'chat': {'id': sender_id, 'type': 'private'}, 'text': text}
+
+
+def group(sender_id, text):
+    return {'from': user(sender_id), 'chat': {'id': CHAT_ID, 'type': 'supergroup', 'title': 'parity'}, 'text': text}
+
+
+def script():
+    """
+    The updates posted to each engine, in order
+    """
+    messages = [
+        dm(SENDER_ID, '.help'),
+        dm(SENDER_ID, '/start'),
+        dm(SENDER_ID, '.balance'),
+        dm(SENDER_ID, '.account'),
+        dm(SENDER_ID, '.withdrawals'),
+        dm(SENDER_ID, '.withdraw 1 ban_1notanaccount'),
+        dm(SENDER_ID, '.withdraw'),
+        dm(SENDER_ID, '.unknown'),
+        dm(NEWCOMER_ID, '.balance'),
+        dm(NEWCOMER_ID, '.register'),
+        dm(NEWCOMER_ID, '.register'),
+        dm(NEWCOMER_ID, '.account'),
+        group(SENDER_ID, '.tip 1 @user{}'.format(MEMBER_ID)),
+        group(SENDER_ID, '.tip 1 @stranger'),
+        group(SENDER_ID, '.tip lots @user{}'.format(MEMBER_ID)),
+        group(SENDER_ID, '.tip 0.0001 @user{}'.format(MEMBER_ID)),
+        group(SENDER_ID, '.tip 1 @user{}'.format(SENDER_ID)),
+        group(SENDER_ID, 'hello'),
+        dm(MEMBER_ID, '.balance'),
+        dm(SENDER_ID, '.balance'),
+        {'from': user(JOINER_ID), 'chat': {'id': CHAT_ID, 'type': 'supergroup', 'title': 'parity'},
+         'new_chat_member': user(JOINER_ID)},
+        group(SENDER_ID, '.tip 1 @user{}'.format(JOINER_ID)),
+        {'from': user(JOINER_ID), 'chat': {'id': CHAT_ID, 'type': 'supergroup', 'title': 'parity'},
+         'left_chat_member': user(JOINER_ID)},
+        group(SENDER_ID, '.tip 1 @user{}'.format(JOINER_ID)),
+    ]
+    updates = []
+    for index, message in enumerate(messages):
+        message = dict(message, message_id=index + 1, date=int(time.time()))
+        updates.append({'update_id': index + 1, 'message': message})
+    return updates
+
+
+def write_config(conf_dir, node_url, telegram_url):
+    config = configparser.ConfigParser()
+    config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+    config['webhooks'].update(OVERRIDES, node_ip=node_url, telegram_api=telegram_url)
+    with open(os.path.join(conf_dir, 'webhooks.ini'), 'w') as ini:
+        config.write(ini)
+
+
+def set_up_db():
+    clean_up_db()
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    with db.database.connection_context():
+        db.User.insert_many([
+            {'user_id': user_id, 'user_name': 'user{}'.format(user_id), 'account': 'ban_parity{}'.format(user_id),
+             'register': 1, 'created_ts': now} for user_id in (SENDER_ID, MEMBER_ID)]).execute()
+        db.TelegramChatMember.insert_many([
+            {'chat_id': CHAT_ID, 'chat_name': 'parity', 'member_id': user_id, 'member_name': 'user{}'.format(user_id),
+             'created_ts': now} for user_id in (SENDER_ID, MEMBER_ID)]).execute()
+
+
+def clean_up_db():
+    with db.database.connection_context():
+        db.Tip.delete().where((db.Tip.sender << USER_IDS) | (db.Tip.receiver << USER_IDS)).execute()
+        db.Withdrawal.delete().where(db.Withdrawal.user << USER_IDS).execute()
+        db.TelegramChatMember.delete().where(db.TelegramChatMember.chat_id == CHAT_ID).execute()
+        db.User.delete().where(db.User.user_id << USER_IDS).execute()
+        db.ThrottleBucket.delete().where(db.ThrottleBucket.key << (
+            ['sender:{}'.format(user_id) for user_id in USER_IDS] + ['chat:{}'.format(CHAT_ID)])).execute()
+
+
+def normalize(texts):
+    """
+    The messages with every account, block hash and withdrawal id replaced by its placeholder, numbered in order of
+    appearance
+    """
+    seen = {}
+
+    def placeholder(kind):
+        def replace(match):
+            return seen.setdefault(match.group(0), '<{} {}>'.format(kind, len(seen) + 1))
+        return replace
+
+    return [WITHDRAWAL_ID.sub(placeholder('withdrawal'), BLOCK_HASH.sub(
+        placeholder('hash'), ACCOUNT.sub(placeholder('account'), text))) for text in texts]
+
+
+async def started(session, url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url + 'stats') as resp:
+                await resp.read()
+                return
+        except ClientError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("the bot did not answer on {} within {}s".format(url, timeout))
+
+
+async def settled(telegram, settle):
+    # Receives and DMs go on after the answer: wait until the bot has sent nothing for settle seconds
+    while True:
+        count = len(telegram.sent)
+        await asyncio.sleep(settle)
+        if len(telegram.sent) == count:
+            return
+
+
+async def run_engine(engine, conf_dir, telegram, updates, args):
+    """
+    Serve the engine against the simulators and post the updates.  Returns the messages sent for each update.
+    """
+    script_name, url = ENGINES[engine]
+    set_up_db()
+    bot = subprocess.Popen([sys.executable, '-W', 'ignore', script_name], cwd=ROOT,
+                           env=dict(os.environ, MY_CONF_DIR=conf_dir), stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+    replies = []
+    try:
+        async with ClientSession() as session:
+            await started(session, url, args.timeout)
+            for update in updates:
+                first = len(telegram.sent)
+                async with session.post(url, json=update) as resp:
+                    await resp.read()
+                await settled(telegram, args.settle)
+                replies.append(sorted('{} {}'.format('group' if sent['chat_id'] < 0 else 'dm', sent['text'])
+                                      for sent in telegram.sent[first:]))
+    finally:
+        bot.terminate()
+        bot.wait()
+        clean_up_db()
+    return replies
+
+
+async def run(args):
+    updates = script()
+    results = {}
+    with tempfile.TemporaryDirectory() as conf_dir:
+        for engine in ENGINES:
+            # Every engine starts from the same ledger and an empty Bot API
+            node = SimulatedNode(opening_balance=OPENING_BALANCE)
+            telegram = SimulatedTelegram(flood_limits=False)
+            node_runner, node_url = await serve(node.app())
+            telegram_runner, telegram_url = await serve(telegram.app())
+            write_config(conf_dir, node_url, telegram_url)
+            try:
+                results[engine] = await run_engine(engine, conf_dir, telegram, updates, args)
+            finally:
+                await telegram_runner.cleanup()
+                await node_runner.cleanup()
+            # Numbered across the whole run, so the same account keeps its placeholder from one update to the next
+            flat = normalize([text for replies in results[engine] for text in replies])
+            numbered = []
+            for replies in results[engine]:
+                numbered.append(flat[:len(replies)])
+                flat = flat[len(replies):]
+            results[engine] = numbered
+    return results
+
+
+def compare(results):
+    """
+    The updates the engines answered differently, as printable lines
+    """
+    differences = []
+    engines = list(results)
+    for index, update in enumerate(script()):
+        answers = [results[engine][index] for engine in engines]
+        if any(answer != answers[0] for answer in answers[1:]):
+            differences.append("update {} ({!r}):".format(index + 1, update['message'].get('text', '')))
+            for engine, answer in zip(engines, answers):
+                differences.append("  {}: {}".format(engine, answer))
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--settle', type=float, default=0.5,
+                        help='seconds without a new message after which an update is answered')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds each engine may take to start')
+    args = parser.parse_args()
+
+    db.init_db(get_settings())
+    db.create_tables()
+    db.migrate_tables()
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    differences = compare(results)
+    for difference in differences:
+        print(difference)
+    if differences:
+        sys.exit(1)
+    print("both engines sent the same {} messages for {} updates".format(
+        sum(len(replies) for replies in results['eventlet']), len(results['eventlet'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""
+Replay captured Telegram updates against the bot and report latency and side effects.
+
+Reads the gzip NDJSON captures written by modules/recorder.py and posts every update at its recorded offset,
+divided by --speed (1 for real time, 10 for ten times faster, 0 for as fast as possible).  Updates are posted
+open loop: a slow answer never delays the next update.
+
+By default the asyncio engine is served in this process against the simulated node and Bot API.  With --url the
+updates go to a bot that is already running; point its node_ip and telegram_api at the simulators started on
+--node-port and --telegram-port.  The Postgres
+database comes from the usual config (MY_CONF_DIR/webhooks.ini), which should be a scratch copy: with --seed
+every pseudonymous sender and chat member in the capture is added to it, and removed again afterwards.
+
+    MY_CONF_DIR=config python benchmarks/replay.py capture/updates-*.ndjson.gz --speed 10 --seed
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import sys
+import time
+
+from aiohttp import ClientSession, TCPConnector
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import modules.db as db
+from modules.simulator import SimulatedNode, SimulatedTelegram, serve
+import modules.triage as triage
+from modules.settings import get_settings
+
+# Raw receivable every account opens with on the simulated node
+OPENING_BALANCE = 10 ** 34
+
+# Side effects compared by --expect; cache hits and precomputed work make the other calls vary between runs
+EFFECTS = {'telegram': ('sendMessage',), 'node': ('send', 'receive', 'account_create')}
+
+
+def read_captures(paths):
+    """
+    Every recorded update as (arrival time, update), oldest first.  A capture cut short by a crash is read up to
+    its last complete line.
+    """
+    records = []
+    for path in paths:
+        with gzip.open(path, 'rt', encoding='utf-8') as capture:
+            try:
+                for line in capture:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    records.append((record['t'], record['u']))
+            except EOFError:
+                pass
+    records.sort(key=lambda record: record[0])
+    return records
+
+
+def seed_rows(records):
+    """
+    The users and chat members a capture needs for its tips to resolve
+    """
+    seen_users = {}
+    members = {}
+    for _, update in records:
+        message = update.get('message') or {}
+        sender = message.get('from')
+        if not sender or sender.get('is_bot'):
+            continue
+        seen_users[sender['id']] = sender.get('username') or sender.get('first_name', '')
+        if message.get('chat', {}).get('type') in ('group', 'supergroup'):
+            members[(message['chat']['id'], sender['id'])] = (message['chat'].get('title', ''),
+                                                               sender.get('username'))
+    return seen_users, members
+
+
+def seed_db(records):
+    """
+    Add the capture's users and chat members that are not in the DB yet.  Returns what was added.
+    """
+    seen_users, members = seed_rows(records)
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    with db.database.connection_context():
+        existing = {user.user_id for user in db.User.select(db.User.user_id).where(
+            db.User.user_id << list(seen_users))} if seen_users else set()
+        user_ids = [user_id for user_id in seen_users if user_id not in existing]
+        if user_ids:
+            db.User.insert_many([
+                {'user_id': user_id, 'user_name': seen_users[user_id], 'account': 'ban_replay{}'.format(user_id),
+                 'register': 1, 'created_ts': now} for user_id in user_ids]).execute()
+        member_ids = []
+        for (chat_id, member_id), (chat_name, member_name) in members.items():
+            if not db.TelegramChatMember.select().where(
+                    (db.TelegramChatMember.chat_id == chat_id) &
+                    (db.TelegramChatMember.member_id == member_id)).exists():
+                member_ids.append(db.TelegramChatMember.insert(
+                    chat_id=chat_id, chat_name=chat_name, member_id=member_id, member_name=member_name or '',
+                    created_ts=now).execute())
+    return user_ids, member_ids
+
+
+def unseed_db(user_ids, member_ids):
+    with db.database.connection_context():
+        if user_ids:
+            db.Tip.delete().where((db.Tip.sender << user_ids) | (db.Tip.receiver << user_ids)).execute()
+            db.Withdrawal.delete().where(db.Withdrawal.user << user_ids).execute()
+            db.User.delete().where(db.User.user_id << user_ids).execute()
+        if member_ids:
+            db.TelegramChatMember.delete().where(db.TelegramChatMember.id << member_ids).execute()
+
+
+def percentile(samples, fraction):
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def latency_table(latencies):
+    lines = ['{:<12} {:>8} {:>9} {:>9} {:>9} {:>9}'.format('update', 'count', 'p50 ms', 'p90 ms', 'p99 ms',
+                                                           'max ms')]
+    for outcome in sorted(latencies, key=lambda outcome: -len(latencies[outcome])):
+        samples = latencies[outcome]
+        lines.append('{:<12} {:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            outcome, len(samples), percentile(samples, 0.5) * 1000, percentile(samples, 0.9) * 1000,
+            percentile(samples, 0.99) * 1000, max(samples) * 1000))
+    return '\n'.join(lines)
+
+
+async def replay(records, url, speed):
+    """
+    Post every update at its recorded offset.  Returns the response times grouped by triage outcome, the wall
+    time and the furthest any update was posted behind its schedule.
+    """
+    latencies = {}
+    first = records[0][0] if records else 0.0
+    started = time.monotonic()
+    behind = {'seconds': 0.0}
+
+    async def post(session, offset, update):
+        if speed > 0:
+            await asyncio.sleep(max(0.0, started + offset / speed - time.monotonic()))
+            behind['seconds'] = max(behind['seconds'], time.monotonic() - started - offset / speed)
+        outcome = triage.classify_update(update) or 'unclassified'
+        posted = time.monotonic()
+        async with session.post(url, json=update) as resp:
+            await resp.read()
+        latencies.setdefault(outcome, []).append(time.monotonic() - posted)
+
+    async with ClientSession(connector=TCPConnector(limit=0)) as session:
+        await asyncio.gather(*[post(session, arrived - first, update) for arrived, update in records])
+    return latencies, time.monotonic() - started, behind['seconds']
+
+
+async def run(args, records):
+    settings = get_settings()
+    node = SimulatedNode(block_latency=args.latency, work_latency=args.latency, opening_balance=OPENING_BALANCE)
+    # Captured replies went out at the recorded pace; at higher speeds flood limits would only change the counts
+    telegram = SimulatedTelegram(args.latency, flood_limits=args.speed == 1)
+    node_runner, node_url = await serve(node.app(), port=args.node_port)
+    telegram_runner, telegram_url = await serve(telegram.app(), port=args.telegram_port)
+
+    bot_runner = None
+    url = args.url
+    if url is None:
+        import aioserver
+
+        settings.node_ip = node_url
+        settings.telegram_api = telegram_url
+        bot_runner, bot_url = await serve(await aioserver.create_app())
+        url = bot_url + '/'
+    print("simulated node: {}  simulated Bot API: {}  bot: {}".format(node_url, telegram_url, url))
+
+    latencies, elapsed, behind = await replay(records, url, args.speed)
+    # Background work (receives, DMs) may still be running after the last answer
+    await asyncio.sleep(args.settle)
+
+    if bot_runner is not None:
+        await bot_runner.cleanup()
+    await telegram_runner.cleanup()
+    await node_runner.cleanup()
+
+    print("updates replayed: {} in {:.2f}s ({:.1f}/s), at most {:.2f}s behind schedule".format(
+        len(records), elapsed, len(records) / elapsed if elapsed else 0.0, behind))
+    print(latency_table(latencies))
+    print("Bot API calls:  {}".format(json.dumps(telegram.counters, sort_keys=True)))
+    print("node RPC calls: {}".format(json.dumps(node.counters, sort_keys=True)))
+    return {
+        'updates': len(records),
+        'telegram': {method: telegram.counters.get(method, 0) for method in EFFECTS['telegram']},
+        'node': {action: node.counters.get(action, 0) for action in EFFECTS['node']}
+    }
+
+
+def compare(effects, expected, tolerance):
+    """
+    The differences between two side effect counts beyond tolerance (a fraction of the expected count), as
+    printable lines.  Throttle replies depend on timing, so runs at different speeds rarely match exactly.
+    """
+    differences = []
+    for group in ('telegram', 'node'):
+        for name in sorted(set(effects[group]) | set(expected.get(group, {}))):
+            wanted = expected.get(group, {}).get(name, 0)
+            if abs(effects[group].get(name, 0) - wanted) > wanted * tolerance:
+                differences.append("{} {}: expected {}, got {}".format(
+                    group, name, expected.get(group, {}).get(name, 0), effects[group].get(name, 0)))
+    if effects['updates'] != expected.get('updates'):
+        differences.append("updates: expected {}, got {}".format(expected.get('updates'), effects['updates']))
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('captures', nargs='+', help='capture files written by the recorder')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 for as fast as possible')
+    parser.add_argument('--url', help='post to this running bot instead of serving the asyncio engine here')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the simulated node and Bot API take')
+    parser.add_argument('--node-port', type=int, default=0, help='port of the simulated node')
+    parser.add_argument('--telegram-port', type=int, default=0, help='port of the simulated Bot API')
+    parser.add_argument('--settle', type=float, default=2.0, help='seconds to wait for background work')
+    parser.add_argument('--seed', action='store_true', help="add the capture's users and chat members to the DB")
+    parser.add_argument('--save', help='write the side effect counts to this JSON file')
+    parser.add_argument('--expect', help='fail unless the side effect counts match this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help='fraction by which each count may differ from --expect')
+    args = parser.parse_args()
+
+    records = read_captures(args.captures)
+    settings = get_settings()
+    db.init_db(settings)
+    seeded = seed_db(records) if args.seed else ([], [])
+    try:
+        effects = asyncio.get_event_loop().run_until_complete(run(args, records))
+    finally:
+        unseed_db(*seeded)
+
+    if args.save:
+        with open(args.save, 'w') as saved:
+            json.dump(effects, saved, indent=2, sort_keys=True)
+    if args.expect:
+        with open(args.expect) as expected:
+            differences = compare(effects, json.load(expected), args.tolerance)
+        for difference in differences:
+            print("MISMATCH {}".format(difference))
+        if differences:
+            sys.exit(1)
+        print("side effects match {}".format(args.expect))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import datetime
+import logging
+import time
+
+import eventlet
+from eventlet.event import Event
+from eventlet.queue import Empty, LightQueue
+
+import modules.db as db
+import modules.tracing as tracing
+
+# Seconds an idle mailbox waits for new work before it is garbage-collected
+IDLE_TIMEOUT = 60
+
+# account -> AccountMailbox for every account with a live actor
+mailboxes = {}
+
+# Totals kept for mailboxes that have already been garbage-collected
+collected = {'mailboxes': 0, 'processed': 0}
+
+
+class AccountMailbox():
+    """
+    Runs the chain operations of one account in order, on that account's own green thread.
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.queue = LightQueue()
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.thread = eventlet.spawn(self.run)
+
+    def run(self):
+        while True:
+            try:
+                func, args, kwargs, done, enqueued, trace = self.queue.get(timeout=IDLE_TIMEOUT)
+            except Empty:
+                if self.queue.qsize() == 0:
+                    self.collect()
+                    return
+                continue
+
+            wait = time.monotonic() - enqueued
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            try:
+                # The operation's stages belong to the trace of the update that queued it
+                with db.database.connection_context(), tracing.bind(trace):
+                    result = func(*args, **kwargs)
+            except Exception as e:
+                done.send_exception(e)
+            else:
+                done.send(result)
+            finally:
+                self.processed += 1
+
+    def collect(self):
+        if mailboxes.get(self.account) is self:
+            del mailboxes[self.account]
+        collected['mailboxes'] += 1
+        collected['processed'] += self.processed
+        logging.debug("{}: mailbox for {} collected after {} operations".format(
+            datetime.datetime.utcnow(), self.account, self.processed))
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'processed': self.processed,
+            'avg_wait': self.total_wait / self.processed if self.processed else 0.0,
+            'max_wait': self.max_wait
+        }
+
+
+def run_for_account(account, func, *args, **kwargs):
+    """
+    Queue func on the account's mailbox and wait for its result.  Calls made from inside the account's own
+    actor run inline, so an operation can reuse other operations on the same account.
+    """
+    mailbox = mailboxes.get(account)
+    if mailbox is not None and mailbox.thread is eventlet.getcurrent():
+        return func(*args, **kwargs)
+
+    if mailbox is None:
+        mailbox = AccountMailbox(account)
+        mailboxes[account] = mailbox
+
+    done = Event()
+    mailbox.queue.put((func, args, kwargs, done, time.monotonic(), tracing.active()))
+    return done.wait()
+
+
+def stats():
+    """
+    Queue depth and wait time per live account mailbox
+    """
+    return {
+        'accounts': {account: mailbox.stats() for account, mailbox in list(mailboxes.items())},
+        'collected': dict(collected)
+    }
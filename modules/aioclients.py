@@ -0,0 +1,204 @@
+import asyncio
+import datetime
+import logging
+import random
+import time
+
+import aiohttp
+import asyncpg
+import nano
+
+from modules.nodepool import NodeRouting
+from modules.resilience import RETRY_BACKOFF, RETRY_ON_ERROR, NodeBusyError, NodePolicy
+
+# Bot API error codes of a refusal: 400 Bad Request and 403 Forbidden
+REFUSED_CODES = {400, 403}
+
+# Shared clients of the asyncio engine, built once by aioserver.create_app() through init_clients()
+session = None
+rpc = None
+telegram_bot = None
+pool = None
+# Connection of its own that LISTENs for balance changes, see aiodb.listen_balances()
+listener = None
+
+
+class TelegramError(Exception):
+    """
+    Raised when the Bot API does not accept a call
+    """
+
+
+class TelegramRefused(TelegramError):
+    """
+    Raised when the Bot API refuses a call for good, like social.DM_REFUSED: the receiver blocked the bot or the
+    chat does not exist
+    """
+
+
+class AsyncNode(NodePolicy):
+    """
+    One node for the asyncio engine, with the same timeouts, retry rules and circuit breaker as
+    resilience.ResilientClient
+    """
+
+    async def call(self, action, params=None):
+        params = dict(params or {}, action=action)
+        attempts = 1 + self.retry_budget(action, params)
+        error = None
+
+        for attempt in range(attempts):
+            if attempt > 0:
+                self.count(action, 'retries')
+                await asyncio.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+            if not self.breaker.allow():
+                raise NodeBusyError("Node {} is busy, not calling {}".format(self.host, action))
+
+            self.count(action, 'calls')
+            call_start = time.monotonic()
+            try:
+                async with session.post(self.host, json=params,
+                                        timeout=aiohttp.ClientTimeout(total=self.timeout(action))) as resp:
+                    resp.raise_for_status()
+                    result = await resp.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.count(action, 'failures')
+                self.breaker.record_failure()
+                logging.info("{}: node call {} failed on attempt {}: {}".format(
+                    datetime.datetime.utcnow(), action, attempt + 1, e))
+                error = e
+                continue
+
+            self.breaker.record_success()
+            self.observe(time.monotonic() - call_start)
+            if 'error' not in result:
+                return result
+            error = nano.rpc.RPCException(result['error'])
+            if action not in RETRY_ON_ERROR:
+                raise error
+
+        raise error
+
+
+class AsyncNodePool(NodeRouting):
+    """
+    Nano RPC client of the asyncio engine: nodepool.NodeRouting over AsyncNodes, with the node RPC methods the
+    async modules use
+    """
+
+    def __init__(self, settings):
+        super(AsyncNodePool, self).__init__(AsyncNode(settings.node_ip, settings),
+                                            [AsyncNode(host, settings) for host in settings.read_nodes
+                                             if host != settings.node_ip], settings)
+        self.probe_task = None
+
+    def start_probes(self):
+        """
+        Probe every node in the background, only worthwhile when there is more than one node to choose from
+        """
+        if len(self.nodes) > 1:
+            self.probe_task = asyncio.get_event_loop().create_task(self.probe_loop())
+
+    async def probe_loop(self):
+        while True:
+            for node in self.nodes:
+                try:
+                    await node.call('block_count')
+                    self.probed(node)
+                except Exception as e:
+                    self.probed(node, e)
+            self.prune_pins()
+            await asyncio.sleep(self.probe_interval)
+
+    async def call(self, action, params=None):
+        nodes = self.route(action, params)
+        if len(nodes) == 1:
+            return await nodes[0].call(action, params)
+
+        error = None
+        for node in nodes:
+            try:
+                return await node.call(action, params)
+            except (NodeBusyError, aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.failed_over(action, node, e)
+                error = e
+        raise error
+
+    async def pending(self, account):
+        resp = await self.call('pending', {'account': account})
+        return resp.get('blocks') or []
+
+    async def receive(self, wallet, account, block, work=None):
+        params = {'wallet': wallet, 'account': account, 'block': block}
+        if work:
+            params['work'] = work
+        resp = await self.call('receive', params)
+        return resp['block']
+
+    async def send(self, wallet, source, destination, amount, id, work=None):
+        params = {'wallet': wallet, 'source': source, 'destination': destination, 'amount': str(amount), 'id': id}
+        if work:
+            params['work'] = work
+        resp = await self.call('send', params)
+        return resp['block']
+
+    async def accounts_balances(self, accounts):
+        resp = await self.call('accounts_balances', {'accounts': accounts})
+        return {account: {'balance': int(balance['balance']), 'pending': int(balance['pending'])}
+                for account, balance in (resp.get('balances') or {}).items()}
+
+    async def account_frontier(self, account):
+        resp = await self.call('accounts_frontiers', {'accounts': [account]})
+        return (resp.get('frontiers') or {})[account]
+
+    async def work_generate(self, hash):
+        resp = await self.call('work_generate', {'hash': hash, 'use_peers': 'true'})
+        return resp['work']
+
+    async def account_create(self, wallet, work=True):
+        resp = await self.call('account_create', {'wallet': wallet, 'work': 'true' if work else 'false'})
+        return resp['account']
+
+    async def validate_account_number(self, account):
+        resp = await self.call('validate_account_number', {'account': account})
+        return int(resp['valid'])
+
+
+class AsyncTelegram():
+    """
+    The part of the Bot API the tip bot uses, over the shared aiohttp session
+    """
+
+    def __init__(self, api, token):
+        self.url = '{}/bot{}/'.format(api, token)
+
+    async def send_message(self, chat_id, text):
+        async with session.post(self.url + 'sendMessage', json={'chat_id': chat_id, 'text': text}) as resp:
+            result = await resp.json(content_type=None)
+        if not result.get('ok'):
+            error = TelegramRefused if result.get('error_code', resp.status) in REFUSED_CODES else TelegramError
+            raise error(result.get('description', resp.status))
+        return result['result']
+
+
+async def init_clients(settings):
+    """
+    Open the HTTP session and the Postgres pool and share the clients with every async module
+    """
+    global session, rpc, telegram_bot, pool
+    session = aiohttp.ClientSession()
+    rpc = AsyncNodePool(settings)
+    rpc.start_probes()
+    telegram_bot = AsyncTelegram(settings.telegram_api, settings.telegram_key)
+    pool = await asyncpg.create_pool(host=settings.db_host, port=settings.db_port, user=settings.db_user,
+                                     password=settings.db_pw, database=settings.db_schema,
+                                     max_size=settings.db_connections)
+
+
+async def close_clients():
+    if rpc.probe_task is not None:
+        rpc.probe_task.cancel()
+    await session.close()
+    if listener is not None:
+        await listener.close()
+    await pool.close()
@@ -0,0 +1,314 @@
+import asyncio
+import datetime
+import logging
+
+import nano
+
+import modules.aioclients as aioclients
+import modules.aiodb as aiodb
+import modules.balances as balances
+import modules.db as db
+import modules.deposits as deposits
+import modules.social as social
+import modules.tips as tips
+import modules.wallets as wallets
+from modules.settings import get_settings
+
+# account -> (frontier hash, work) precomputed in the background for the account's next block
+work_cache = {}
+
+# Background tasks, referenced until they finish so they are not garbage collected mid-flight
+tasks = set()
+
+# Tip transitions made by this engine; the eventlet engine's tips.counters also count its scheduler's passes
+tip_counters = {name: 0 for name in tips.STATE_NAMES.values()}
+
+
+def spawn(coroutine):
+    task = asyncio.get_event_loop().create_task(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+
+async def receive_pending(account):
+    """
+    Receive every pending block of the account while holding its lock.  Returns the hashes of the received blocks.
+    """
+    received = []
+    await prepare_pow(account)
+    async with aiodb.account_lock(account) as connection:
+        pending_blocks = await aioclients.rpc.pending(account)
+        for block in pending_blocks:
+            work = await get_pow(account)
+            try:
+                received.append(await wallet_call(account, connection, 'receive', account, block, work=work))
+            except nano.rpc.RPCException as e:
+                logging.info("{}: block {} not received: {}".format(datetime.datetime.utcnow(), block, e))
+                continue
+        if received:
+            await aiodb.invalidate_balance(account, connection)
+            precache_work(account, received[-1])
+    return received
+
+
+async def get_pow(account):
+    """
+    Work for the account's next block, or '' to let the node generate it
+    """
+    try:
+        frontier_hash = await aioclients.rpc.account_frontier(account)
+    except Exception as e:
+        logging.info("{}: Error checking frontier: {}".format(datetime.datetime.utcnow(), e))
+        return ''
+
+    cached = work_cache.pop(account, None)
+    if cached is not None and cached[0] == frontier_hash:
+        return cached[1]
+    return await generate_pow(frontier_hash)
+
+
+async def prepare_pow(account):
+    """
+    Same as currency.prepare_pow(): work for the account's next block into the work_cache, before its lock is taken
+    """
+    try:
+        frontier_hash = await aioclients.rpc.account_frontier(account)
+    except Exception as e:
+        logging.info("{}: Error checking frontier: {}".format(datetime.datetime.utcnow(), e))
+        return
+    cached = work_cache.get(account)
+    if cached is not None and cached[0] == frontier_hash:
+        return
+    work = await generate_pow(frontier_hash)
+    if work != '':
+        work_cache[account] = (frontier_hash, work)
+
+
+async def generate_pow(frontier_hash):
+    try:
+        return await aioclients.rpc.work_generate(frontier_hash)
+    except Exception as e:
+        logging.info("{}: ERROR GENERATING WORK: {}".format(datetime.datetime.utcnow(), e))
+        return ''
+
+
+def precache_work(account, frontier_hash):
+    if frontier_hash is None:
+        return
+    spawn(cache_work(account, frontier_hash))
+
+
+async def cache_work(account, frontier_hash):
+    try:
+        work_cache[account] = (frontier_hash, await aioclients.rpc.work_generate(frontier_hash))
+    except Exception as e:
+        logging.info("{}: Could not precompute work for {}: {}".format(datetime.datetime.utcnow(), account, e))
+
+
+async def create_account(user_id, work=True):
+    """
+    Create an account for user_id in the wallet wallets.assign() picks.  Returns (account, wallet).
+    """
+    wallet = wallets.assign(user_id)
+    account = await aioclients.rpc.account_create(wallet, work=work)
+    wallets.remember(account, wallet)
+    return account, wallet
+
+
+async def owner(account, connection=None):
+    """
+    The wallet holding account, from the cache shared with wallets.owner()
+    """
+    if account not in wallets.owners:
+        wallets.remember(account, await aiodb.account_wallet(account, connection))
+    return wallets.owners[account]
+
+
+async def wallet_call(account, connection, method, *args, **kwargs):
+    """
+    Run a wallet-bound method of aioclients.rpc, which take the wallet first, with the retry rule of wallets.call().
+    Runs under aiodb.account_lock(), whose connection looks the owner up: the pool may have no other one left.
+    """
+    wallet = await owner(account, connection)
+    try:
+        return await getattr(aioclients.rpc, method)(wallet, *args, **kwargs)
+    except nano.rpc.RPCException as e:
+        if not wallets.moved(e):
+            raise
+        wallets.owners.pop(account, None)
+        if await owner(account, connection) == wallet:
+            raise
+        return await getattr(aioclients.rpc, method)(wallets.owners[account], *args, **kwargs)
+
+
+async def get_balance(account):
+    """
+    The balance from the cache shared with balances.get_balance(); for display only, like it
+    """
+    balance = balances.cached_balance(account)
+    if balance is not None:
+        return balance
+    return await fresh_balance(account)
+
+
+async def fresh_balance(account):
+    """
+    The balance read from the node, refreshing the shared cache; what a spend is checked against
+    """
+    version = balances.miss(account)
+    balance = (await aioclients.rpc.accounts_balances([account]))[account]
+    balances.store(account, version, balance)
+    return balance
+
+
+async def send_tip(message, users_to_tip, tip_index):
+    """
+    Record the tip and publish its send block.  Returns True once the send block is published.
+    """
+    receiver = users_to_tip[tip_index]
+    if str(receiver['receiver_id']) == str(message['sender_id']):
+        await send_reply(message, social.SELF_TIP_TEXT)
+        return False
+
+    try:
+        receiver['receiver_account'] = (await aiodb.get_user(receiver['receiver_id'])).account
+    except db.User.DoesNotExist:
+        receiver['receiver_account'], wallet = await create_account(receiver['receiver_id'], work=True)
+        await aiodb.create_user(receiver['receiver_id'], receiver['receiver_screen_name'],
+                                receiver['receiver_account'], register=0, wallet=wallet)
+        deposits.track_account(receiver['receiver_account'], int(receiver['receiver_id']))
+        logging.info("{}: Sender sent to a new receiving account.  Created  account {}".format(
+            datetime.datetime.utcnow(), receiver['receiver_account']))
+
+    message['tip_id'] = "{}{}".format(message['id'], tip_index)
+    receiver['tip'] = await aiodb.insert_tip(message, receiver['receiver_id'], tips.CREATED)
+    if receiver['tip'] is None:
+        # Same as currency.send_tip(): an earlier delivery of the update recorded it, the scheduler takes it on
+        return False
+    tip_counters[tips.STATE_NAMES[tips.CREATED]] += 1
+    try:
+        receiver['send_hash'] = await send_tip_block(receiver['tip'])
+    except tips.REFUSED:
+        # Same rule as currency.send_tip(): only a send the node refused fails, anything else is left for the
+        # scheduler to send again with the same id
+        await fail(receiver['tip'])
+        raise
+    logging.info("{}: tip sent to {} via hash {}".format(
+        datetime.datetime.utcnow(), receiver['receiver_screen_name'], receiver['send_hash']))
+    return True
+
+
+async def send_tip_block(tip_id):
+    """
+    Generate work and publish the send block of a recorded tip while holding the sender's lock
+    """
+    tip = await aiodb.get_tip(tip_id)
+    await prepare_pow(tip['sender_account'])
+    async with aiodb.account_lock(tip['sender_account']) as connection:
+        tip = await aiodb.get_tip(tip_id, connection)
+        if tip['processed'] >= tips.SENT:
+            return tip['send_hash']
+
+        work = await get_pow(tip['sender_account'])
+        await advance(tip_id, tips.WORK_READY, connection=connection)
+        send_hash = await wallet_call(
+            tip['sender_account'], connection, 'send', tip['sender_account'], tip['receiver_account'], int(tip['amount_raw']),
+            "tip-{}".format(tip['tx_id']), work=work)
+        await aiodb.invalidate_balance(tip['sender_account'], connection)
+        await aiodb.invalidate_balance(tip['receiver_account'], connection)
+        precache_work(tip['sender_account'], send_hash)
+        await advance(tip_id, tips.SENT, send_hash=send_hash, connection=connection)
+    return send_hash
+
+
+async def notify_receiver(message, users_to_tip, tip_index):
+    """
+    Receive the tip into the receiver's account and DM them.  Steps that fail are retried by the tip scheduler
+    of the eventlet engine, which reads the same tip rows.
+    """
+    receiver = users_to_tip[tip_index]
+    try:
+        await receive_pending(receiver['receiver_account'])
+        await advance(receiver['tip'], tips.RECEIVED)
+        if await deliver_dm(receiver['receiver_id'],
+                            social.tip_received_text(message['sender_screen_name'], message['tip_amount_text'])):
+            await advance(receiver['tip'], tips.NOTIFIED)
+        else:
+            await advance(receiver['tip'], tips.UNNOTIFIED)
+    except Exception as e:
+        logging.info("{}: ERROR IN RECEIVING NEW TIP: {}".format(datetime.datetime.utcnow(), e))
+        await record_failure(receiver['tip'])
+
+
+async def advance(tip_id, state, send_hash=None, connection=None):
+    if await aiodb.advance_tip(tip_id, state, send_hash, connection):
+        tip_counters[tips.STATE_NAMES[state]] += 1
+
+
+async def fail(tip_id, max_attempts=None):
+    if await aiodb.fail_tip(tip_id, max_attempts):
+        tip_counters[tips.STATE_NAMES[tips.FAILED]] += 1
+        logging.info("{}: Tip {} failed for good".format(datetime.datetime.utcnow(), tip_id))
+
+
+async def record_failure(tip_id):
+    await aiodb.count_tip_attempt(tip_id)
+    await fail(tip_id, get_settings().tip_max_attempts)
+
+
+async def receive_deposit(account):
+    """
+    Receive a deposit pushed by a node callback and tell the owner about it
+    """
+    try:
+        user_id = deposits.deposit_owner(account, await receive_pending(account))
+        if user_id is None:
+            return
+        balance_return = await get_balance(account)
+        await send_dm(user_id, deposits.deposit_text(balance_return))
+    except Exception as e:
+        logging.info("{}: Deposit receive for {} failed: {}".format(datetime.datetime.utcnow(), account, e))
+    finally:
+        deposits.queued.discard(account)
+
+
+def queue_receive(account):
+    if deposits.claim_receive(account):
+        spawn(receive_deposit(account))
+
+
+async def send_dm(receiver, text):
+    """
+    Send text to the receiver.  Returns False if Telegram did not take it.
+    """
+    try:
+        return await deliver_dm(receiver, text)
+    except Exception as e:
+        logging.info("{}: Send DM - Telegram ERROR: {}".format(datetime.datetime.utcnow(), e))
+        return False
+
+
+async def deliver_dm(receiver, text):
+    """
+    Same as social.deliver_dm(): returns False if Telegram refused the DM for good, raises on errors worth retrying
+    """
+    try:
+        await aioclients.telegram_bot.send_message(receiver, text)
+    except aioclients.TelegramRefused as e:
+        logging.info("{}: Send DM - Telegram refused: {}".format(datetime.datetime.utcnow(), e))
+        return False
+    return True
+
+
+async def send_reply(message, text):
+    await aioclients.telegram_bot.send_message(message['chat_id'], text)
+
+
+def tip_stats():
+    return {'counters': dict(tip_counters)}
+
+
+def deposit_stats():
+    # Receives run as background tasks rather than from deposits.receive_queue
+    return dict(deposits.stats(), backlog=len(deposits.queued))
@@ -0,0 +1,362 @@
+import asyncio
+import contextlib
+import datetime
+import time
+from decimal import Decimal
+
+import asyncpg
+from peewee import Select, Value, fn
+
+import modules.aioclients as aioclients
+import modules.balances as balances
+import modules.db as db
+import modules.deposits as deposits
+import modules.orchestration as orchestration
+import modules.social as social
+import modules.throttle as throttle
+import modules.tips as tips
+import modules.users as users
+import modules.wallets as wallets
+import modules.withdrawals as withdrawals
+
+# Queries of the asyncio engine against the tables of modules/db.py, built with peewee by the same functions the
+# eventlet engine uses where it has the query, and compiled once for asyncpg.  Functions that take a connection run
+# on it, e.g. inside account_lock(); without one they use any connection of the pool.
+
+# account -> [asyncio.Lock, number of tasks holding or waiting for it]
+account_locks = {}
+
+
+@contextlib.asynccontextmanager
+async def account_lock(account):
+    """
+    Serialize chain operations on an account: one task per process, then one process per database through the
+    same session advisory lock as db.account_lock().  Yields the connection holding the lock; what is written on
+    it commits right away.  Unlike db.account_lock() it is not reentrant.
+    """
+    entry = account_locks.setdefault(account, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            async with aioclients.pool.acquire() as connection:
+                key = db.account_lock_key(account)
+                await connection.execute('SELECT pg_advisory_lock($1)', key)
+                try:
+                    yield connection
+                finally:
+                    await connection.execute('SELECT pg_advisory_unlock($1)', key)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del account_locks[account]
+
+
+def numbered(sql):
+    # The psycopg2 placeholders of SQL shared with the eventlet engine, as asyncpg's $1, $2, ...
+    parts = sql.split('%s')
+    return parts[0] + ''.join('${}{}'.format(index, part) for index, part in enumerate(parts[1:], 1))
+
+
+class Arg():
+    """
+    The index-th value, from 1, a Statement is run with
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+
+def arg(index):
+    # Stands for a value in a query compiled once and run with different values
+    return Value(Arg(index), converter=False)
+
+
+class Statement():
+    """
+    A peewee query with arg() in place of its values, as asyncpg SQL.  The constants of the query stay in place.
+    """
+
+    def __init__(self, query):
+        sql, self.params = query.sql()
+        self.sql = numbered(sql)
+
+    def args(self, values):
+        return [values[param.index - 1] if isinstance(param, Arg) else param for param in self.params]
+
+
+async def execute(statement, *values, connection=None):
+    return await (connection or aioclients.pool).execute(statement.sql, *statement.args(values))
+
+
+async def fetch(statement, *values, connection=None):
+    return await (connection or aioclients.pool).fetch(statement.sql, *statement.args(values))
+
+
+async def fetchrow(statement, *values, connection=None):
+    return await (connection or aioclients.pool).fetchrow(statement.sql, *statement.args(values))
+
+
+async def fetchval(statement, *values, connection=None):
+    return await (connection or aioclients.pool).fetchval(statement.sql, *statement.args(values))
+
+
+def exists(query):
+    return Select(columns=[fn.EXISTS(query)]).bind(db.database)
+
+
+GET_USER = Statement(users.user_query(arg(1)))
+REGISTER_USER = Statement(users.register_query(arg(1)))
+INSERT_USER = Statement(db.User.insert(user_id=arg(1), user_name=arg(2), account=arg(3), register=arg(4),
+                                       created_ts=arg(5), wallet=arg(6)))
+ACCOUNT_WALLET = Statement(wallets.wallet_query(arg(1)).limit(1))
+ALL_ACCOUNTS = Statement(deposits.accounts_query())
+AIRDROP_SOURCES = Statement(deposits.sources_query())
+ACCOUNT_OWNER = Statement(deposits.owner_query(arg(1)).limit(1))
+AIRDROP_SOURCE = Statement(exists(deposits.source_query(arg(1))))
+MEMBER_EXISTS = Statement(exists(social.member_query(arg(1), arg(2))))
+INSERT_MEMBER = Statement(db.TelegramChatMember.insert(chat_id=arg(1), chat_name=arg(2), member_id=arg(3),
+                                                       member_name=arg(4), created_ts=arg(5)))
+DELETE_MEMBER = Statement(social.delete_member_query(arg(1), arg(2)))
+FIND_MEMBER = {kind: Statement(social.target_query(arg(1), kind, arg(2)).limit(1)) for kind in ('id', 'name')}
+INSERT_TIP = Statement(db.Tip.insert(
+    dm_id=arg(1), tx_id=arg(2), processed=arg(3), sender=arg(4), receiver=arg(5), dm_text=arg(6), amount=arg(7),
+    amount_raw=arg(8), created_ts=arg(9), updated_ts=arg(9)).on_conflict_ignore())
+Sender = db.User.alias('sender')
+Receiver = db.User.alias('receiver')
+GET_TIP = Statement(db.Tip.select(db.Tip, Sender.account.alias('sender_account'),
+                                  Receiver.account.alias('receiver_account')).join(
+    Sender, on=(Sender.user_id == db.Tip.sender)).switch(db.Tip).join(
+    Receiver, on=(Receiver.user_id == db.Tip.receiver)).where(db.Tip.id == arg(1)))
+ADVANCE_TIP = Statement(tips.advance_query(arg(1), arg(2), arg(3)))
+ADVANCE_SENT_TIP = Statement(tips.advance_query(arg(1), arg(2), arg(3), send_hash=arg(4)))
+FAIL_TIP = Statement(tips.fail_query(arg(1)))
+FAIL_EXHAUSTED_TIP = Statement(tips.fail_query(arg(1), tips.exhausted(arg(2))))
+COUNT_TIP_ATTEMPT = Statement(tips.attempt_query(arg(1), arg(2)))
+INSERT_WITHDRAWAL = Statement(db.Withdrawal.insert(
+    user=arg(1), sender_account=arg(2), receiver_account=arg(3), amount_raw=arg(4), status=arg(5),
+    created_ts=arg(6), updated_ts=arg(6)))
+GET_WITHDRAWAL = Statement(db.Withdrawal.select().where(db.Withdrawal.id == arg(1)))
+LEFTOVER_WITHDRAWALS = Statement(withdrawals.leftovers_query())
+SET_WITHDRAWAL_STATUS = Statement(db.Withdrawal.update(
+    status=arg(2), send_hash=arg(3), error=arg(4), updated_ts=arg(5),
+    amount_raw=fn.COALESCE(arg(6), db.Withdrawal.amount_raw)).where(db.Withdrawal.id == arg(1)))
+RECENT_WITHDRAWALS = Statement(orchestration.recent_withdrawals_query(arg(1)))
+
+
+def updated(status):
+    # asyncpg returns the command tag, e.g. 'UPDATE 1'
+    return int(status.split()[-1])
+
+
+async def get_user(user_id):
+    """
+    The user with user_id, through the process cache of users.get_user()
+    """
+    user_id = int(user_id)
+    user = users.cached_user(user_id)
+    if user is not None:
+        return user
+    row = await fetchrow(GET_USER, user_id)
+    if row is None:
+        raise db.User.DoesNotExist()
+    user = db.User(**row)
+    users.cache_user(user)
+    return user
+
+
+async def invalidate_balance(account, connection=None):
+    """
+    Drop the account's cached balance here and announce the change to every other process, see
+    balances.invalidate()
+    """
+    balances.drop(account)
+    await (connection or aioclients.pool).execute(numbered(balances.NOTIFY_SQL), account)
+
+
+async def invalidate_user(user_id, connection=None):
+    """
+    Drop the user here and announce the change to every other process, see users.invalidate()
+    """
+    users.drop(user_id)
+    await (connection or aioclients.pool).execute(numbered(users.NOTIFY_SQL), str(int(user_id)))
+
+
+async def listen_balances(settings):
+    """
+    Drop the balances and users other processes announce, like balances.listen(), over a connection of its own
+    """
+    aioclients.listener = await asyncpg.connect(host=settings.db_host, port=settings.db_port, user=settings.db_user,
+                                                password=settings.db_pw, database=settings.db_schema)
+    await aioclients.listener.add_listener(balances.CHANNEL, heard)
+    await aioclients.listener.add_listener(users.CHANNEL, heard_user)
+    balances.state['listening'] = True
+
+
+def heard(connection, pid, channel, account):
+    balances.heard(account)
+    aioclients.rpc.pin(account)
+
+
+def heard_user(connection, pid, channel, user_id):
+    users.heard(user_id)
+
+
+async def check_throttle(sender_id, chat_id=None):
+    """
+    Take a token from the throttle buckets shared with throttle.check(), which decides it the same way: from this
+    process's claimed tokens when it can, otherwise with throttle.settle()
+    """
+    specs = throttle.bucket_specs(sender_id, chat_id)
+    now = time.time()
+    reply, claim = throttle.local_check(specs, now)
+    if not claim:
+        return reply
+    async with aioclients.pool.acquire() as connection:
+        async with connection.transaction():
+            rows = await connection.fetch(
+                numbered(throttle.REFILL_SQL.format(', '.join([throttle.REFILL_VALUES] * len(claim)))),
+                *throttle.refill_params(claim, now))
+            refilled = {row['key']: (row['tokens'], row['notified']) for row in rows}
+            reply, takes, notify = throttle.settle(specs, claim, refilled, now, sender_id, chat_id)
+            if takes:
+                await connection.execute(
+                    numbered(throttle.TAKE_SQL.format(', '.join([throttle.TAKE_VALUES] * len(takes)))),
+                    *throttle.take_params(takes))
+            if notify is not None:
+                await connection.execute(numbered(throttle.NOTIFY_SQL), notify)
+        if throttle.due_for_prune():
+            await connection.execute(numbered(throttle.PRUNE_SQL), now)
+    return reply
+
+
+async def mark_registered(user_id):
+    await execute(REGISTER_USER, int(user_id))
+    await invalidate_user(user_id)
+
+
+async def create_user(user_id, user_name, account, register, wallet):
+    """
+    Insert a new user row for an account created in wallet.  Returns the number of rows inserted.
+    """
+    status = await execute(INSERT_USER, int(user_id), user_name, account, register, datetime.datetime.utcnow(),
+                           wallet)
+    await invalidate_user(user_id)
+    return updated(status)
+
+
+async def account_wallet(account, connection=None):
+    """
+    The wallet stored with the user of account; None for accounts that are not users' or have none stored
+    """
+    return await fetchval(ACCOUNT_WALLET, account, connection=connection)
+
+
+async def all_accounts():
+    return await fetch(ALL_ACCOUNTS)
+
+
+async def airdrop_sources():
+    return [row['source_account'] for row in await fetch(AIRDROP_SOURCES)]
+
+
+async def bot_managed(account):
+    """
+    True when account is one of the bot's own, see deposits.bot_managed()
+    """
+    if deposits.known_managed(account):
+        return True
+    user_id = await fetchval(ACCOUNT_OWNER, account)
+    if user_id is not None:
+        return deposits.remember_managed(account, user_id, False)
+    return deposits.remember_managed(account, None, await fetchval(AIRDROP_SOURCE, account))
+
+
+async def member_exists(chat_id, member_id):
+    return await fetchval(MEMBER_EXISTS, int(chat_id), int(member_id))
+
+
+async def insert_member(chat_id, chat_name, member_id, member_name):
+    await execute(INSERT_MEMBER, int(chat_id), chat_name, int(member_id), member_name, datetime.datetime.utcnow())
+
+
+async def delete_member(chat_id, member_id):
+    await execute(DELETE_MEMBER, int(chat_id), int(member_id))
+
+
+async def find_member(chat_id, kind, key):
+    """
+    The chat member a social.tip_targets() target points at, or None
+    """
+    return await fetchrow(FIND_MEMBER['id' if kind == 'id' else 'name'], int(chat_id), key)
+
+
+async def insert_tip(message, receiver_id, processed):
+    """
+    Insert the row db.set_db_data_tip() writes.  Returns the id of the new tip, or None when it is recorded already.
+    """
+    return await fetchval(
+        INSERT_TIP, int(message['id']), int(message['tip_id']), processed, int(message['sender_id']),
+        int(receiver_id), db.tip_dm_text(message), int(message['tip_amount']),
+        Decimal(int(message['tip_amount_raw'])), datetime.datetime.utcnow())
+
+
+async def get_tip(tip_id, connection=None):
+    """
+    The tip with the accounts of its sender and receiver
+    """
+    return await fetchrow(GET_TIP, tip_id, connection=connection)
+
+
+async def advance_tip(tip_id, state, send_hash=None, connection=None):
+    """
+    Move the tip to state, only ever forward like tips.advance().  Returns the number of rows updated.
+    """
+    now = datetime.datetime.utcnow()
+    if send_hash is None:
+        status = await execute(ADVANCE_TIP, tip_id, state, now, connection=connection)
+    else:
+        status = await execute(ADVANCE_SENT_TIP, tip_id, state, now, send_hash, connection=connection)
+    return updated(status)
+
+
+async def fail_tip(tip_id, max_attempts=None):
+    """
+    Give up on the tip like tips.fail(), or once it ran out of attempts like tips.record_failure().  Returns the
+    number of rows updated.
+    """
+    if max_attempts is None:
+        return updated(await execute(FAIL_TIP, tip_id))
+    return updated(await execute(FAIL_EXHAUSTED_TIP, tip_id, max_attempts))
+
+
+async def count_tip_attempt(tip_id):
+    await execute(COUNT_TIP_ATTEMPT, tip_id, datetime.datetime.utcnow())
+
+
+async def insert_withdrawal(user, receiver_account, amount_raw, status):
+    now = datetime.datetime.utcnow()
+    return await fetchval(INSERT_WITHDRAWAL, int(user.user_id), user.account, receiver_account,
+                          None if amount_raw is None else Decimal(int(amount_raw)), status, now)
+
+
+async def get_withdrawal(withdrawal_id, connection=None):
+    return await fetchrow(GET_WITHDRAWAL, withdrawal_id, connection=connection)
+
+
+async def leftover_withdrawals():
+    return [row['id'] for row in await fetch(LEFTOVER_WITHDRAWALS)]
+
+
+async def set_withdrawal_status(withdrawal_id, status, send_hash=None, error=None, amount_raw=None,
+                                connection=None):
+    """
+    Update the withdrawal like withdrawals.set_status().  Returns the time of the update.
+    """
+    now = datetime.datetime.utcnow()
+    await execute(SET_WITHDRAWAL_STATUS, withdrawal_id, status, send_hash, error, now,
+                  None if amount_raw is None else Decimal(int(amount_raw)), connection=connection)
+    return now
+
+
+async def recent_withdrawals(user_id):
+    return [dict(row) for row in await fetch(RECENT_WITHDRAWALS, int(user_id))]
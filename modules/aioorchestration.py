@@ -0,0 +1,343 @@
+import asyncio
+import datetime
+import logging
+import re
+
+import modules.aioclients as aioclients
+import modules.aiocurrency as aiocurrency
+import modules.aiodb as aiodb
+import modules.aiowithdrawals as aiowithdrawals
+import modules.balances as balances
+import modules.db as db
+import modules.deposits as deposits
+import modules.orchestration as orchestration
+import modules.social as social
+import modules.triage as triage
+from modules.resilience import NodeBusyError
+from modules.settings import get_settings
+
+# Parsing, replies and decisions come from the eventlet engine's modules; only the I/O is async here
+
+counters = {'in_flight': 0, 'peak_in_flight': 0, 'handled': 0, 'errors': 0}
+
+
+async def handle_update(update):
+    """
+    Triage the update like webhooks.telegram_event(), then take the full path for DMs, tips and service messages
+    """
+    outcome = triage.classify_update(update)
+    triage.count(outcome)
+    if outcome in triage.FAST_PATH:
+        if outcome in triage.TOUCHES_MEMBER:
+            message = update['message']
+            touch_member(message['chat']['id'], message['chat'].get('title', ''), message['from']['id'],
+                         social.get_screen_name(message['from']))
+        return
+
+    counters['in_flight'] += 1
+    counters['peak_in_flight'] = max(counters['peak_in_flight'], counters['in_flight'])
+    try:
+        await process_update(update)
+    except Exception as e:
+        counters['errors'] += 1
+        logging.error('Fatal error: {}'.format(e))
+    finally:
+        counters['in_flight'] -= 1
+        counters['handled'] += 1
+
+
+async def process_update(request_json):
+    if 'message' not in request_json:
+        return
+    chat_type = request_json['message']['chat']['type']
+    if chat_type == 'private':
+        message = social.parse_private_message(request_json)
+        await parse_action(message)
+    elif chat_type == 'supergroup' or chat_type == 'group':
+        if 'forward_from' in request_json['message']:
+            return
+        if 'text' in request_json['message']:
+            await group_message(request_json)
+        else:
+            await member_update(request_json['message'])
+
+
+async def group_message(request_json):
+    message = social.parse_group_message(request_json)
+
+    throttled_text = await aiodb.check_throttle(message['sender_id'], message['chat_id'])
+    if throttled_text is not None:
+        if throttled_text != '':
+            await aiocurrency.send_reply(message, throttled_text)
+        return
+
+    await check_member(message['chat_id'], message['chat_name'], message['sender_id'],
+                       message['sender_screen_name'])
+
+    message = social.check_message_action(message)
+    if message['action'] is None:
+        return
+
+    error_text = social.parse_tip_amount(message)
+    if error_text is not None:
+        if error_text != '':
+            await aiocurrency.send_reply(message, error_text)
+        return
+
+    if str(message['sender_id']) != str(get_settings().bot_id_telegram):
+        try:
+            await tip_process(message, request_json)
+        except NodeBusyError:
+            await aiocurrency.send_reply(message, social.NODE_BUSY_TEXT)
+
+
+async def tip_process(message, request_json):
+    """
+    Send the tips of a group message: sends from one account are sequential, receivers are notified concurrently
+    """
+    users_to_tip = await set_tip_list(message, request_json)
+
+    await validate_sender(message)
+    if message['sender_account'] is None:
+        return
+
+    if not social.covers_total(message):
+        await aiocurrency.send_reply(message, social.not_enough_text(message))
+        return
+
+    sent = [t_index for t_index in range(0, len(users_to_tip))
+            if await aiocurrency.send_tip(message, users_to_tip, t_index)]
+    await asyncio.gather(*[aiocurrency.notify_receiver(message, users_to_tip, t_index) for t_index in sent])
+
+    if not sent:
+        return
+    tip_success_text = social.tip_success_text(message, len(users_to_tip))
+    if tip_success_text is not None:
+        await aiocurrency.send_reply(message, tip_success_text)
+
+
+async def set_tip_list(message, request_json):
+    """
+    The receivers of the tip, or an empty list when one of them is not a member of the chat
+    """
+    users_to_tip = []
+    for kind, key, display_name in social.tip_targets(message, request_json):
+        member = await aiodb.find_member(message['chat_id'], kind, key)
+        if member is None:
+            await aiocurrency.send_reply(message, social.missing_user_text(display_name))
+            users_to_tip.clear()
+            break
+        social.add_receiver(users_to_tip, member['member_id'], member['member_name'])
+    social.set_total_tip_amount(message, len(users_to_tip))
+    return users_to_tip
+
+
+async def validate_sender(message):
+    try:
+        user = await aiodb.get_user(message['sender_id'])
+    except db.User.DoesNotExist:
+        await aiocurrency.send_reply(message, social.NO_TIP_ACCOUNT_TEXT)
+        message['sender_account'] = None
+        return
+    message['sender_account'] = user.account
+    if user.register != 1:
+        await aiodb.mark_registered(message['sender_id'])
+
+    await aiocurrency.receive_pending(message['sender_account'])
+    message['sender_balance_raw'] = await aiocurrency.fresh_balance(message['sender_account'])
+
+
+async def parse_action(message):
+    command = orchestration.dm_command(message)
+    if command in orchestration.EXPENSIVE_COMMANDS:
+        throttled_text = await aiodb.check_throttle(message['sender_id'])
+        if throttled_text is not None:
+            if throttled_text != '':
+                await aiocurrency.send_dm(message['sender_id'], throttled_text)
+            return
+
+    processes = {
+        'help': help_process,
+        'balance': balance_process,
+        'register': register_process,
+        'tip': redirect_tip_process,
+        'withdrawals': withdrawals_process,
+        'withdraw': withdraw_process,
+        'account': account_process
+    }
+    try:
+        await processes.get(command, wrong_format_process)(message)
+    except NodeBusyError:
+        await aiocurrency.send_dm(message['sender_id'], social.NODE_BUSY_TEXT)
+
+
+async def help_process(message):
+    await aiocurrency.send_dm(message['sender_id'], orchestration.HELP_TEXT)
+
+
+async def redirect_tip_process(message):
+    await aiocurrency.send_dm(message['sender_id'], orchestration.REDIRECT_TIP_TEXT)
+
+
+async def wrong_format_process(message):
+    await aiocurrency.send_dm(message['sender_id'], orchestration.WRONG_FORMAT_TEXT)
+
+
+async def withdrawals_process(message):
+    recent = await aiodb.recent_withdrawals(message['sender_id'])
+    await aiocurrency.send_dm(message['sender_id'], orchestration.withdrawals_text(recent))
+
+
+async def balance_process(message):
+    try:
+        user = await aiodb.get_user(message['sender_id'])
+    except db.User.DoesNotExist:
+        await aiocurrency.send_dm(message['sender_id'], orchestration.NO_BALANCE_ACCOUNT_TEXT)
+        return
+    if user.register == 0:
+        await aiodb.mark_registered(message['sender_id'])
+
+    balance_return = balances.cached_balance(user.account)
+    if orchestration.balance_stale(balance_return):
+        if not deposits.callbacks_enabled():
+            await aiocurrency.receive_pending(user.account)
+        balance_return = await aiocurrency.get_balance(user.account)
+
+    pending_queued = orchestration.receiving_pending(balance_return)
+    if pending_queued:
+        aiocurrency.queue_receive(user.account)
+    await aiocurrency.send_dm(message['sender_id'], orchestration.balance_text(balance_return, pending_queued))
+
+
+async def register_process(message):
+    try:
+        user = await aiodb.get_user(message['sender_id'])
+    except db.User.DoesNotExist:
+        sender_account, wallet = await aiocurrency.create_account(message['sender_id'], work=False)
+        if await aiodb.create_user(message['sender_id'], message['sender_screen_name'], sender_account,
+                                   register=1, wallet=wallet) > 0:
+            deposits.track_account(sender_account, int(message['sender_id']))
+            await send_account_message(orchestration.REGISTERED_TEXT, message, sender_account)
+        else:
+            await aiocurrency.send_dm(message['sender_id'], orchestration.REGISTER_FAILED_TEXT)
+        return
+
+    if user.register == 0:
+        await aiodb.mark_registered(message['sender_id'])
+    await send_account_message(orchestration.register_text(user), message, user.account)
+
+
+async def account_process(message):
+    try:
+        user = await aiodb.get_user(message['sender_id'])
+    except db.User.DoesNotExist:
+        sender_account, wallet = await aiocurrency.create_account(message['sender_id'], work=True)
+        await aiodb.create_user(message['sender_id'], message['sender_screen_name'], sender_account, register=1,
+                                wallet=wallet)
+        deposits.track_account(sender_account, int(message['sender_id']))
+        await send_account_message(orchestration.ACCOUNT_CREATED_TEXT, message, sender_account)
+        return
+
+    if user.register == 0:
+        await aiodb.mark_registered(message['sender_id'])
+    await send_account_message(orchestration.ACCOUNT_TEXT, message, user.account)
+
+
+async def withdraw_process(message):
+    receiver_account, withdraw_amount_raw, error_text = orchestration.parse_withdraw(message)
+    if error_text is not None:
+        await aiocurrency.send_dm(message['sender_id'], error_text)
+        return
+    try:
+        user = await aiodb.get_user(message['sender_id'])
+    except db.User.DoesNotExist:
+        await aiocurrency.send_dm(message['sender_id'], orchestration.WITHDRAW_NO_ACCOUNT_TEXT)
+        return
+    withdrawal_id = await aiowithdrawals.queue_withdrawal(user, receiver_account, withdraw_amount_raw)
+    await aiocurrency.send_dm(message['sender_id'], orchestration.withdraw_queued_text(withdrawal_id))
+
+
+async def send_account_message(account_text, message, account):
+    await aiocurrency.send_dm(message['sender_id'], account_text)
+    await aiocurrency.send_dm(message['sender_id'], account)
+
+
+async def check_member(chat_id, chat_name, member_id, member_name):
+    """
+    Store the member unless the member cache shared with social.check_telegram_member() knows it already
+    """
+    key = social.member_key(chat_id, member_id)
+    if social.seen_member(key):
+        return
+    if not await aiodb.member_exists(chat_id, member_id):
+        await aiodb.insert_member(chat_id, chat_name, member_id, member_name)
+    social.cache_telegram_member(key)
+
+
+def touch_member(chat_id, chat_title, member_id, member_name):
+    """
+    Record that a member spoke in a chat in a background task, off the request path, see
+    social.touch_telegram_member()
+    """
+    key = social.member_key(chat_id, member_id)
+    if social.claim_member(key):
+        aiocurrency.spawn(record_member(key, chat_id, re.sub(r'\W+', ' ', chat_title), member_id, member_name))
+
+
+async def record_member(key, chat_id, chat_name, member_id, member_name):
+    try:
+        await check_member(chat_id, chat_name, member_id, member_name)
+    except Exception as e:
+        logging.info("{}: Could not record member {} of chat {}: {}".format(
+            datetime.datetime.utcnow(), member_id, chat_id, e))
+    finally:
+        social.member_queued.discard(key)
+
+
+async def member_update(message):
+    """
+    Members joining or leaving a chat, and the creator of a new chat
+    """
+    chat_id = message['chat']['id']
+    chat_name = message['chat']['title']
+    if 'new_chat_member' in message:
+        member = message['new_chat_member']
+        await aiodb.insert_member(chat_id, chat_name, member['id'], member.get('username'))
+    elif 'left_chat_member' in message:
+        member = message['left_chat_member']
+        social.member_cache.pop(social.member_key(chat_id, member['id']), None)
+        await aiodb.delete_member(chat_id, member['id'])
+    elif 'group_chat_created' in message:
+        await aiodb.insert_member(chat_id, chat_name, message['from']['id'], message['from'].get('username'))
+
+
+async def load_accounts():
+    """
+    Load the accounts deposits.handle_callback() watches, like deposits.load_accounts()
+    """
+    try:
+        for row in await aiodb.all_accounts():
+            deposits.track_account(row['account'], row['user_id'])
+        deposits.sources.update(await aiodb.airdrop_sources())
+        logging.info("{}: Watching {} accounts for deposits".format(
+            datetime.datetime.utcnow(), len(deposits.accounts)))
+    except Exception as e:
+        logging.info("{}: Could not load accounts for deposits: {}".format(datetime.datetime.utcnow(), e))
+
+
+async def handle_callback(payload):
+    """
+    Queue a receive when the node reports a deposit from outside the bot, see deposits.handle_callback()
+    """
+    destination, sender = deposits.callback_deposit(payload)
+    if destination is None:
+        return
+    if not deposits.count_deposit(bool(sender) and await aiodb.bot_managed(sender)):
+        return
+    aioclients.rpc.pin(destination)
+    await aiodb.invalidate_balance(destination)
+    aiocurrency.queue_receive(destination)
+
+
+def stats():
+    return dict(counters, background_tasks=len(aiocurrency.tasks))
@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+import logging
+
+import modules.aioclients as aioclients
+import modules.aiocurrency as aiocurrency
+import modules.aiodb as aiodb
+import modules.withdrawals as withdrawals
+from modules.resilience import NodeBusyError
+from modules.settings import get_settings
+
+# Withdrawal ids waiting for a free executor task; created on the running loop by start_executor()
+pending = None
+
+
+def start_executor(settings):
+    """
+    Start the bounded pool of executor tasks and resume withdrawals left over by a previous worker
+    """
+    global pending
+    pending = asyncio.Queue()
+    for _ in range(settings.withdraw_concurrency):
+        aiocurrency.spawn(executor())
+    aiocurrency.spawn(resume_withdrawals())
+
+
+async def executor():
+    while True:
+        withdrawal_id = await pending.get()
+        try:
+            await process_withdrawal(withdrawal_id)
+        except Exception as e:
+            logging.info("{}: Withdrawal {} executor error: {}".format(
+                datetime.datetime.utcnow(), withdrawal_id, e))
+
+
+async def resume_withdrawals():
+    try:
+        for withdrawal_id in await aiodb.leftover_withdrawals():
+            pending.put_nowait(withdrawal_id)
+    except Exception as e:
+        logging.info("{}: Could not resume queued withdrawals: {}".format(datetime.datetime.utcnow(), e))
+
+
+async def queue_withdrawal(user, receiver_account, amount_raw):
+    """
+    Record the withdrawal and hand it to the executor.  Returns its id.
+    """
+    withdrawal_id = await aiodb.insert_withdrawal(user, receiver_account, amount_raw, withdrawals.QUEUED)
+    withdrawals.counters[withdrawals.QUEUED] += 1
+    pending.put_nowait(withdrawal_id)
+    return withdrawal_id
+
+
+async def set_status(withdrawal_id, status, **fields):
+    withdrawals.counters[status] += 1
+    return await aiodb.set_withdrawal_status(withdrawal_id, status, **fields)
+
+
+async def process_withdrawal(withdrawal_id):
+    withdrawal = await aiodb.get_withdrawal(withdrawal_id)
+    if withdrawal['status'] not in (withdrawals.QUEUED, withdrawals.SENDING):
+        return
+    try:
+        await send_withdrawal(withdrawal_id)
+    except NodeBusyError:
+        retry_later(withdrawal_id)
+    except Exception as e:
+        withdrawal = await aiodb.get_withdrawal(withdrawal_id)
+        if withdrawals.resend(withdrawal['status'], e):
+            logging.info("{}: Withdrawal {} may have been sent, sending it again later: {}".format(
+                datetime.datetime.utcnow(), withdrawal_id, e))
+            retry_later(withdrawal_id)
+            return
+        logging.info("{}: Withdrawal {} failed: {}".format(datetime.datetime.utcnow(), withdrawal_id, e))
+        await set_status(withdrawal_id, withdrawals.FAILED, error=str(e)[:255])
+        await aiocurrency.send_dm(withdrawal['user_id'], withdrawals.failed_text(withdrawal_id))
+
+
+def retry_later(withdrawal_id):
+    withdrawals.counters['retried'] += 1
+    asyncio.get_event_loop().call_later(get_settings().breaker_cooldown, pending.put_nowait, withdrawal_id)
+
+
+async def send_withdrawal(withdrawal_id):
+    """
+    Validate a queued withdrawal with withdrawals.check_withdrawal() and send it while holding the sender's lock,
+    committing the amount with the SENDING state first like withdrawals.send_withdrawal().  Pending blocks are
+    received before the lock is taken because the async lock is not reentrant.
+    """
+    withdrawal = await aiodb.get_withdrawal(withdrawal_id)
+    sender_account = withdrawal['sender_account']
+    if withdrawal['status'] == withdrawals.QUEUED:
+        await aiocurrency.receive_pending(sender_account)
+    await aiocurrency.prepare_pow(sender_account)
+
+    async with aiodb.account_lock(sender_account) as connection:
+        withdrawal = await aiodb.get_withdrawal(withdrawal_id, connection)
+        if withdrawal['status'] == withdrawals.QUEUED:
+            balance_return = (await aioclients.rpc.accounts_balances([sender_account]))[sender_account]
+            receiver_valid = await aioclients.rpc.validate_account_number(withdrawal['receiver_account']) != 0
+            withdraw_amount_raw, reason_text = withdrawals.check_withdrawal(
+                sender_account, withdrawal['amount_raw'], receiver_valid, balance_return['balance'])
+            if reason_text is not None:
+                await set_status(withdrawal_id, withdrawals.FAILED, error=reason_text[:255], connection=connection)
+                await aiocurrency.send_dm(withdrawal['user_id'], reason_text)
+                return
+            await set_status(withdrawal_id, withdrawals.SENDING, amount_raw=withdraw_amount_raw,
+                             connection=connection)
+        elif withdrawal['status'] != withdrawals.SENDING:
+            return
+        else:
+            withdraw_amount_raw = int(withdrawal['amount_raw'])
+
+        work = await aiocurrency.get_pow(sender_account)
+        send_hash = await aiocurrency.wallet_call(
+            sender_account, connection, 'send', sender_account, withdrawal['receiver_account'], withdraw_amount_raw,
+            "withdraw-{}".format(withdrawal_id), work=work)
+        await aiodb.invalidate_balance(sender_account, connection)
+        aiocurrency.precache_work(sender_account, send_hash)
+        sent_ts = await set_status(withdrawal_id, withdrawals.SENT, send_hash=send_hash, connection=connection)
+        withdrawals.record_latency(withdrawal['created_ts'], sent_ts)
+
+    await aiocurrency.send_dm(withdrawal['user_id'], withdrawals.withdrawn_text(withdraw_amount_raw, send_hash))
+    logging.info("{}: Withdraw {} processed.  Hash: {}".format(datetime.datetime.utcnow(), withdrawal_id, send_hash))
+
+
+def stats():
+    return dict(withdrawals.stats(), backlog=pending.qsize() if pending is not None else 0)
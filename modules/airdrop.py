@@ -0,0 +1,264 @@
+import csv
+import datetime
+import logging
+import re
+import time
+from decimal import Decimal, InvalidOperation
+
+import eventlet
+import nano
+
+import modules.balances as balances
+import modules.clients as clients
+import modules.currency as currency
+import modules.db as db
+import modules.social as social
+import modules.users as users
+import modules.wallets as wallets
+from modules.conversion import BananoConversions
+
+# Payout states, stored in airdrop_payouts.status
+QUEUED = 'queued'
+SENT = 'sent'
+FAILED = 'failed'
+
+ACCOUNT_PATTERN = re.compile(r'^(ban|xrb|nano)_[13][13456789abcdefghijkmnopqrstuwxyz]{59}$')
+
+# Rows inserted and user ids looked up per query
+CHUNK_SIZE = 1000
+
+# Recipient accounts checked with the node at once
+VALIDATE_CONCURRENCY = 8
+
+# Problems listed by the validation; the rest are only counted
+MAX_ERRORS = 100
+
+# Failed sends in a row after which the run stops: the source account or the node is at fault, not the rows
+MAX_CONSECUTIVE_FAILURES = 10
+
+# Seconds between progress reports
+REPORT_INTERVAL = 10
+
+# Concurrent DMs to recipients given by Telegram user id
+NOTIFY_CONCURRENCY = 8
+
+
+def received_text(amount_raw, name):
+    return ("You just received {} BANANO from the {} airdrop!  Reply to this DM with .balance to see your new "
+            "balance.".format(BananoConversions.raw_to_banano(amount_raw), name))
+
+
+def read_rows(path):
+    """
+    Stream (line number, recipient, amount, name) from the CSV.  Blank lines, # comments and a header are skipped.
+    """
+    with open(path, newline='') as rows:
+        for line, row in enumerate(csv.reader(rows), 1):
+            cells = [cell.strip() for cell in row]
+            if not cells or not cells[0] or cells[0].startswith('#'):
+                continue
+            if line == 1 and not cells[0].isdigit() and not ACCOUNT_PATTERN.match(cells[0]):
+                continue
+            yield line, cells[0], cells[1] if len(cells) > 1 else '', cells[2] if len(cells) > 2 else ''
+
+
+def parse_amount(amount):
+    """
+    Raw amount of a BAN amount, or None when it is not a positive amount the bot can send
+    """
+    try:
+        amount_raw = BananoConversions.banano_to_raw(Decimal(amount))
+    except (InvalidOperation, ValueError):
+        return None
+    return amount_raw if amount_raw > 0 else None
+
+
+def validate(path):
+    """
+    First pass over the CSV, before anything is sent: every row must have a positive amount and a recipient that is
+    a valid account or a Telegram user id.  Returns the plan of the airdrop with the problems found.
+    """
+    plan = {'rows': 0, 'total_raw': 0, 'errors': [], 'error_count': 0, 'accounts': {}, 'new_users': {}}
+    user_ids = {}
+    accounts = set()
+
+    def problem(line, text):
+        plan['error_count'] += 1
+        if len(plan['errors']) < MAX_ERRORS:
+            plan['errors'].append("line {}: {}".format(line, text))
+
+    for line, recipient, amount, name in read_rows(path):
+        amount_raw = parse_amount(amount)
+        if amount_raw is None:
+            problem(line, "amount '{}' is not a positive BANANO amount".format(amount))
+        elif recipient.isdigit():
+            user_ids.setdefault(int(recipient), name)
+        elif ACCOUNT_PATTERN.match(recipient):
+            accounts.add(recipient)
+        else:
+            problem(line, "'{}' is neither an account nor a Telegram user id".format(recipient))
+        if amount_raw is not None:
+            plan['rows'] += 1
+            plan['total_raw'] += amount_raw
+
+    # Users without an account get one before the first send, like the receivers of a tip
+    ids = list(user_ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        for user in db.User.select(db.User.user_id, db.User.account).where(
+                db.User.user_id << ids[start:start + CHUNK_SIZE]):
+            plan['accounts'][user.user_id] = user.account
+    plan['new_users'] = {user_id: name for user_id, name in user_ids.items() if user_id not in plan['accounts']}
+
+    pool = eventlet.GreenPool(VALIDATE_CONCURRENCY)
+    for account, valid in pool.imap(lambda account: (account, valid_account(account)), accounts):
+        if not valid:
+            problem('-', "account {} is not valid".format(account))
+    return plan
+
+
+def valid_account(account):
+    try:
+        return clients.rpc.validate_account_number(account) != 0
+    except nano.rpc.RPCException:
+        return False
+
+
+def check_funds(source, total_raw):
+    """
+    Receive what is pending on the source account and return its balance, or raise ValueError when it cannot
+    cover total_raw
+    """
+    currency.receive_pending_blocks(source)
+    balance = int(clients.rpc.account_balance(source)['balance'])
+    if balance < total_raw:
+        raise ValueError("{} has {} BANANO, the payouts need {}".format(
+            source, BananoConversions.raw_to_banano(balance), BananoConversions.raw_to_banano(total_raw)))
+    return balance
+
+
+def find(name):
+    return db.Airdrop.get_or_none(db.Airdrop.name == name)
+
+
+def load(name, path, source, plan):
+    """
+    Second pass over the validated CSV: store every payout as queued, so the sends can be resumed after a failure
+    """
+    for user_id, user_name in plan['new_users'].items():
+        account, wallet = wallets.create_account(user_id, work=True)
+        users.create_user(user_id, user_name or str(user_id), account, register=0, wallet=wallet)
+        plan['accounts'][user_id] = account
+
+    now = datetime.datetime.utcnow()
+    with db.database.atomic():
+        airdrop = db.Airdrop.create(name=name, source_account=source, rows=plan['rows'],
+                                    total_raw=plan['total_raw'], created_ts=now)
+        chunk = []
+        for line, recipient, amount, _ in read_rows(path):
+            user_id = int(recipient) if recipient.isdigit() else None
+            chunk.append({'airdrop': airdrop.id, 'line': line, 'user_id': user_id,
+                          'account': plan['accounts'][user_id] if user_id is not None else recipient,
+                          'amount_raw': parse_amount(amount), 'status': QUEUED, 'updated_ts': now})
+            if len(chunk) == CHUNK_SIZE:
+                db.AirdropPayout.insert_many(chunk).execute()
+                chunk = []
+        if chunk:
+            db.AirdropPayout.insert_many(chunk).execute()
+    return airdrop
+
+
+def requeue_failed(airdrop):
+    """
+    Queue the failed payouts of the airdrop again when it is resumed.  Their send ids are unchanged, so a payout
+    the node published before the error is not paid twice.  Returns the number of payouts requeued.
+    """
+    return db.AirdropPayout.update(status=QUEUED, error=None, updated_ts=datetime.datetime.utcnow()).where(
+        (db.AirdropPayout.airdrop == airdrop.id) & (db.AirdropPayout.status == FAILED)).execute()
+
+
+def generate_work(frontier_hash):
+    try:
+        return clients.rpc.work_generate(frontier_hash, use_peers=True)
+    except Exception as e:
+        logging.info("{}: ERROR GENERATING WORK: {}".format(datetime.datetime.utcnow(), e))
+        return ''
+
+
+def send(airdrop, payout, work):
+    """
+    Publish one payout.  The id makes a send repeated after a crash return the first block instead of paying twice.
+    Without work the node generates its own.
+    """
+    params = dict(source=airdrop.source_account, destination=payout.account, amount=int(payout.amount_raw),
+                  id="airdrop-{}-{}".format(airdrop.id, payout.line))
+    if work:
+        params['work'] = work
+    return wallets.call(airdrop.source_account, 'send', **params)
+
+
+def run(airdrop, notify, report):
+    """
+    Send the queued payouts of the airdrop in CSV order.  Work for the source account's next block is generated
+    while the previous send is recorded and reported.  report is called with the progress every REPORT_INTERVAL
+    seconds and once at the end; the final progress is returned.
+    """
+    queued = list(db.AirdropPayout.select().where(
+        (db.AirdropPayout.airdrop == airdrop.id) & (db.AirdropPayout.status == QUEUED)).order_by(
+        db.AirdropPayout.line))
+    progress = {'queued': len(queued), 'sent': 0, 'failed': 0, 'seconds': 0.0, 'sends_per_second': 0.0}
+    if not queued:
+        report(progress)
+        return progress
+    check_funds(airdrop.source_account, sum(int(payout.amount_raw) for payout in queued))
+
+    source = airdrop.source_account
+    frontier_hash = clients.rpc.accounts_frontiers([source])[source]
+    work = eventlet.spawn(generate_work, frontier_hash)
+    notifications = eventlet.GreenPool(NOTIFY_CONCURRENCY)
+    started = time.monotonic()
+    reported = started
+    consecutive_failures = 0
+    for payout in queued:
+        with db.account_lock(source):
+            try:
+                send_hash = send(airdrop, payout, work.wait())
+            except nano.rpc.RPCException:
+                # Work for a frontier that another send moved on is rejected: let the node generate it
+                try:
+                    send_hash = send(airdrop, payout, '')
+                except nano.rpc.RPCException as e:
+                    set_status(payout, FAILED, error=str(e)[:255])
+                    progress['failed'] += 1
+                    consecutive_failures += 1
+                    if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                        raise
+                    work = eventlet.spawn(generate_work, clients.rpc.accounts_frontiers([source])[source])
+                    continue
+            work = eventlet.spawn(generate_work, send_hash)
+            set_status(payout, SENT, send_hash=send_hash)
+            if payout.user_id is not None:
+                # The bot processes caching the recipient's balance drop it when this commits
+                balances.invalidate(payout.account)
+        consecutive_failures = 0
+        progress['sent'] += 1
+        if notify and payout.user_id is not None:
+            notifications.spawn_n(social.send_dm, payout.user_id, received_text(payout.amount_raw, airdrop.name))
+
+        now = time.monotonic()
+        progress['seconds'] = now - started
+        progress['sends_per_second'] = progress['sent'] / progress['seconds'] if progress['seconds'] else 0.0
+        if now - reported >= REPORT_INTERVAL:
+            report(progress)
+            reported = now
+
+    notifications.waitall()
+    report(progress)
+    return progress
+
+
+def set_status(payout, status, send_hash=None, error=None):
+    payout.status = status
+    payout.send_hash = send_hash
+    payout.error = error
+    payout.updated_ts = datetime.datetime.utcnow()
+    payout.save()
@@ -0,0 +1,154 @@
+import datetime
+import logging
+import select
+import time
+
+import eventlet
+import psycopg2
+import psycopg2.extensions
+
+import modules.batching as batching
+import modules.clients as clients
+import modules.db as db
+import modules.users as users
+
+# Safety net for changes no process announces, e.g. deposits while node callbacks are off, or while this process
+# was not listening
+BALANCE_TTL = 60
+
+# Postgres channel announcing every account whose balance or pending amount changed, to every process caching it
+CHANNEL = 'balances'
+NOTIFY_SQL = "SELECT pg_notify('balances', %s)"
+
+# Seconds the listener waits for notifications between checks of its connection, and before reconnecting
+LISTEN_TIMEOUT = 5
+RECONNECT_DELAY = 5
+
+# account -> ({'balance': raw, 'pending': raw}, expires)
+cache = {}
+
+# account -> number of invalidations, so a lookup racing an invalidation does not store a stale balance
+versions = {}
+
+state = {'listening': False}
+
+counters = {'hits': 0, 'misses': 0, 'invalidations': 0, 'notifications': 0}
+
+
+def cached_balance(account):
+    """
+    Return the cached balance of the account, or None when there is no valid entry
+    """
+    entry = cache.get(account)
+    if entry is None or entry[1] <= time.monotonic():
+        return None
+    counters['hits'] += 1
+    return entry[0]
+
+
+def get_balance(account):
+    """
+    Same result as rpc.account_balance, answered from the cache while the entry is valid.  For display only: a
+    balance a spend is checked against comes from fresh_balance().
+    """
+    balance = cached_balance(account)
+    if balance is not None:
+        return balance
+    return fresh_balance(account)
+
+
+def fresh_balance(account):
+    """
+    Same result as rpc.account_balance, always read from the node; the cache is refreshed with it
+    """
+    version = miss(account)
+    balance = batching.account_balance(account)
+    store(account, version, balance)
+    return balance
+
+
+def miss(account):
+    """
+    Count a read of the account from the node.  Returns the version to pass to store() with its result.
+    """
+    counters['misses'] += 1
+    return versions.get(account, 0)
+
+
+def store(account, version, balance):
+    """
+    Cache a balance read from the node, unless the account was invalidated since version was taken
+    """
+    if versions.get(account, 0) == version:
+        cache[account] = (balance, time.monotonic() + BALANCE_TTL)
+
+
+def drop(account):
+    """
+    Forget the cached balance of the account in this process
+    """
+    counters['invalidations'] += 1
+    versions[account] = versions.get(account, 0) + 1
+    cache.pop(account, None)
+
+
+def invalidate(account):
+    """
+    Called by every code path that changes the account's balance or pending amount.  Every other process drops the
+    account too once the surrounding transaction, if any, commits.
+    """
+    drop(account)
+    db.database.execute_sql(NOTIFY_SQL, (account,))
+
+
+def heard(account):
+    """
+    Another process changed the account: drop it, and read it from the wallet node until read nodes caught up
+    """
+    counters['notifications'] += 1
+    drop(account)
+    if clients.rpc is not None:
+        clients.rpc.pin(account)
+
+
+def start_listener(settings):
+    eventlet.spawn(listen)
+
+
+def listen():
+    """
+    LISTEN on CHANNEL and users.CHANNEL over a connection of its own, outside the pool.  Notifications sent while it
+    was not listening are lost, so every (re)connect starts from empty balance and user caches.
+    """
+    while True:
+        connection = None
+        try:
+            connection = psycopg2.connect(dbname=db.database.database, **db.database.connect_params)
+            connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            connection.cursor().execute('LISTEN {}; LISTEN {}'.format(CHANNEL, users.CHANNEL))
+            cache.clear()
+            users.user_cache.clear()
+            state['listening'] = True
+            while True:
+                # Green once eventlet has monkey patched select
+                select.select([connection], [], [], LISTEN_TIMEOUT)
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    if notify.channel == users.CHANNEL:
+                        users.heard(notify.payload)
+                    else:
+                        heard(notify.payload)
+        except Exception as e:
+            logging.info("{}: Balance listener failed, reconnecting: {}".format(datetime.datetime.utcnow(), e))
+        finally:
+            state['listening'] = False
+            if connection is not None:
+                connection.close()
+        eventlet.sleep(RECONNECT_DELAY)
+
+
+def stats():
+    lookups = counters['hits'] + counters['misses']
+    return dict(counters, entries=len(cache), listening=state['listening'],
+                hit_rate=counters['hits'] / lookups if lookups else 0.0)
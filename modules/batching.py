@@ -0,0 +1,86 @@
+import eventlet
+from eventlet.event import Event
+
+import modules.clients as clients
+from modules.settings import get_settings
+
+# Largest number of accounts sent to the node in one call
+MAX_BATCH = 1000
+
+
+class BatchLoader():
+    """
+    Dataloader: keys requested within `window` seconds of each other are fetched with a single batch call.
+    batch_fn takes a list of keys and returns a dict of results keyed the same way.
+    """
+
+    def __init__(self, batch_fn):
+        self.batch_fn = batch_fn
+        self.waiting = {}
+        self.timer = None
+        self.counters = {'loads': 0, 'batches': 0, 'keys': 0}
+
+    def load(self, key):
+        self.counters['loads'] += 1
+        event = self.waiting.get(key)
+        if event is None:
+            event = Event()
+            self.waiting[key] = event
+            if len(self.waiting) >= MAX_BATCH:
+                self.flush()
+            elif self.timer is None:
+                self.timer = eventlet.spawn_after(get_settings().batch_window, self.flush)
+        return event.wait()
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch = self.waiting
+        self.waiting = {}
+        if len(batch) == 0:
+            return
+
+        self.counters['batches'] += 1
+        self.counters['keys'] += len(batch)
+        try:
+            results = self.batch_fn(list(batch))
+        except Exception as e:
+            for event in batch.values():
+                event.send_exception(e)
+            return
+        for key, event in batch.items():
+            if key in results:
+                event.send(results[key])
+            else:
+                event.send_exception(KeyError(key))
+
+    def stats(self):
+        batches = self.counters['batches']
+        return dict(self.counters, avg_batch=self.counters['keys'] / batches if batches else 0.0)
+
+
+balances = BatchLoader(lambda accounts: clients.rpc.accounts_balances(accounts))
+# Frontiers feed PoW for the next block, so they always come from the wallet node rather than a lagging read node
+frontiers = BatchLoader(lambda accounts: clients.rpc.wallet_node.accounts_frontiers(accounts))
+
+
+def account_balance(account):
+    """
+    Same result as rpc.account_balance, fetched through a batched accounts_balances call
+    """
+    return balances.load(account)
+
+
+def account_frontier(account):
+    """
+    Hash of the account's latest block, fetched through a batched accounts_frontiers call
+    """
+    return frontiers.load(account)
+
+
+def stats():
+    return {
+        'balances': balances.stats(),
+        'frontiers': frontiers.stats()
+    }
@@ -0,0 +1,16 @@
+import telegram
+
+from modules.nodepool import NodePool
+
+# Shared clients, built once by the app factory through init_clients()
+rpc = None
+telegram_bot = None
+
+
+def init_clients(settings):
+    """
+    Connect to the Nano nodes and Telegram and share the clients with every module
+    """
+    global rpc, telegram_bot
+    rpc = NodePool(settings)
+    telegram_bot = telegram.Bot(token=settings.telegram_key, base_url=settings.telegram_api + '/bot')
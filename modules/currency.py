@@ -1,70 +1,85 @@
-import configparser
-import json
 import logging
-import os
 import re
 import datetime
 
+import eventlet
 import nano
-import requests
 
+import modules.actors as actors
+import modules.balances as balances
+import modules.batching as batching
+import modules.clients as clients
+import modules.db as db
+import modules.deposits as deposits
+import modules.profiling as profiling
+import modules.social as social
+import modules.tips as tips
+import modules.users as users
+import modules.wallets as wallets
 from modules.conversion import BananoConversions
 
-# Read config and parse constants
-config = configparser.ConfigParser()
-config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
-logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
-# Constants
-WALLET = config.get('webhooks', 'wallet')
-NODE_IP = config.get('webhooks', 'node_ip')
-
-# Connect to Nano node
-rpc = nano.rpc.Client(NODE_IP)
+# account -> (frontier hash, work) precomputed in the background for the account's next block
+work_cache = {}
 
 
 def receive_pending(sender_account):
     """
-    Check to see if the account has any pending blocks and process them
+    Check to see if the account has any pending blocks and process them on the account's actor
+    """
+    with profiling.stage('receive_pending'):
+        return actors.run_for_account(sender_account, receive_pending_blocks, sender_account)
+
+
+def receive_pending_blocks(sender_account):
+    """
+    Receive every pending block of the account while holding its lock.  Returns the hashes of the received blocks.
     """
+    received = []
     try:
         logging.info("{}: in receive pending".format(datetime.datetime.utcnow()))
-        pending_blocks = rpc.pending(account='{}'.format(sender_account))
-        logging.info("pending blocks: {}".format(pending_blocks))
-        if len(pending_blocks) > 0:
-            for block in pending_blocks:
-                work = get_pow(sender_account)
-                if work == '':
-                    logging.info("{}: processing without pow".format(
-                        datetime.datetime.utcnow()))
-                    receive_data = {
-                        'action': "receive",
-                        'wallet': WALLET,
-                        'account': sender_account,
-                        'block': block
-                    }
-                else:
-                    logging.info("{}: processing with pow".format(
-                        datetime.datetime.utcnow()))
-                    receive_data = {
-                        'action': "receive",
-                        'wallet': WALLET,
-                        'account': sender_account,
-                        'block': block,
-                        'work': work
-                    }
-                receive_json = json.dumps(receive_data)
-                requests.post('{}'.format(NODE_IP), data=receive_json)
-                logging.info("{}: block {} received".format(
-                    datetime.datetime.utcnow(), block))
-
-        else:
-            logging.info('{}: No blocks to receive.'.format(datetime.datetime.utcnow()))
+        prepare_pow(sender_account)
+        with db.account_lock(sender_account):
+            pending_blocks = clients.rpc.pending(account='{}'.format(sender_account))
+            logging.info("pending blocks: {}".format(pending_blocks))
+            if len(pending_blocks) > 0:
+                for block in pending_blocks:
+                    with profiling.stage('get_pow'):
+                        work = get_pow(sender_account)
+                    try:
+                        if work == '':
+                            logging.info("{}: processing without pow".format(
+                                datetime.datetime.utcnow()))
+                            receive_hash = wallets.call(
+                                sender_account, 'receive',
+                                account=sender_account,
+                                block=block)
+                        else:
+                            logging.info("{}: processing with pow".format(
+                                datetime.datetime.utcnow()))
+                            receive_hash = wallets.call(
+                                sender_account, 'receive',
+                                account=sender_account,
+                                block=block,
+                                work=work)
+                    except nano.rpc.RPCException as e:
+                        logging.info("{}: block {} not received: {}".format(
+                            datetime.datetime.utcnow(), block, e))
+                        continue
+                    received.append(receive_hash)
+                    logging.info("{}: block {} received".format(
+                        datetime.datetime.utcnow(), block))
+                if received:
+                    balances.invalidate(sender_account)
+                precache_work(sender_account, received[-1] if received else None)
+
+            else:
+                logging.info('{}: No blocks to receive.'.format(datetime.datetime.utcnow()))
 
     except Exception as e:
         logging.info("Receive Pending Error: {}".format(e))
         raise e
 
-    return
+    return received
 
 
 def get_pow(sender_account):
@@ -73,60 +88,136 @@ def get_pow(sender_account):
     """
     logging.info("{}: in get_pow".format(datetime.datetime.utcnow()))
     try:
-        account_frontiers = rpc.accounts_frontiers([sender_account])
-        frontier_hash = account_frontiers[sender_account]
+        frontier_hash = batching.account_frontier(sender_account)
     except Exception as e:
         logging.info("{}: Error checking frontier: {}".format(
             datetime.datetime.utcnow(), e))
         return ''
-    logging.info("account_frontiers: {}".format(account_frontiers))
 
-    work = ''
     logging.info("{}: hash: {}".format(datetime.datetime.utcnow(), frontier_hash))
-    while work == '':
-        try:
-            work = rpc.work_generate(frontier_hash, use_peers=True)
-            logging.info("{}: Work generated: {}".format(datetime.datetime.utcnow(), work))
-        except Exception as e:
-            logging.info("{}: ERROR GENERATING WORK: {}".format(
-                datetime.datetime.utcnow(), e))
-            pass
+    cached = work_cache.pop(sender_account, None)
+    if cached is not None and cached[0] == frontier_hash:
+        logging.info("{}: Using precomputed work: {}".format(datetime.datetime.utcnow(), cached[1]))
+        return cached[1]
+    return generate_pow(sender_account, frontier_hash)
+
+
+def prepare_pow(account):
+    """
+    Generate work for the account's next block into the work_cache before the account's lock is taken, so the lock
+    is not held while work is generated.  get_pow() under the lock uses it if the frontier has not moved since.
+    """
+    try:
+        frontier_hash = batching.account_frontier(account)
+    except Exception as e:
+        logging.info("{}: Error checking frontier: {}".format(
+            datetime.datetime.utcnow(), e))
+        return
+    cached = work_cache.get(account)
+    if cached is not None and cached[0] == frontier_hash:
+        return
+    work = generate_pow(account, frontier_hash)
+    if work != '':
+        work_cache[account] = (frontier_hash, work)
+
+
+def generate_pow(sender_account, frontier_hash):
+    """
+    Work for the block following frontier_hash, from the shared work cache or the node.  '' lets the node generate
+    it while publishing the block.
+    """
+    work = shared_work(sender_account, frontier_hash)
+    if work is not None:
+        logging.info("{}: Using shared precomputed work: {}".format(datetime.datetime.utcnow(), work))
+        return work
+
+    # Retries are bounded by the RPC client; if they run out the node generates the work itself
+    try:
+        work = clients.rpc.work_generate(frontier_hash, use_peers=True)
+        logging.info("{}: Work generated: {}".format(datetime.datetime.utcnow(), work))
+    except Exception as e:
+        logging.info("{}: ERROR GENERATING WORK: {}".format(
+            datetime.datetime.utcnow(), e))
+        work = ''
 
     return work
 
 
+def precache_work(account, frontier_hash):
+    """
+    Generate work for the block following frontier_hash in the background, so the account's next block is ready
+    """
+    if frontier_hash is None:
+        return
+    eventlet.spawn_n(cache_work, account, frontier_hash)
+
+
+def cache_work(account, frontier_hash):
+    try:
+        work_cache[account] = (frontier_hash, clients.rpc.work_generate(frontier_hash, use_peers=True))
+    except Exception as e:
+        logging.info("{}: Could not precompute work for {}: {}".format(
+            datetime.datetime.utcnow(), account, e))
+
+
+def share_work(account, frontier_hash):
+    """
+    Generate work for the block following frontier_hash into the work_cache table, for whichever process makes
+    that block
+    """
+    try:
+        work = clients.rpc.work_generate(frontier_hash, use_peers=True)
+        with db.database.connection_context():
+            db.WorkCache.insert(account=account, frontier=frontier_hash, work=work,
+                                created_ts=datetime.datetime.utcnow()).on_conflict(
+                conflict_target=[db.WorkCache.account],
+                preserve=[db.WorkCache.frontier, db.WorkCache.work, db.WorkCache.created_ts]).execute()
+    except Exception as e:
+        logging.info("{}: Could not precompute shared work for {}: {}".format(
+            datetime.datetime.utcnow(), account, e))
+
+
+def shared_work(account, frontier_hash):
+    """
+    Take the work share_work() stored for frontier_hash, or None.  Runs in its own transaction or savepoint, so a
+    failure leaves a surrounding transaction usable.
+    """
+    try:
+        with db.database.atomic():
+            rows = list(db.WorkCache.delete().where(
+                (db.WorkCache.account == account) & (db.WorkCache.frontier == frontier_hash)).returning(
+                db.WorkCache.work).execute())
+    except Exception as e:
+        logging.info("{}: Could not read shared work for {}: {}".format(datetime.datetime.utcnow(), account, e))
+        return None
+    return rows[0].work if rows else None
+
+
 def send_tip(message, users_to_tip, tip_index):
-    import modules.db as db
-    import modules.social as social
     """
-    Process tip for specified user
+    Process tip for specified user.  Returns True once the send block is published.
     """
     logging.info("{}: sending tip to {}".format(
         datetime.datetime.utcnow(), users_to_tip[tip_index]['receiver_screen_name']))
     if str(users_to_tip[tip_index]['receiver_id']) == str(
             message['sender_id']):
-        self_tip_text = "Self tipping is not allowed.  Please use this bot to tip BANANO to other users!"
-        social.send_reply(message, self_tip_text)
+        social.send_reply(message, social.SELF_TIP_TEXT)
 
-        logging.info("{}: User tried to tip themself").format(datetime.datetime.utcnow())
-        return
+        logging.info("{}: User tried to tip themself".format(datetime.datetime.utcnow()))
+        return False
 
     # Check if the receiver has an account
     try:
-        user = db.User.select().where(db.User.user_id == int(users_to_tip[tip_index]['receiver_id'])).get()
+        user = users.get_user(users_to_tip[tip_index]['receiver_id'])
         users_to_tip[tip_index]['receiver_account'] = user.account
     except db.User.DoesNotExist:
         # If they don't, create an account for them
-        users_to_tip[tip_index]['receiver_account'] = rpc.account_create(
-            wallet="{}".format(WALLET), work=True)
-        user = db.User(
-            user_id = int(users_to_tip[tip_index]['receiver_id']),
-            user_name = users_to_tip[tip_index]['receiver_screen_name'],
-            account = users_to_tip[tip_index]['receiver_account'],
-            register=0,
-            created_ts=datetime.datetime.utcnow()
-        )
-        user.save(force_insert=True)
+        users_to_tip[tip_index]['receiver_account'], wallet = wallets.create_account(
+            users_to_tip[tip_index]['receiver_id'], work=True)
+        users.create_user(users_to_tip[tip_index]['receiver_id'], users_to_tip[tip_index]['receiver_screen_name'],
+                          users_to_tip[tip_index]['receiver_account'], register=0, wallet=wallet)
+        deposits.track_account(users_to_tip[tip_index]['receiver_account'],
+                               int(users_to_tip[tip_index]['receiver_id']))
         logging.info(
             "{}: Sender sent to a new receiving account.  Created  account {}".
             format(datetime.datetime.utcnow(),
@@ -134,64 +225,123 @@ def send_tip(message, users_to_tip, tip_index):
     # Send the tip
 
     message['tip_id'] = "{}{}".format(message['id'], tip_index)
+    with profiling.stage('db_insert'):
+        tip = tips.create_tip(message, users_to_tip, tip_index)
+    if tip is None:
+        # Recorded by an earlier delivery of the update, e.g. before the worker died or by a shard the router
+        # posted it to; the tip scheduler takes it from here
+        return False
+    users_to_tip[tip_index]['tip'] = tip.id
 
-    work = get_pow(message['sender_account'])
-    logging.info("Sending Tip:")
-    logging.info("From: {}".format(message['sender_account']))
-    logging.info("To: {}".format(users_to_tip[tip_index]['receiver_account']))
-    logging.info("amount: {:f}".format(message['tip_amount_raw']))
-    logging.info("id: {}".format(message['tip_id']))
-    logging.info("work: {}".format(work))
-    if work == '':
-        message['send_hash'] = rpc.send(
-            wallet="{}".format(WALLET),
-            source="{}".format(message['sender_account']),
-            destination="{}".format(
-                users_to_tip[tip_index]['receiver_account']),
-            amount="{}".format(int(message['tip_amount_raw'])),
-            id="tip-{}".format(message['tip_id']))
-    else:
-        message['send_hash'] = rpc.send(
-            wallet="{}".format(WALLET),
-            source="{}".format(message['sender_account']),
-            destination="{}".format(
-                users_to_tip[tip_index]['receiver_account']),
-            amount="{}".format(int(message['tip_amount_raw'])),
-            work=work,
-            id="tip-{}".format(message['tip_id']))
-    # Update the DB
-    db.set_db_data_tip(message, users_to_tip, tip_index)
-
-    # Get receiver's new balance
     try:
-        logging.info("{}: Checking to receive new tip")
-        receive_pending(users_to_tip[tip_index]['receiver_account'])
-        balance_return = rpc.account_balance(
-            account="{}".format(users_to_tip[tip_index]['receiver_account']))
-        users_to_tip[tip_index][
-            'balance'] = BananoConversions.raw_to_banano(balance_return['balance'])
-
-        # create a string to remove scientific notation from small decimal tips
-        if str(users_to_tip[tip_index]['balance'])[0] == ".":
-            users_to_tip[tip_index]['balance'] = "0{}".format(
-                str(users_to_tip[tip_index]['balance']))
-        else:
-            users_to_tip[tip_index]['balance'] = str(
-                users_to_tip[tip_index]['balance'])
-
-        # Send a DM to the receiver
-        receiver_tip_text = (
-            "@{0} just sent you a {1} BANANO tip! Reply to this DM with .balance to see your new balance.  If you have not "
-            "registered an account, send a reply with .register to get started, or .help to see a list of "
-            "commands! Learn more about BANANO at https://banano.cc"
-            .format(message['sender_screen_name'], message['tip_amount_text'])) 
-        social.send_dm(users_to_tip[tip_index]['receiver_id'],
-                       receiver_tip_text)
-    except Exception as e:
-        logging.info(
-            "{}: ERROR IN RECEIVING NEW TIP - POSSIBLE NEW ACCOUNT NOT REGISTERED WITH DPOW: {}"
-            .format(datetime.datetime.utcnow(), e))
+        message['send_hash'] = actors.run_for_account(message['sender_account'], send_tip_block, tip.id)
+    except tips.REFUSED:
+        # The node refused the send.  The sender hears that the tip failed and may tip again, so the scheduler must
+        # not send this one later.  Any other error leaves the tip for the scheduler, which sends it again with the
+        # same id and so never sends it twice.
+        tips.fail(tip.id)
+        raise
 
+    users_to_tip[tip_index]['send_hash'] = message['send_hash']
     logging.info("{}: tip sent to {} via hash {}".format(
         datetime.datetime.utcnow(), users_to_tip[tip_index]['receiver_screen_name'],
         message['send_hash']))
+    return True
+
+
+def notify_receiver(message, users_to_tip, tip_index):
+    """
+    Receive the tip into the receiver's account and let them know about it.  Safe to run concurrently for the
+    receivers of one multi-tip, so their balance lookups share a batch.  Steps that fail are retried by the tip
+    scheduler.
+    """
+    tip_id = users_to_tip[tip_index]['tip']
+    with db.database.connection_context():
+        try:
+            logging.info("{}: Checking to receive new tip")
+            receive_tip(tip_id, users_to_tip[tip_index]['receiver_account'])
+            balance_return = balances.get_balance(users_to_tip[tip_index]['receiver_account'])
+            users_to_tip[tip_index][
+                'balance'] = BananoConversions.raw_to_banano(balance_return['balance'])
+
+            # create a string to remove scientific notation from small decimal tips
+            if str(users_to_tip[tip_index]['balance'])[0] == ".":
+                users_to_tip[tip_index]['balance'] = "0{}".format(
+                    str(users_to_tip[tip_index]['balance']))
+            else:
+                users_to_tip[tip_index]['balance'] = str(
+                    users_to_tip[tip_index]['balance'])
+
+            notify_tip(tip_id, users_to_tip[tip_index]['receiver_id'], message['sender_screen_name'],
+                       message['tip_amount_text'])
+        except Exception as e:
+            logging.info(
+                "{}: ERROR IN RECEIVING NEW TIP - POSSIBLE NEW ACCOUNT NOT REGISTERED WITH DPOW: {}"
+                .format(datetime.datetime.utcnow(), e))
+            tips.record_failure(tip_id)
+
+
+def receive_tip(tip_id, receiver_account):
+    receive_pending(receiver_account)
+    tips.advance(tip_id, tips.RECEIVED)
+
+
+def notify_tip(tip_id, receiver_id, sender_screen_name, tip_amount_text):
+    """
+    DM the receiver about the tip.  Returns False if Telegram refused the message for good; the tip is then
+    UNNOTIFIED and the DM is not tried again.  Other Telegram errors are raised, so the scheduler retries the DM.
+    """
+    if not social.deliver_dm(receiver_id, social.tip_received_text(sender_screen_name, tip_amount_text)):
+        tips.advance(tip_id, tips.UNNOTIFIED)
+        return False
+    tips.advance(tip_id, tips.NOTIFIED)
+    return True
+
+
+def send_tip_block(tip_id):
+    """
+    Generate work and publish the send block of a recorded tip while holding the sender's lock.  Returns the send
+    hash; a tip that was already sent is not sent again.
+    """
+    tip = db.Tip.get_by_id(tip_id)
+    sender_account = users.get_user(tip.sender_id).account
+    receiver_account = users.get_user(tip.receiver_id).account
+    with profiling.stage('get_pow'):
+        prepare_pow(sender_account)
+    with db.account_lock(sender_account):
+        # Re-read under the lock: the scheduler may be retrying this tip in another worker
+        tip = db.Tip.get_by_id(tip_id)
+        if tip.processed >= tips.SENT:
+            return tip.send_hash
+
+        with profiling.stage('get_pow'):
+            work = get_pow(sender_account)
+        tips.advance(tip_id, tips.WORK_READY)
+        logging.info("Sending Tip:")
+        logging.info("From: {}".format(sender_account))
+        logging.info("To: {}".format(receiver_account))
+        logging.info("amount: {:f}".format(tip.amount_raw))
+        logging.info("id: {}".format(tip.tx_id))
+        logging.info("work: {}".format(work))
+        with profiling.stage('rpc_send'):
+            if work == '':
+                send_hash = wallets.call(
+                    sender_account, 'send',
+                    source="{}".format(sender_account),
+                    destination="{}".format(receiver_account),
+                    amount="{}".format(int(tip.amount_raw)),
+                    id="tip-{}".format(tip.tx_id))
+            else:
+                send_hash = wallets.call(
+                    sender_account, 'send',
+                    source="{}".format(sender_account),
+                    destination="{}".format(receiver_account),
+                    amount="{}".format(int(tip.amount_raw)),
+                    work=work,
+                    id="tip-{}".format(tip.tx_id))
+        balances.invalidate(sender_account)
+        balances.invalidate(receiver_account)
+        precache_work(sender_account, send_hash)
+        # Update the DB
+        tips.advance(tip_id, tips.SENT, send_hash=send_hash)
+    return send_hash
@@ -1,22 +1,174 @@
-import configparser
+import contextlib
+import hashlib
+import itertools
 import logging
-import os
 import datetime
-from peewee import IntegerField, CharField, BigIntegerField, ForeignKeyField, DateTimeField, Model
+import threading
+import time
+
+import eventlet
+from peewee import (IntegerField, CharField, BigIntegerField, BooleanField, DecimalField, DoubleField, ForeignKeyField,
+                    DateTimeField, Model, InterfaceError, OperationalError, SelectBase, fn)
+from playhouse.migrate import PostgresqlMigrator, migrate
 from playhouse.pool  import PooledPostgresqlDatabase
 
-# Read config and parse constants
-config = configparser.ConfigParser()
-config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
-logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
-# DB connection settings
-DB_HOST = config.get('webhooks', 'host')
-DB_USER = config.get('webhooks', 'user')
-DB_PW = config.get('webhooks', 'password')
-DB_SCHEMA = config.get('webhooks', 'schema')
-DB_PORT = int(config.get('webhooks', 'port'))
+from modules.settings import get_settings
+
+# Replication lag of a replica, 0 when it has replayed everything it received (or is not a standby at all)
+LAG_SQL = ("SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+           "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END")
+
+
+class PrimaryDatabase(PooledPostgresqlDatabase):
+    """
+    The primary.  A write pins the green thread's reads to it until its connection goes back to the pool at the
+    end of the request (or connection_context), so they see what it wrote.
+    """
+
+    def execute(self, query, **context_options):
+        if not isinstance(query, SelectBase):
+            pinned.primary = True
+        return super(PrimaryDatabase, self).execute(query, **context_options)
+
+    def close(self):
+        closed = super(PrimaryDatabase, self).close()
+        pinned.primary = False
+        return closed
+
+
+class Replica():
+    """
+    A read-only standby with its own connection pool and health, probed in the background
+    """
+
+    def __init__(self, host, port, settings):
+        self.host = '{}:{}'.format(host, port)
+        self.database = PooledPostgresqlDatabase(settings.db_schema, user=settings.db_user, password=settings.db_pw,
+                                                 host=host, port=port, max_connections=settings.db_connections)
+        self.healthy = True
+        self.lag = 0.0
+        self.counters = {'reads': 0, 'failures': 0}
+
+    def stats(self):
+        return dict(self.counters, host=self.host, healthy=self.healthy, lag=self.lag)
+
+
+# Connection settings are supplied by init_db() from the app factory
+database = PrimaryDatabase(None)
+
+# Read-only replicas from replica_hosts, read round-robin while healthy
+replicas = []
+next_replica = itertools.count()
+
+# Read-after-write flag of the current connection, green thread local once eventlet has monkey patched threading
+pinned = threading.local()
+
+# Keys (see wrote()) written by this process recently enough that a replica may not have them yet -> expiry
+recent_writes = {}
+
+counters = {'primary_reads': 0, 'pinned_reads': 0, 'replica_failovers': 0}
+
+def init_db(settings):
+    database.init(settings.db_schema, user=settings.db_user, password=settings.db_pw, host=settings.db_host,
+                  port=settings.db_port, max_connections=settings.db_connections)
+    replicas[:] = [Replica(*split_host(host, settings.db_port), settings) for host in settings.replica_hosts]
+
+def split_host(host, default_port):
+    if ':' in host:
+        host, port = host.rsplit(':', 1)
+        return host, int(port)
+    return host, default_port
 
-database = PooledPostgresqlDatabase(DB_SCHEMA, user=DB_USER, password=DB_PW, host=DB_HOST, port=DB_PORT, max_connections=20)
+def start_replica_probes(settings):
+    if replicas:
+        eventlet.spawn(probe_loop, settings)
+
+def probe_loop(settings):
+    while True:
+        for replica in replicas:
+            probe(replica, settings.replica_max_lag)
+        now = time.monotonic()
+        for key in [key for key, expires in recent_writes.items() if expires <= now]:
+            recent_writes.pop(key, None)
+        eventlet.sleep(settings.replica_probe_interval)
+
+def probe(replica, max_lag):
+    """
+    A replica is healthy while it answers and lags the primary by at most max_lag seconds
+    """
+    try:
+        with replica.database.connection_context():
+            replica.lag = float(replica.database.execute_sql(LAG_SQL).fetchone()[0])
+        healthy = replica.lag <= max_lag
+    except Exception as e:
+        logging.info("{}: replica {} failed its health probe: {}".format(datetime.datetime.utcnow(), replica.host, e))
+        healthy = False
+    if healthy != replica.healthy:
+        logging.info("{}: replica {} is {} (lag {:.1f}s)".format(
+            datetime.datetime.utcnow(), replica.host, 'healthy' if healthy else 'unhealthy', replica.lag))
+    replica.healthy = healthy
+
+def wrote(key):
+    """
+    Record a write that reads passing the same key must see.  They go to the primary until the replicas have had
+    replica_max_lag seconds to catch up.
+    """
+    if replicas:
+        recent_writes[key] = time.monotonic() + get_settings().replica_max_lag
+
+def recently_written(key):
+    expires = recent_writes.get(key)
+    if expires is None:
+        return False
+    if expires <= time.monotonic():
+        recent_writes.pop(key, None)
+        return False
+    return True
+
+def read_replicas(key):
+    """
+    Healthy replicas in round-robin order, or none when reads have to see this process's writes
+    """
+    if getattr(pinned, 'primary', False) or (key is not None and recently_written(key)):
+        counters['pinned_reads'] += 1
+        return []
+    healthy = [replica for replica in replicas if replica.healthy]
+    if not healthy:
+        return []
+    start = next(next_replica) % len(healthy)
+    return healthy[start:] + healthy[:start]
+
+def fetch(query, one):
+    return query.get() if one else list(query)
+
+def read(query, one=False, key=None):
+    """
+    Run a read-only select on a replica and return its rows, or its first row with one=True (raising DoesNotExist
+    like get()).  The primary answers when no replica is configured or healthy, when this connection has written, or
+    when key was written recently (see wrote()).  A row missing from a replica may just not have arrived yet, so
+    the primary gets the last word before DoesNotExist is raised.
+    """
+    for replica in read_replicas(key):
+        try:
+            with replica.database.connection_context():
+                rows = fetch(query.clone().bind(replica.database), one)
+            replica.counters['reads'] += 1
+            return rows
+        except query.model.DoesNotExist:
+            replica.counters['reads'] += 1
+            break
+        except (InterfaceError, OperationalError) as e:
+            replica.counters['failures'] += 1
+            replica.healthy = False
+            counters['replica_failovers'] += 1
+            logging.info("{}: read failed on replica {}, failing over: {}".format(
+                datetime.datetime.utcnow(), replica.host, e))
+    counters['primary_reads'] += 1
+    return fetch(query, one)
+
+def stats():
+    return {'replicas': [replica.stats() for replica in replicas], 'counters': dict(counters),
+            'recent_writes': len(recent_writes)}
 
 class BaseModel(Model):
     class Meta:
@@ -26,9 +178,10 @@ class BaseModel(Model):
 class User(BaseModel):
     user_id = IntegerField(primary_key=True)
     user_name = CharField()
-    account = CharField()
+    account = CharField(index=True)
     register = IntegerField()
     created_ts = DateTimeField()
+    wallet = CharField(null=True)
 
     class Meta:
         db_table = 'users'
@@ -46,40 +199,209 @@ class TelegramChatMember(BaseModel):
 class Tip(BaseModel):
     dm_id = IntegerField()
     tx_id = IntegerField()
-    processed = IntegerField()
+    # Lifecycle state, see modules/tips.py
+    processed = IntegerField(index=True)
     sender = ForeignKeyField(User, backref='tips_sent')
     receiver = ForeignKeyField(User, backref='tips_received')
     dm_text = CharField()
     amount = IntegerField()
     created_ts = DateTimeField()
+    amount_raw = DecimalField(max_digits=40, decimal_places=0, null=True)
+    send_hash = CharField(null=True)
+    attempts = IntegerField(default=0)
+    updated_ts = DateTimeField(null=True)
 
     class Meta:
         db_table = 'tip_list'
+        # One row per tip of an update, so an update delivered twice records its tips once
+        indexes = ((('dm_id', 'tx_id'), True),)
+
+class Withdrawal(BaseModel):
+    user = ForeignKeyField(User, backref='withdrawals')
+    sender_account = CharField()
+    receiver_account = CharField()
+    # Raw amount; NULL until the withdrawal is SENDING when the full balance was requested
+    amount_raw = DecimalField(max_digits=40, decimal_places=0, null=True)
+    status = CharField(index=True)
+    send_hash = CharField(null=True)
+    error = CharField(null=True)
+    created_ts = DateTimeField()
+    updated_ts = DateTimeField()
+
+    class Meta:
+        db_table = 'withdrawals'
+
+class ReconcileCheckpoint(BaseModel):
+    # Newest block of the account already matched against the DB, see modules/reconcile.py
+    account = CharField(primary_key=True)
+    head = CharField()
+    blocks = IntegerField(default=0)
+    updated_ts = DateTimeField()
+
+    class Meta:
+        db_table = 'reconcile_checkpoints'
+
+class Discrepancy(BaseModel):
+    account = CharField()
+    block_hash = CharField(index=True)
+    kind = CharField(index=True)
+    tip = IntegerField(null=True)
+    amount_raw = DecimalField(max_digits=40, decimal_places=0, null=True)
+    detail = CharField()
+    created_ts = DateTimeField()
+
+    class Meta:
+        db_table = 'reconcile_discrepancies'
+
+class Airdrop(BaseModel):
+    # One CSV of payouts sent by `flask airdrop`, see modules/airdrop.py
+    name = CharField(unique=True)
+    source_account = CharField()
+    rows = IntegerField()
+    total_raw = DecimalField(max_digits=40, decimal_places=0)
+    created_ts = DateTimeField()
+
+    class Meta:
+        db_table = 'airdrops'
+
+class AirdropPayout(BaseModel):
+    airdrop = ForeignKeyField(Airdrop, backref='payouts')
+    # CSV line, also part of the idempotent send id
+    line = IntegerField()
+    user_id = IntegerField(null=True)
+    account = CharField()
+    amount_raw = DecimalField(max_digits=40, decimal_places=0)
+    status = CharField(index=True)
+    send_hash = CharField(null=True)
+    error = CharField(null=True)
+    updated_ts = DateTimeField()
+
+    class Meta:
+        db_table = 'airdrop_payouts'
+        indexes = ((('airdrop', 'line'), True),)
+
+class ThrottleBucket(BaseModel):
+    # Token bucket shared by every process, see modules/throttle.py; updated is a unix timestamp
+    key = CharField(primary_key=True)
+    tokens = DoubleField()
+    rate = DoubleField()
+    capacity = IntegerField()
+    updated = DoubleField()
+    notified = BooleanField(default=False)
+
+    class Meta:
+        db_table = 'throttle_buckets'
+
+class WorkCache(BaseModel):
+    # Work for the block following frontier, precomputed by the warm-up for whichever process makes that block
+    account = CharField(primary_key=True)
+    frontier = CharField()
+    work = CharField()
+    created_ts = DateTimeField()
+
+    class Meta:
+        db_table = 'work_cache'
 
 def create_tables():
     with database.connection_context():
-        database.create_tables([User, Tip, TelegramChatMember], safe=True)
+        database.create_tables([User, Tip, TelegramChatMember, Withdrawal, ReconcileCheckpoint, Discrepancy, Airdrop,
+                                AirdropPayout, ThrottleBucket, WorkCache], safe=True)
+
+def migrate_tables():
+    """
+    Add the columns and indexes introduced after a table was first created
+    """
+    migrator = PostgresqlMigrator(database)
+    with database.connection_context():
+        columns = [column.name for column in database.get_columns(Tip._meta.table_name)]
+        operations = [migrator.add_column(Tip._meta.table_name, field.column_name, field)
+                      for field in (Tip.amount_raw, Tip.send_hash, Tip.attempts, Tip.updated_ts)
+                      if field.column_name not in columns]
+        indexes = [tuple(index.columns) for index in database.get_indexes(Tip._meta.table_name)]
+        if ('processed',) not in indexes:
+            operations.append(migrator.add_index(Tip._meta.table_name, ('processed',)))
+        if ('dm_id', 'tx_id') not in indexes:
+            duplicates = Tip.select(Tip.dm_id, Tip.tx_id).group_by(Tip.dm_id, Tip.tx_id).having(
+                fn.COUNT(Tip.id) > 1).count()
+            if duplicates:
+                logging.warning("{}: {} tips are recorded more than once; remove the extra rows and migrate again to "
+                                "make tip inserts idempotent".format(datetime.datetime.utcnow(), duplicates))
+            else:
+                operations.append(migrator.add_index(Tip._meta.table_name, ('dm_id', 'tx_id'), True))
+
+        if User.wallet.column_name not in [column.name for column in database.get_columns(User._meta.table_name)]:
+            operations.append(migrator.add_column(User._meta.table_name, User.wallet.column_name, User.wallet))
+        if ('account',) not in [tuple(index.columns) for index in database.get_indexes(User._meta.table_name)]:
+            operations.append(migrator.add_index(User._meta.table_name, ('account',)))
+        migrate(*operations)
+
+def account_lock_key(account):
+    """
+    Map an account address to the signed 64 bit key used for its advisory lock
+    """
+    digest = hashlib.blake2b(account.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+@contextlib.contextmanager
+def account_lock(account):
+    """
+    Serialize chain operations on an account across workers and hosts.  The advisory lock belongs to the session,
+    not to a transaction, so the state written while holding it commits right away and no transaction stays open
+    across node calls.  It is reentrant for the same connection, and like leader_lock() needs a connection_context
+    around it so the lock is released on the connection that took it.
+    """
+    key = account_lock_key(account)
+    database.execute_sql('SELECT pg_advisory_lock(%s)', (key,))
+    try:
+        yield
+    finally:
+        database.execute_sql('SELECT pg_advisory_unlock(%s)', (key,))
+
+@contextlib.contextmanager
+def leader_lock(name):
+    """
+    Yield True in the one process that holds the named session lock, False everywhere else.  Needs a
+    connection_context around it so the lock is released on the connection that took it.
+    """
+    key = account_lock_key(name)
+    acquired = database.execute_sql('SELECT pg_try_advisory_lock(%s)', (key,)).fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            database.execute_sql('SELECT pg_advisory_unlock(%s)', (key,))
+
+def tip_dm_text(message):
+    """
+    Message text stored with every tip
+    """
+    return ' '.join(message['text']).replace('!', '').replace('@', '')
 
-def set_db_data_tip(message, users_to_tip, t_index):
+def set_db_data_tip(message, users_to_tip, t_index, processed):
     """
-    Special case to update DB information to include tip data
+    Special case to update DB information to include tip data.  Returns the new tip, or None when an earlier
+    delivery of the same update recorded it already.
     """
     logging.info("{}: inserting tip into DB.".format(datetime.datetime.utcnow()))
     try:
-        sender = User.select().where(User.user_id == int(message['sender_id'])).get()
-        receiver = User.select().where(User.user_id == int(users_to_tip[t_index]['receiver_id'])).get()
-        message_text = ' '.join(message['text']).replace('!', '').replace(
-            '@', '')
+        # Both users were loaded earlier in the tip, so reference them by id instead of querying again
+        sender = int(message['sender_id'])
+        receiver = int(users_to_tip[t_index]['receiver_id'])
         tip = Tip(dm_id=message['id'],
                 tx_id=message['tip_id'],
-                processed=2,
+                processed=processed,
                 sender=sender,
                 receiver=receiver,
-                dm_text=message_text,
+                dm_text=tip_dm_text(message),
                 amount=int(message['tip_amount']),
-                created_ts=datetime.datetime.utcnow())
-        if tip.save(force_insert=True) == 0:
-            raise Exception("Couldn't insert tip {0}".format(message['id']))
+                amount_raw=int(message['tip_amount_raw']),
+                created_ts=datetime.datetime.utcnow(),
+                updated_ts=datetime.datetime.utcnow())
+        tip.id = Tip.insert(**tip.__data__).on_conflict_ignore().execute()
+        if tip.id is None:
+            logging.info("{}: tip {} already recorded".format(datetime.datetime.utcnow(), message['tip_id']))
+            return None
+        return tip
     except Exception as e:
         logging.info("{}: Exception in set_db_data_tip".format(datetime.datetime.utcnow()))
         logging.info("{}: {}".format(datetime.datetime.utcnow(), e))
@@ -0,0 +1,217 @@
+import datetime
+import json
+import logging
+
+import eventlet
+from eventlet.queue import LightQueue
+
+import modules.balances as balances
+import modules.clients as clients
+import modules.currency as currency
+import modules.db as db
+import modules.social as social
+from modules.conversion import BananoConversions
+from modules.settings import get_settings
+
+# account -> user_id for every account owned by the bot
+accounts = {}
+
+# Accounts airdrops are paid from; they live in the bot's wallets without belonging to a user
+sources = set()
+
+# Accounts waiting for a background receive, and the set used to avoid queueing an account twice
+receive_queue = LightQueue()
+queued = set()
+
+counters = {'callbacks': 0, 'matched': 0, 'internal': 0, 'receives': 0, 'blocks_received': 0}
+
+
+def callbacks_enabled():
+    return get_settings().callback_token != ''
+
+
+def start_receivers(settings):
+    """
+    Load the bot's accounts and spawn the green threads that receive pushed deposits
+    """
+    if not callbacks_enabled():
+        return
+    eventlet.spawn(load_accounts)
+    for _ in range(settings.deposit_receivers):
+        eventlet.spawn(receiver)
+
+
+def load_accounts():
+    try:
+        with db.database.connection_context():
+            for user in accounts_query().iterator():
+                accounts[user.account] = user.user_id
+            for airdrop in sources_query():
+                sources.add(airdrop.source_account)
+        logging.info("{}: Watching {} accounts for deposits".format(
+            datetime.datetime.utcnow(), len(accounts)))
+    except Exception as e:
+        logging.info("{}: Could not load accounts for deposits: {}".format(
+            datetime.datetime.utcnow(), e))
+
+
+def accounts_query():
+    return db.User.select(db.User.user_id, db.User.account)
+
+
+def sources_query():
+    return db.Airdrop.select(db.Airdrop.source_account)
+
+
+def track_account(account, user_id):
+    accounts[account] = user_id
+
+
+def callback_destination(payload):
+    """
+    Return the destination of a send block from a node callback, or None for any other block
+    """
+    block = payload.get('block', {})
+    if isinstance(block, str):
+        block = json.loads(block)
+    if block.get('type') == 'send':
+        return block.get('destination')
+    if block.get('type') == 'state' and str(payload.get('is_send', '')).lower() == 'true':
+        return block.get('link_as_account')
+    return None
+
+
+def callback_deposit(payload):
+    """
+    Return (destination, sender) of a node callback for a send to one of the bot's accounts, or (None, None) for
+    any other block.  Whether the sender is one of the bot's own accounts is for bot_managed() to tell.
+    """
+    counters['callbacks'] += 1
+    destination = callback_destination(payload)
+    if destination not in accounts:
+        return None, None
+    return destination, payload.get('account')
+
+
+def known_managed(account):
+    return account in accounts or account in sources
+
+
+def remember_managed(account, user_id, source):
+    """
+    Remember what a lookup of account found: the user owning it, or whether it is an airdrop source.  Returns
+    True when it is one of the bot's own accounts.
+    """
+    if user_id is not None:
+        accounts[account] = user_id
+        return True
+    if source:
+        sources.add(account)
+        return True
+    return False
+
+
+def bot_managed(account):
+    """
+    True when account is one of the bot's own: a user's account, possibly created in another worker since the
+    accounts were loaded, or an airdrop source
+    """
+    if known_managed(account):
+        return True
+    user = owner_query(account).first()
+    if user is not None:
+        return remember_managed(account, user.user_id, False)
+    return remember_managed(account, None, source_query(account).exists())
+
+
+def owner_query(account):
+    return db.User.select(db.User.user_id).where(db.User.account == account)
+
+
+def source_query(account):
+    return db.Airdrop.select(db.Airdrop.id).where(db.Airdrop.source_account == account)
+
+
+def count_deposit(internal):
+    """
+    Count a callback for a send to the bot.  Returns True when it is a deposit from outside the bot.
+    """
+    counters['internal' if internal else 'matched'] += 1
+    return not internal
+
+
+def handle_callback(payload):
+    """
+    Queue a receive when the node reports a deposit: a send to one of the bot's accounts from outside the bot.
+    Sends from the bot's own accounts (tips, withdrawals to another user, airdrops) are announced by the code that
+    sent them, and the receiving account picks them up with its next receive.
+    """
+    destination, sender = callback_deposit(payload)
+    if destination is None:
+        return
+    if not count_deposit(bool(sender) and bot_managed(sender)):
+        return
+    # The wallet node saw the block first; the receive must not miss it on a read node that has not yet
+    clients.rpc.pin(destination)
+    balances.invalidate(destination)
+    queue_receive(destination)
+
+
+def claim_receive(account):
+    """
+    True for the caller that should queue a receive of account, False while one is queued already
+    """
+    if account in queued:
+        return False
+    queued.add(account)
+    return True
+
+
+def queue_receive(account):
+    if claim_receive(account):
+        receive_queue.put(account)
+
+
+def receiver():
+    while True:
+        account = receive_queue.get()
+        try:
+            with db.database.connection_context():
+                receive_deposit(account)
+        except Exception as e:
+            logging.info("{}: Deposit receive for {} failed: {}".format(
+                datetime.datetime.utcnow(), account, e))
+        finally:
+            queued.discard(account)
+
+
+def receive_deposit(account):
+    user_id = deposit_owner(account, currency.receive_pending(account))
+    if user_id is None:
+        return
+    balance_return = balances.get_balance(account)
+    social.send_dm(user_id, deposit_text(balance_return))
+
+
+def deposit_owner(account, received):
+    """
+    Count a receive of the blocks received into account.  Returns the user to tell about the deposit, or None.
+    """
+    counters['receives'] += 1
+    if not received:
+        return None
+    counters['blocks_received'] += len(received)
+    return accounts.get(account)
+
+
+def deposit_text(balance_return):
+    return "Your deposit was received.  Your balance is now {} BAN.".format(
+        BananoConversions.raw_to_banano(balance_return['balance']))
+
+
+def stats():
+    return {
+        'accounts': len(accounts),
+        'backlog': receive_queue.qsize(),
+        'counters': dict(counters)
+    }
@@ -0,0 +1,320 @@
+import datetime
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import eventlet
+from eventlet import tpool
+from eventlet.event import Event
+from eventlet.queue import LightQueue
+
+from modules.settings import get_settings
+
+# Rewrite the journal with only the unfinished updates after this many updates have finished
+COMPACT_EVERY = 1000
+
+# Number of finished update ids remembered to drop redeliveries of the same update
+RECENT_SIZE = 10000
+
+# Seconds between looks for journals orphaned after start-up, e.g. by the old workers of a graceful reload that
+# still held their locks when this process started
+CLAIM_INTERVAL = 60
+
+# Lines waiting for the writer, with the Event to fire once they are on disk (None for fire and forget)
+writes = LightQueue()
+
+# update_id -> journal entries of every update this process has accepted but not finished
+inflight = {}
+recent = OrderedDict()
+
+# The update handled by the current green thread, its progress markers and whether it is being replayed
+current = threading.local()
+
+journal = {'path': None, 'file': None, 'finished': 0, 'replay': None}
+
+counters = {'accepted': 0, 'duplicates': 0, 'finished': 0, 'entries': 0, 'commits': 0, 'errors': 0,
+            'replayed': 0, 'compactions': 0}
+commit_time = {'total': 0.0, 'max': 0.0}
+
+
+def enabled():
+    return get_settings().journal_dir != ''
+
+
+def start_journal(settings, replay_update):
+    """
+    Open this process's journal, take over the journals of dead processes and replay their unfinished updates
+    through replay_update(update) in the background.  Journals orphaned later are taken over every CLAIM_INTERVAL
+    seconds.
+    """
+    if not enabled():
+        return
+    os.makedirs(settings.journal_dir, exist_ok=True)
+
+    # Lock the file before it gets a name other processes look for, so it is never mistaken for an orphan
+    temp_path = os.path.join(settings.journal_dir, 'journal-{}.tmp'.format(os.getpid()))
+    journal['file'] = lock_file(temp_path)
+    journal['path'] = '{}-{}.log'.format(temp_path[:-len('.tmp')], int(time.time() * 1000))
+    os.rename(temp_path, journal['path'])
+    journal['replay'] = replay_update
+
+    eventlet.spawn(writer)
+    claim(settings.journal_dir)
+    eventlet.spawn(claimer, settings.journal_dir)
+
+
+def claimer(journal_dir):
+    while True:
+        eventlet.sleep(CLAIM_INTERVAL)
+        try:
+            claim(journal_dir)
+        except Exception as e:
+            counters['errors'] += 1
+            logging.info("{}: Could not take over orphaned journals: {}".format(datetime.datetime.utcnow(), e))
+
+
+def claim(journal_dir):
+    unfinished = claim_orphans(journal_dir)
+    if unfinished:
+        eventlet.spawn(replay, unfinished, journal['replay'])
+
+
+def lock_file(path):
+    journal_file = open(path, 'ab')
+    fcntl.flock(journal_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return journal_file
+
+
+def encode(entry):
+    return (json.dumps(entry) + '\n').encode('utf-8')
+
+
+def sync(journal_file):
+    journal_file.flush()
+    # fsync blocks the whole process, so it runs on a native thread while other green threads keep going
+    tpool.execute(os.fsync, journal_file.fileno())
+
+
+def claim_orphans(journal_dir):
+    """
+    Read every journal no live process holds a lock on, copy its unfinished updates into this process's
+    journal and delete it.  Returns the unfinished updates as (update, progress markers) pairs.
+    """
+    updates = {}
+    claimed = []
+    for path in sorted(glob.glob(os.path.join(journal_dir, 'journal-*.log'))):
+        if path == journal['path']:
+            continue
+        try:
+            orphan = open(path, 'rb')
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(orphan, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Another process may have taken it over, or its owner compacted it, since it was opened
+            if os.stat(path).st_ino != os.fstat(orphan.fileno()).st_ino:
+                raise FileNotFoundError(path)
+        except (BlockingIOError, FileNotFoundError):
+            orphan.close()
+            continue
+        claimed.append((path, orphan))
+        for line in orphan:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A torn last line from the crash
+                continue
+            if entry['s'] == 'accepted':
+                updates[entry['u']] = [entry]
+            elif entry['s'] == 'done':
+                updates.pop(entry['u'], None)
+                remember(entry['u'])
+            elif entry['u'] in updates:
+                updates[entry['u']].append(entry)
+
+    # Redeliveries this process has already picked up itself
+    for update_id in [update_id for update_id in updates if update_id in inflight or update_id in recent]:
+        del updates[update_id]
+
+    # Copied through the writer and on disk before the orphans are deleted
+    entries = [entry for update_entries in updates.values() for entry in update_entries]
+    for update_id, update_entries in updates.items():
+        inflight[update_id] = update_entries
+    for index, entry in enumerate(entries):
+        append(entry, wait=index == len(entries) - 1)
+    for path, orphan in claimed:
+        os.remove(path)
+        orphan.close()
+    # Leftovers of compactions and start-ups cut short by a crash
+    for path in glob.glob(os.path.join(journal_dir, 'journal-*.compact')) + glob.glob(
+            os.path.join(journal_dir, 'journal-*.tmp')):
+        try:
+            with open(path, 'rb') as leftover:
+                fcntl.flock(leftover, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(path)
+        except (BlockingIOError, FileNotFoundError):
+            continue
+    if claimed:
+        logging.info("{}: Took over {} journals with {} unfinished updates".format(
+            datetime.datetime.utcnow(), len(claimed), len(updates)))
+
+    return [(entries[0]['d'], {entry['s'] for entry in entries[1:]}) for entries in updates.values()]
+
+
+def replay(unfinished, replay_update):
+    for update, stages in unfinished:
+        current.update_id = update['update_id']
+        current.stages = stages
+        current.replaying = True
+        counters['replayed'] += 1
+        try:
+            replay_update(update)
+        except Exception as e:
+            logging.info("{}: Replaying update {} failed: {}".format(
+                datetime.datetime.utcnow(), update['update_id'], e))
+        finally:
+            current.replaying = False
+            finish()
+
+
+def writer():
+    """
+    Group commit: everything queued while the previous fsync ran is written and synced together
+    """
+    while True:
+        batch = [writes.get()]
+        while writes.qsize() > 0:
+            batch.append(writes.get_nowait())
+
+        commit_start = time.monotonic()
+        try:
+            journal['file'].write(b''.join(line for line, _ in batch))
+            sync(journal['file'])
+        except Exception as e:
+            counters['errors'] += 1
+            logging.info("{}: Journal write failed: {}".format(datetime.datetime.utcnow(), e))
+        seconds = time.monotonic() - commit_start
+        counters['commits'] += 1
+        counters['entries'] += len(batch)
+        commit_time['total'] += seconds
+        commit_time['max'] = max(commit_time['max'], seconds)
+
+        # Waiters are released even after a failed write: a broken journal must not stop the bot
+        for _, done in batch:
+            if done is not None:
+                done.send()
+
+        if journal['finished'] >= COMPACT_EVERY:
+            compact()
+
+
+def compact():
+    """
+    Replace the journal with one holding only the entries of unfinished updates
+    """
+    journal['finished'] = 0
+    compact_path = journal['path'][:-len('.log')] + '.compact'
+    try:
+        compacted = lock_file(compact_path)
+        compacted.write(b''.join(encode(entry) for entries in list(inflight.values()) for entry in entries))
+        sync(compacted)
+        os.rename(compact_path, journal['path'])
+        directory = os.open(os.path.dirname(journal['path']) or '.', os.O_RDONLY)
+        try:
+            tpool.execute(os.fsync, directory)
+        finally:
+            os.close(directory)
+    except Exception as e:
+        counters['errors'] += 1
+        logging.info("{}: Journal compaction failed: {}".format(datetime.datetime.utcnow(), e))
+        return
+    journal['file'].close()
+    journal['file'] = compacted
+    counters['compactions'] += 1
+
+
+def append(entry, wait):
+    done = Event() if wait else None
+    writes.put((encode(entry), done))
+    if done is not None:
+        done.wait()
+
+
+def remember(update_id):
+    recent[update_id] = True
+    recent.move_to_end(update_id)
+    if len(recent) > RECENT_SIZE:
+        recent.popitem(last=False)
+
+
+def accept(update):
+    """
+    Journal an update before it is processed; returns once the entry is on disk.  Returns False for a
+    redelivery of an update this process is still working on or has just finished.
+    """
+    current.update_id = None
+    current.stages = set()
+    if not enabled() or not isinstance(update, dict) or 'update_id' not in update:
+        return True
+    if update['update_id'] in inflight or update['update_id'] in recent:
+        counters['duplicates'] += 1
+        return False
+    entry = {'u': update['update_id'], 's': 'accepted', 't': time.time(), 'd': update}
+    inflight[entry['u']] = [entry]
+    current.update_id = entry['u']
+    counters['accepted'] += 1
+    append(entry, wait=True)
+    return True
+
+
+def progress(stage):
+    """
+    Record that the current update got past a step that must not be repeated when it is replayed
+    """
+    update_id = getattr(current, 'update_id', None)
+    if update_id is None:
+        return
+    entry = {'u': update_id, 's': stage, 't': time.time()}
+    inflight[update_id].append(entry)
+    current.stages.add(stage)
+    append(entry, wait=True)
+
+
+def reached(stage):
+    return stage in getattr(current, 'stages', ())
+
+
+def replaying():
+    return getattr(current, 'replaying', False)
+
+
+def finish():
+    """
+    Mark the current update done.  Not waited for: losing it only means a finished update is replayed.
+    """
+    update_id = getattr(current, 'update_id', None)
+    if update_id is None:
+        return
+    current.update_id = None
+    inflight.pop(update_id, None)
+    remember(update_id)
+    counters['finished'] += 1
+    journal['finished'] += 1
+    append({'u': update_id, 's': 'done', 't': time.time()}, wait=False)
+
+
+def stats():
+    """
+    Unfinished updates, entries per group commit and commit latency
+    """
+    commits = counters['commits']
+    return dict(counters,
+                inflight=len(inflight),
+                entries_per_commit=counters['entries'] / commits if commits else 0.0,
+                avg_commit_ms=commit_time['total'] * 1000 / commits if commits else 0.0,
+                max_commit_ms=commit_time['max'] * 1000)
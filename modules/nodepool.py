@@ -0,0 +1,154 @@
+import datetime
+import logging
+import time
+
+import eventlet
+import nano
+import requests
+
+from modules.resilience import NodeBusyError, ResilientClient
+
+# Read-only actions that any synced node can answer.  Everything else, including wallet-bound calls such as
+# send, receive and account_create, stays pinned to the wallet node.
+READ_ACTIONS = {
+    'account_balance',
+    'accounts_balances',
+    'accounts_frontiers',
+    'account_history',
+    'account_info',
+    'blocks_info',
+    'pending',
+    'accounts_pending',
+    'validate_account_number'
+}
+
+# Wallet-bound actions that change accounts, and the params naming the accounts they change
+WRITE_ACCOUNTS = {
+    'send': ('source', 'destination'),
+    'receive': ('account',)
+}
+
+# Seconds reads of a written account stay on the wallet node, so a lagging read node cannot answer with the
+# balance or pending blocks from before the write
+WRITE_PIN = 30
+
+
+class NodeRouting():
+    """
+    Routing rules of the node pools of both engines: reads go to the fastest healthy node and fail over to the
+    next one, while wallet-bound calls always go to the wallet node (node_ip).  Reads of an account written in the
+    last WRITE_PIN seconds go to the wallet node as well.  The nodes are clients with NodePolicy's health and latency.
+    """
+
+    def __init__(self, wallet_node, read_nodes, settings):
+        self.wallet_node = wallet_node
+        self.nodes = [wallet_node] + read_nodes
+        self.probe_interval = settings.node_probe_interval
+        # account -> expiry of its pin to the wallet node
+        self.pinned = {}
+        self.counters = {'pinned_reads': 0}
+
+    def probed(self, node, error=None):
+        """
+        Record the outcome of a health probe of node: healthy unless it failed with error
+        """
+        if error is not None and node.healthy:
+            logging.info("{}: node {} failed its health probe: {}".format(
+                datetime.datetime.utcnow(), node.host, error))
+        node.healthy = error is None
+
+    def prune_pins(self):
+        now = time.monotonic()
+        for account in [account for account, expires in self.pinned.items() if expires <= now]:
+            self.pinned.pop(account, None)
+
+    def pin(self, account):
+        """
+        Send reads of account to the wallet node for the next WRITE_PIN seconds.  Writes through this pool pin
+        their accounts themselves; this is for changes heard about otherwise, e.g. a deposit callback.
+        """
+        if len(self.nodes) > 1:
+            self.pinned[account] = time.monotonic() + WRITE_PIN
+
+    def reads_pinned(self, params):
+        if not self.pinned or not params:
+            return False
+        accounts = params.get('accounts') or [params.get('account')]
+        now = time.monotonic()
+        return any(self.pinned.get(account, 0) > now for account in accounts)
+
+    def read_candidates(self):
+        """
+        Healthy nodes, fastest first.  Nodes without a latency sample yet are tried first so they get measured.
+        """
+        healthy = [node for node in self.nodes if node.healthy and node.breaker.state != 'open']
+        if len(healthy) == 0:
+            return [self.wallet_node]
+        return sorted(healthy, key=lambda node: node.ewma or 0.0)
+
+    def route(self, action, params):
+        """
+        The nodes to try for a call, in order: the wallet node alone for everything but reads of accounts that
+        were not just written, else read_candidates()
+        """
+        if action not in READ_ACTIONS:
+            for param in WRITE_ACCOUNTS.get(action, ()):
+                if params and params.get(param):
+                    self.pin(params[param])
+            return [self.wallet_node]
+        if self.reads_pinned(params):
+            self.counters['pinned_reads'] += 1
+            return [self.wallet_node]
+        return self.read_candidates()
+
+    def failed_over(self, action, node, error):
+        logging.info("{}: {} failed on node {}, failing over: {}".format(
+            datetime.datetime.utcnow(), action, node.host, error))
+
+    def stats(self):
+        return {'nodes': [node.stats() for node in self.nodes], 'pinned': len(self.pinned),
+                'counters': dict(self.counters)}
+
+
+class NodePool(NodeRouting, nano.rpc.Client):
+    """
+    NodeRouting over ResilientClients, for the eventlet engine
+    """
+
+    def __init__(self, settings):
+        nano.rpc.Client.__init__(self, settings.node_ip)
+        NodeRouting.__init__(self, ResilientClient(settings.node_ip, settings),
+                             [ResilientClient(host, settings) for host in settings.read_nodes
+                              if host != settings.node_ip], settings)
+
+    def start_probes(self):
+        """
+        Probe every node in the background, only worthwhile when there is more than one node to choose from
+        """
+        if len(self.nodes) > 1:
+            eventlet.spawn(self.probe_loop)
+
+    def probe_loop(self):
+        while True:
+            for node in self.nodes:
+                try:
+                    node.call('block_count')
+                    self.probed(node)
+                except Exception as e:
+                    self.probed(node, e)
+            self.prune_pins()
+            eventlet.sleep(self.probe_interval)
+
+    def call(self, action, params=None):
+        nodes = self.route(action, params)
+        if len(nodes) == 1:
+            return nodes[0].call(action, params)
+
+        error = None
+        for node in nodes:
+            try:
+                return node.call(action, dict(params or {}))
+            except (NodeBusyError, requests.exceptions.RequestException, ValueError) as e:
+                self.failed_over(action, node, e)
+                error = e
+        raise error
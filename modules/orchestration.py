@@ -1,226 +1,231 @@
-import configparser
 import logging
-import os
 import datetime
 from decimal import Decimal
 from http import HTTPStatus
 
-import nano
-
+import eventlet
+
+import modules.balances as balances
+import modules.currency as currency
+import modules.db as db
+import modules.deposits as deposits
+import modules.journal as journal
+import modules.profiling as profiling
+import modules.social as social
+import modules.throttle as throttle
+import modules.tracing as tracing
+import modules.users as users
+import modules.wallets as wallets
+import modules.withdrawals as withdrawals
 from modules.conversion import BananoConversions
+from modules.resilience import NodeBusyError
 
-# Read config and parse constants
-config = configparser.ConfigParser()
-config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
-logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
 # Set constants
 BULLET = u"\u2022"
-NODE_IP = config.get('webhooks', 'node_ip')
-WALLET = config.get('webhooks', 'wallet')
-MIN_TIP = config.get('webhooks', 'min_tip')
 
-# Connect to global functions
-rpc = nano.rpc.Client(NODE_IP)
+# DM command -> the command both engines dispatch it as
+DM_COMMANDS = {
+    '.help': 'help', '/help': 'help', '/start': 'help',
+    '.balance': 'balance', '/balance': 'balance',
+    '.register': 'register', '/register': 'register',
+    '.tip': 'tip', '/ban': 'tip',
+    '.withdrawals': 'withdrawals', '/withdrawals': 'withdrawals',
+    '.withdraw': 'withdraw', '/withdraw': 'withdraw',
+    '.account': 'account', '/account': 'account'
+}
+
+# Commands that cost DB, node or account work, and are therefore throttled
+EXPENSIVE_COMMANDS = {'balance', 'register', 'withdraw', 'withdrawals', 'account'}
+
+
+HELP_TEXT = (
+    "Thank you for using my services @BANANOTipBot!  Below is a list of commands, and a description of how you can interact with me:\n\n"
+    + BULLET +
+    " .help: The BANANOTipBot will respond to your DM with a list of commands and their functions. If you forget something, use this to get a hint of how to do it!n\n\n"
+    + BULLET +
+    " .register: Creates a fresh BANANO account address specifically for you.  This is used to store your tips. Make sure to withdraw to a private wallet such as Kalium or BananoVault, as the tip bot is not meant to be a long term storage device for BANANO.\n\n"
+    + BULLET +
+    " .balance: This shows you how much funds are in your your account.\n\n"
+    + BULLET +
+    " .tip: Tips are sent directly to @username on telegram.  Tag @BANANOTipBot and mention .tip <amount> <@username>.  EXAMPLE: .tip 1 @user will send a 1 BANANO tip to @user.\n\n"
+    + BULLET +
+    " .account: Returns the account number.  You can use this to deposit more BANANO to tip from your personal wallet.\n\n"
+    + BULLET +
+    " .withdraw: Proper usage is .withdraw ban_1meme1...  This will send the full balance of your tip account to another external BANANO account.  Optional: You can include an amount to withdraw by sending .withdraw <amount> <address>.  Example: .withdraw 1 ban_1meme1... would withdraw 1 BAN to account ban_1meme1...\n\n"
+    + BULLET +
+    " .withdrawals: Shows the status of your recent withdrawals, and the block hash of the ones that were sent.\n\n"
+)
+
+REDIRECT_TIP_TEXT = (
+    "Tips are processed through public messages now.  Please send this message in group chat in the format "
+    ".tip 1 @user1.")
+WRONG_FORMAT_TEXT = (
+    "The command or syntax you sent is not recognized.  Please send .help for a list of commands and what they do.")
+NO_BALANCE_ACCOUNT_TEXT = (
+    "There is no account linked to your username.  Please respond with .register to create an account.")
+REGISTERED_TEXT = "You have successfully registered for an account.  Your deposit address is:"
+ALREADY_REGISTERED_TEXT = "You already have registered your account.  Your deposit address is:"
+REGISTER_FAILED_TEXT = "Something went wrong - please try again later ot inform one of my masters"
+ACCOUNT_TEXT = "Your deposit address is:"
+ACCOUNT_CREATED_TEXT = "You didn't have an account set up, so I set one up for you.  Your deposit address is:"
+WITHDRAW_NO_ACCOUNT_TEXT = "You do not have an account.  Respond with .register to set one up."
+INVALID_WITHDRAW_AMOUNT_TEXT = (
+    "You did not send a number to withdraw.  Please resend with the format"
+    ".withdraw <account> or !withdraw <amount> <account>")
+INCORRECT_WITHDRAW_TEXT = (
+    "I didn't understand your withdraw request.  Please resend with .withdraw "
+    "<optional:amount> <account>.  Example, .withdraw 1 ban_1meme1... would "
+    "withdraw 1 BANANO to account ban_1meme1...  Also, .withdraw "
+    "ban_1meme1... would withdraw your entire balance to account "
+    "ban_1meme1...")
+
+
+def dm_command(message):
+    """
+    The command a DM asks for, see DM_COMMANDS, or None when the bot does not know it
+    """
+    return DM_COMMANDS.get(message['dm_action'])
 
 
 def parse_action(message):
-    import modules.social as social
-    if message['dm_action'] == '.help' or message[
-            'dm_action'] == '/help' or message['dm_action'] == '/start':
-        try:
-            help_process(message)
-        except Exception as e:
-            logging.info("Exception: {}".format(e))
-            raise e
-        finally:
-            return '', HTTPStatus.OK
-
-    elif message['dm_action'] == '.balance' or message[
-            'dm_action'] == '/balance':
-        try:
-            balance_process(message)
-        except Exception as e:
-            logging.info("Exception: {}".format(e))
-            raise e
-        finally:
-            return '', HTTPStatus.OK
-
-    elif message['dm_action'] == '.register' or message[
-            'dm_action'] == '/register':
-        try:
-            register_process(message)
-        except Exception as e:
-            logging.info("Exception: {}".format(e))
-            raise e
-        finally:
-            return '', HTTPStatus.OK
-
-    elif message['dm_action'] == '.tip' or message['dm_action'] == '/ban':
-        try:
-            redirect_tip_text = (
-                "Tips are processed through public messages now.  Please send this message in group chat in the format "
-                ".tip 1 @user1.")
-            social.send_dm(message['sender_id'], redirect_tip_text)
-        except Exception as e:
-            logging.info("Exception: {}".format(e))
-            raise e
-        finally:
-            return '', HTTPStatus.OK
-
-    elif message['dm_action'] == '.withdraw' or message[
-            'dm_action'] == '/withdraw':
-        try:
-            withdraw_process(message)
-        except Exception as e:
-            logging.info("Exception: {}".format(e))
-            raise e
-        finally:
-            return '', HTTPStatus.OK
-
-    elif message['dm_action'] == '.account' or message[
-            'dm_action'] == '/account':
-        try:
-            account_process(message)
-        except Exception as e:
-            logging.info("Exception: {}".format(e))
-            raise e
-        finally:
+    command = dm_command(message)
+    if command in EXPENSIVE_COMMANDS:
+        throttled_text = throttle.check(message['sender_id'])
+        if throttled_text is not None:
+            if throttled_text != '':
+                social.send_dm(message['sender_id'], throttled_text)
             return '', HTTPStatus.OK
 
-    else:
-        try:
-            wrong_format_text = (
-                "The command or syntax you sent is not recognized.  Please send .help for a list "
-                "of commands and what they do.")
-            social.send_dm(message['sender_id'], wrong_format_text)
-            logging.info('unrecognized syntax')
-        except Exception as e:
-            logging.info("Exception: {}".format(e))
-            raise e
-        finally:
-            return '', HTTPStatus.OK
+    processes = {
+        'help': help_process,
+        'balance': balance_process,
+        'register': register_process,
+        'tip': redirect_tip_process,
+        'withdrawals': withdrawals_process,
+        'withdraw': withdraw_process,
+        'account': account_process
+    }
+    try:
+        processes.get(command, wrong_format_process)(message)
+    except NodeBusyError:
+        social.send_dm(message['sender_id'], social.NODE_BUSY_TEXT)
+    except Exception as e:
+        logging.info("Exception: {}".format(e))
 
     return '', HTTPStatus.OK
 
 
 def help_process(message):
-    import modules.social as social
     """
     Reply to the sender with help commands
     """
-    help_message = (
-        "Thank you for using my services @BANANOTipBot!  Below is a list of commands, and a description of how you can interact with me:\n\n"
-        + BULLET +
-        " .help: The BANANOTipBot will respond to your DM with a list of commands and their functions. If you forget something, use this to get a hint of how to do it!n\n\n"
-        + BULLET +
-        " .register: Creates a fresh BANANO account address specifically for you.  This is used to store your tips. Make sure to withdraw to a private wallet such as Kalium or BananoVault, as the tip bot is not meant to be a long term storage device for BANANO.\n\n"
-        + BULLET +
-        " .balance: This shows you how much funds are in your your account.\n\n"
-        + BULLET +
-        " .tip: Tips are sent directly to @username on telegram.  Tag @BANANOTipBot and mention .tip <amount> <@username>.  EXAMPLE: .tip 1 @user will send a 1 BANANO tip to @user.\n\n"
-        + BULLET +
-        " .account: Returns the account number.  You can use this to deposit more BANANO to tip from your personal wallet.\n\n"
-        + BULLET +
-        " .withdraw: Proper usage is .withdraw ban_1meme1...  This will send the full balance of your tip account to another external BANANO account.  Optional: You can include an amount to withdraw by sending .withdraw <amount> <address>.  Example: .withdraw 1 ban_1meme1... would withdraw 1 BAN to account ban_1meme1...\n\n"
-    )
-    social.send_dm(message['sender_id'], help_message)
+    social.send_dm(message['sender_id'], HELP_TEXT)
     logging.info("{}: Help message sent!".format(datetime.datetime.utcnow()))
 
 
+def redirect_tip_process(message):
+    social.send_dm(message['sender_id'], REDIRECT_TIP_TEXT)
+
+
+def wrong_format_process(message):
+    social.send_dm(message['sender_id'], WRONG_FORMAT_TEXT)
+    logging.info('unrecognized syntax')
+
+
 def balance_process(message):
-    import modules.db as db
-    import modules.currency as currency
-    import modules.social as social
     """
     When the user sends a DM containing !balance, reply with the balance of the account linked with their Twitter ID
     """
     logging.info("{}: In balance process".format(datetime.datetime.utcnow()))
     try:
-        user = db.User.select().where(db.User.user_id == int(message['sender_id'])).get()
+        user = users.get_user(message['sender_id'])
         message['sender_account'] = user.account
         sender_register = user.register
 
         if sender_register == 0:
-            db.User.update(register=1).where(
-                (db.User.user_id == int(message['sender_id'])) &
-                (db.User.register == 0)).execute()
-
-        currency.receive_pending(message['sender_account'])
-        balance_return = rpc.account_balance(
-            account="{}".format(message['sender_account']))
+            users.mark_registered(message['sender_id'])
+
+        # A valid cache entry without pending funds answers a repeated .balance with no node work at all
+        balance_return = balances.cached_balance(message['sender_account'])
+        if balance_stale(balance_return):
+            if not deposits.callbacks_enabled():
+                currency.receive_pending(message['sender_account'])
+            balance_return = balances.get_balance(message['sender_account'])
         message['sender_balance_raw'] = balance_return['balance']
         message['sender_balance'] = BananoConversions.raw_to_banano(balance_return['balance'])
 
-        balance_text = "Your balance is {} BAN.".format(
-            message['sender_balance'])
-        social.send_dm(message['sender_id'], balance_text)
+        pending_queued = receiving_pending(balance_return)
+        if pending_queued:
+            # Deposits are received in the background when the node pushes its block callbacks
+            deposits.queue_receive(message['sender_account'])
+        social.send_dm(message['sender_id'], balance_text(balance_return, pending_queued))
         logging.info("{}: Balance Message Sent!".format(datetime.datetime.utcnow()))
     except db.User.DoesNotExist:
         logging.info(
             "{}: User tried to check balance without an account".format(
                 datetime.datetime.utcnow()))
-        balance_message = (
-            "There is no account linked to your username.  Please respond with .register to "
-            "create an account.")
-        social.send_dm(message['sender_id'], balance_message)
+        social.send_dm(message['sender_id'], NO_BALANCE_ACCOUNT_TEXT)
+
+def balance_stale(balance_return):
+    """
+    True when a cached balance cannot answer .balance on its own: there is none, or it has funds pending
+    """
+    return balance_return is None or balance_return['pending'] > 0
+
+
+def receiving_pending(balance_return):
+    """
+    True when the pending funds of a balance are left to the background deposit receivers
+    """
+    return balance_return['pending'] > 0 and deposits.callbacks_enabled()
+
+
+def balance_text(balance_return, pending_queued):
+    """
+    The .balance reply.  Pending funds are only mentioned when they are being received in the background.
+    """
+    text = "Your balance is {} BAN.".format(BananoConversions.raw_to_banano(balance_return['balance']))
+    if pending_queued:
+        text += "  {} BAN is pending and will be added shortly.".format(
+            BananoConversions.raw_to_banano(balance_return['pending']))
+    return text
+
+def register_text(user):
+    """
+    The reply to .register of a user who has an account already
+    """
+    if user.register == 0:
+        return REGISTERED_TEXT
+    return ALREADY_REGISTERED_TEXT
+
 
 def register_process(message):
-    import modules.db as db
-    import modules.social as social
     """
     When the user sends .register, create an account for them and mark it registered.  If they already have an account
     reply with their account number.
     """
     logging.info("{}: In register process.".format(datetime.datetime.utcnow()))
     try:
-        user = db.User.select().where(db.User.user_id == int(message['sender_id'])).get()
+        user = users.get_user(message['sender_id'])
+        # The user has an account: register it if they needed to, and let them know their account
         if user.register == 0:
-            # The user has an account, but needed to register, so send a message to the user with their account
-            sender_account = user.account
-            db.User.update(register=1).where(
-                (db.User.user_id == int(message['sender_id'])) &
-                (db.User.register == 0)).execute()
-
-            account_registration_text = "You have successfully registered for an account.  Your deposit address is:"
-            social.send_account_message(account_registration_text, message,
-                                        sender_account)
-
-            logging.info(
-                "{}: User has an account, but needed to register.  Message sent".
-                format(datetime.datetime.utcnow()))
-        else:
-            # The user had an account and already registered, so let them know their account.
-            sender_account = user.account
-            account_already_registered = "You already have registered your account.  Your deposit address is:"
-            social.send_account_message(account_already_registered, message,
-                                        sender_account)
-
-            logging.info(
-                "{}: User has a registered account.  Message sent.".format(
-                    datetime.datetime.utcnow()))
+            users.mark_registered(message['sender_id'])
+        social.send_account_message(register_text(user), message, user.account)
+
+        logging.info("{}: User has an account.  Message sent.".format(datetime.datetime.utcnow()))
     except db.User.DoesNotExist:
         # Create an account for the user
-        sender_account = rpc.account_create(
-            wallet="{}".format(WALLET), work=False)
-        user = db.User(
-            user_id = int(message['sender_id']),
-            user_name = message['sender_screen_name'],
-            account = sender_account,
-            register=1,
-            created_ts=datetime.datetime.utcnow()
-        )
-        if user.save(force_insert=True) > 0:
-            account_text = "You have successfully registered for an account.  Your deposit address is:"
-            social.send_account_message(account_text, message, sender_account)
+        sender_account, wallet = wallets.create_account(message['sender_id'], work=False)
+        if users.create_user(message['sender_id'], message['sender_screen_name'], sender_account, register=1,
+                             wallet=wallet) > 0:
+            deposits.track_account(sender_account, int(message['sender_id']))
+            social.send_account_message(REGISTERED_TEXT, message, sender_account)
         else:
-            account_text = "Something went wrong - please try again later ot inform one of my masters"
-            social.send_dm(message['sender_id'], account_text)
+            social.send_dm(message['sender_id'], REGISTER_FAILED_TEXT)
 
         logging.info("{}: Register successful!".format(datetime.datetime.utcnow()))
 
 def account_process(message):
-    import modules.db as db
-    import modules.social as social
     """
     If the user sends .account command, reply with their account.  If there is no account, create one, register it
     and reply to the user.
@@ -228,159 +233,131 @@ def account_process(message):
 
     logging.info("{}: In account process.".format(datetime.datetime.utcnow()))
     try:
-        user = db.User.select().where(db.User.user_id == int(message['sender_id'])).get()
+        user = users.get_user(message['sender_id'])
         sender_account = user.account
         sender_register = user.register
 
         if sender_register == 0:
-            db.User.update(register=1).where(
-                (db.User.user_id == int(message['sender_id'])) &
-                (db.User.register == 0)).execute()
+            users.mark_registered(message['sender_id'])
 
-        account_text = "Your deposit address is:"
-        social.send_account_message(account_text, message, sender_account)
+        social.send_account_message(ACCOUNT_TEXT, message, sender_account)
 
         logging.info("{}: Sent the user their account number.".format(
             datetime.datetime.utcnow()))
     except db.User.DoesNotExist:
-        sender_account = rpc.account_create(
-            wallet="{}".format(WALLET), work=True)
-        user = db.User(
-            user_id = int(message['sender_id']),
-            user_name = message['sender_screen_name'],
-            account = sender_account,
-            register=1,
-            created_ts=datetime.datetime.utcnow()
-        )
-        user.save(force_insert=True)
-        account_text = "You didn't have an account set up, so I set one up for you.  Your deposit address is:"
-        social.send_account_message(account_text, message, sender_account)
+        sender_account, wallet = wallets.create_account(message['sender_id'], work=True)
+        users.create_user(message['sender_id'], message['sender_screen_name'], sender_account, register=1,
+                          wallet=wallet)
+        deposits.track_account(sender_account, int(message['sender_id']))
+        social.send_account_message(ACCOUNT_CREATED_TEXT, message, sender_account)
 
         logging.info("{}: Created an account for the user!".format(
             datetime.datetime.utcnow()))
 
+def parse_withdraw(message):
+    """
+    Read .withdraw [amount] <account>.  Returns (receiver_account, amount_raw, error_text); amount_raw is None for
+    the full balance and error_text is None when the request is well formed.
+    """
+    if not 3 >= len(message['dm_array']) >= 2:
+        return None, None, INCORRECT_WITHDRAW_TEXT
+    if len(message['dm_array']) == 2:
+        return message['dm_array'][1].lower(), None, None
+    try:
+        withdraw_amount = Decimal(message['dm_array'][1])
+    except Exception as e:
+        logging.info("{}: withdraw no number ERROR: {}".format(
+            datetime.datetime.utcnow(), e))
+        return None, None, INVALID_WITHDRAW_AMOUNT_TEXT
+    return message['dm_array'][2].lower(), BananoConversions.banano_to_raw(withdraw_amount), None
+
+
+def withdraw_queued_text(withdrawal_id):
+    return ("Your withdraw request #{} is queued.  I'll send you the block hash as soon as it is sent.  "
+            "Send .withdrawals to check its status.".format(withdrawal_id))
+
+
 def withdraw_process(message):
-    import modules.db as db
-    import modules.currency as currency
-    import modules.social as social
     """
-    When the user sends !withdraw, send their entire balance to the provided account.  If there is no provided account
-    reply with an error.
+    When the user sends !withdraw, queue a send of their entire balance to the provided account.  If there is no
+    provided account reply with an error.  The executor DMs the hash once the withdrawal is sent.
     """
     logging.info('{}: in withdraw process.'.format(datetime.datetime.utcnow()))
     # check if there is a 2nd argument
     if 3 >= len(message['dm_array']) >= 2:
-        # if there is, retrieve the sender's account and wallet
+        # if there is, retrieve the sender's account
         try:
-            user = db.User.select().where(db.User.user_id == int(message['sender_id'])).get()
-            sender_account = user.account
-            currency.receive_pending(sender_account)
-            balance_return = rpc.account_balance(
-                account='{}'.format(sender_account))
-
-            if len(message['dm_array']) == 2:
-                receiver_account = message['dm_array'][1].lower()
-            else:
-                receiver_account = message['dm_array'][2].lower()
-
-            if rpc.validate_account_number(receiver_account) == 0:
-                invalid_account_text = (
-                    "The account address you provided is invalid.  Please double check and "
-                    "resend your request.")
-                social.send_dm(message['sender_id'], invalid_account_text)
-                logging.info(
-                    "{}: The BAN account address is invalid: {}".format(
-                        datetime.datetime.utcnow(), receiver_account))
-            elif balance_return['balance'] == 0:
-                no_balance_text = (
-                    "You have 0 balance in your account.  Please deposit to your address {} to "
-                    "send more tips!".format(sender_account))
-                social.send_dm(message['sender_id'], no_balance_text)
-                logging.info(
-                    "{}: The user tried to withdraw with 0 balance".format(
-                        datetime.datetime.utcnow()))
-            else:
-                if len(message['dm_array']) == 3:
-                    try:
-                        withdraw_amount = Decimal(message['dm_array'][1])
-                    except Exception as e:
-                        logging.info("{}: withdraw no number ERROR: {}".format(
-                            datetime.datetime.utcnow(), e))
-                        invalid_amount_text = (
-                            "You did not send a number to withdraw.  Please resend with the format"
-                            ".withdraw <account> or !withdraw <amount> <account>"
-                        )
-                        social.send_dm(message['sender_id'],
-                                       invalid_amount_text)
-                        return
-                    withdraw_amount_raw = BananoConversions.banano_to_raw(withdraw_amount)
-                    if Decimal(withdraw_amount_raw) > Decimal(
-                            balance_return['balance']):
-                        not_enough_balance_text = (
-                            "You do not have that much BAN in your account.  To withdraw your "
-                            "full amount, send .withdraw <account>")
-                        social.send_dm(message['sender_id'],
-                                       not_enough_balance_text)
-                        return
-                else:
-                    withdraw_amount_raw = balance_return['balance']
-                    withdraw_amount = BananoConversions.raw_to_banano(balance_return[
-                        'balance'])
-                # send the total balance to the provided account
-                work = currency.get_pow(sender_account)
-                if work == '':
-                    logging.info("{}: processed without work".format(
-                        datetime.datetime.utcnow()))
-                    send_hash = rpc.send(
-                        wallet="{}".format(WALLET),
-                        source="{}".format(sender_account),
-                        destination="{}".format(receiver_account),
-                        amount=withdraw_amount_raw)
-                else:
-                    logging.info("{}: processed with work: {}".format(
-                        datetime.datetime.utcnow(), work))
-                    send_hash = rpc.send(
-                        wallet="{}".format(WALLET),
-                        source="{}".format(sender_account),
-                        destination="{}".format(receiver_account),
-                        amount=withdraw_amount_raw,
-                        work=work)
-                logging.info("{}: send_hash = {}".format(
-                    datetime.datetime.utcnow(), send_hash))
-                # respond that the withdraw has been processed
-                withdraw_text = ("You have successfully withdrawn {} BANANO!".
-                                 format(withdraw_amount))
-                social.send_dm(message['sender_id'], withdraw_text)
-                logging.info("{}: Withdraw processed.  Hash: {}".format(
-                    datetime.datetime.utcnow(), send_hash))
+            user = users.get_user(message['sender_id'])
+
+            receiver_account, withdraw_amount_raw, error_text = parse_withdraw(message)
+            if error_text is not None:
+                social.send_dm(message['sender_id'], error_text)
+                return
+
+            # A replayed update must not queue the same withdrawal twice
+            if journal.reached('withdrawal_queued'):
+                return
+            withdrawal = withdrawals.queue_withdrawal(user, receiver_account, withdraw_amount_raw)
+            journal.progress('withdrawal_queued')
+            social.send_dm(message['sender_id'], withdraw_queued_text(withdrawal.id))
+            logging.info("{}: Withdraw {} queued.".format(
+                datetime.datetime.utcnow(), withdrawal.id))
         except db.User.DoesNotExist:
-            withdraw_no_account_text = "You do not have an account.  Respond with .register to set one up."
-            social.send_dm(message['sender_id'], withdraw_no_account_text)
+            social.send_dm(message['sender_id'], WITHDRAW_NO_ACCOUNT_TEXT)
             logging.info("{}: User tried to withdraw with no account".format(
                 datetime.datetime.utcnow()))
     else:
-        incorrect_withdraw_text = (
-            "I didn't understand your withdraw request.  Please resend with .withdraw "
-            "<optional:amount> <account>.  Example, .withdraw 1 ban_1meme1... would "
-            "withdraw 1 BANANO to account ban_1meme1...  Also, .withdraw "
-            "ban_1meme1... would withdraw your entire balance to account "
-            "ban_1meme1...")
-        social.send_dm(message['sender_id'], incorrect_withdraw_text)
+        social.send_dm(message['sender_id'], INCORRECT_WITHDRAW_TEXT)
         logging.info("{}: User sent a withdraw with invalid syntax.".format(
             datetime.datetime.utcnow()))
 
 
+def withdrawals_text(recent):
+    """
+    The .withdrawals reply for a list of withdrawal rows as dicts, newest first
+    """
+    lines = []
+    for withdrawal in recent:
+        if withdrawal['amount_raw'] is None:
+            amount_text = "full balance"
+        else:
+            amount_text = "{} BAN".format(BananoConversions.raw_to_banano(withdrawal['amount_raw']))
+        line = "{} #{}: {} to {} - {}".format(BULLET, withdrawal['id'], amount_text,
+                                            withdrawal['receiver_account'], withdrawal['status'])
+        if withdrawal['send_hash'] is not None:
+            line += " ({})".format(withdrawal['send_hash'])
+        lines.append(line)
+
+    if len(lines) == 0:
+        return "You have not made any withdrawals yet."
+    return "Your recent withdrawals:\n\n" + "\n".join(lines)
+
+
+def withdrawals_process(message):
+    """
+    Reply with the status of the sender's five most recent withdrawals
+    """
+    logging.info('{}: in withdrawals process.'.format(datetime.datetime.utcnow()))
+    recent = db.read(recent_withdrawals_query(int(message['sender_id'])).dicts(),
+                     key=('user', int(message['sender_id'])))
+    social.send_dm(message['sender_id'], withdrawals_text(recent))
+
+
+def recent_withdrawals_query(user_id):
+    return db.Withdrawal.select().where(db.Withdrawal.user == user_id).order_by(db.Withdrawal.id.desc()).limit(5)
+
+
 def tip_process(message, users_to_tip, request_json):
-    import modules.currency as currency
-    import modules.social as social
     """
     Main orchestration process to handle tips
     """
     logging.info("{}: in tip_process".format(datetime.datetime.utcnow()))
 
-    message, users_to_tip = social.set_tip_list(message, users_to_tip, request_json)
+    with profiling.stage('tip_list'):
+        message, users_to_tip = social.set_tip_list(message, users_to_tip, request_json)
 
-    message = social.validate_sender(message)
+    with profiling.stage('validate_sender'):
+        message = social.validate_sender(message)
     if message['sender_account'] is None or message['tip_amount'] <= 0:
         return
 
@@ -388,17 +365,20 @@ def tip_process(message, users_to_tip, request_json):
     if message['tip_amount'] <= 0:
         return
 
-    for t_index in range(0, len(users_to_tip)):
-        currency.send_tip(message, users_to_tip, t_index)
-
-    # Inform the user that all tips were sent.
-    if len(users_to_tip) >= 2:
-        multi_tip_success = (
-            "You have successfully sent your {} BAN tips.".format(
-                message['tip_amount_text']))
-        social.send_reply(message, multi_tip_success)
-
-    elif len(users_to_tip) == 1:
-        tip_success = ("You have successfully sent your {} BAN tip.".format(
-            message['tip_amount_text']))
-        social.send_reply(message, tip_success)
+    # Sends from one account are sequential, but receivers are notified concurrently
+    with profiling.stage('send'):
+        sent = [t_index for t_index in range(0, len(users_to_tip))
+                if currency.send_tip(message, users_to_tip, t_index)]
+    with profiling.stage('notify'):
+        pool = eventlet.GreenPool()
+        for t_index in sent:
+            pool.spawn_n(tracing.carry(currency.notify_receiver), message, users_to_tip, t_index)
+        pool.waitall()
+
+    # Inform the user that all tips were sent.  A replay that found every tip recorded already has nothing to say.
+    if not sent:
+        return
+    with profiling.stage('reply'):
+        tip_success_text = social.tip_success_text(message, len(users_to_tip))
+        if tip_success_text is not None:
+            social.send_reply(message, tip_success_text)
@@ -0,0 +1,220 @@
+import contextlib
+import cProfile
+import datetime
+import json
+import logging
+import os
+import pstats
+import queue
+import random
+import signal
+import threading
+import time
+
+import modules.tracing as tracing
+from modules.settings import get_settings
+
+# Modes switched on by SIGUSR2 when the config leaves both off
+DEFAULT_SAMPLE = 100
+DEFAULT_SLOW_MS = 1000
+
+# Profiles and slow requests waiting for the dumper; when it falls behind they are dropped
+QUEUE_SIZE = 100
+
+# Switched by the config at start-up and by SIGUSR2 at runtime.  Requests check 'enabled' and nothing else while
+# profiling is off.
+state = {'enabled': False, 'sample': 0, 'slow_ms': 0.0}
+
+# cProfile hooks the whole (OS) thread, so one request at a time holds the profiler.  Under eventlet its profile
+# also covers whatever other green threads ran while it waited.
+profiler_lock = threading.Lock()
+
+# The request being timed, green thread local once eventlet has monkey patched threading
+current = threading.local()
+
+dumps = queue.Queue(QUEUE_SIZE)
+
+counters = {'requests': 0, 'sampled': 0, 'slow': 0, 'profiler_busy': 0, 'files': 0, 'dropped': 0, 'errors': 0}
+
+NO_PROFILE = contextlib.nullcontext()
+
+
+class RequestProfile():
+    """
+    Times the stages of one request and, when it is sampled or could turn out slow, profiles it
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.stages = []
+        self.profiler = None
+        self.sampled = state['sample'] > 0 and random.randrange(state['sample']) == 0
+
+    def __enter__(self):
+        counters['requests'] += 1
+        if self.sampled or state['slow_ms'] > 0:
+            if profiler_lock.acquire(blocking=False):
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+            else:
+                counters['profiler_busy'] += 1
+        current.profile = self
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.monotonic() - self.started
+        current.profile = None
+        if self.profiler is not None:
+            self.profiler.disable()
+            profiler_lock.release()
+
+        if state['slow_ms'] > 0 and elapsed * 1000 >= state['slow_ms']:
+            counters['slow'] += 1
+            queue_dump(('slow', self.label, elapsed, self.stages, self.profiler))
+        elif self.sampled and self.profiler is not None:
+            counters['sampled'] += 1
+            queue_dump(('sample', self.profiler))
+        return False
+
+
+class Stage():
+    """
+    Times one stage for the profiled request and the update's trace, whichever of them are on
+    """
+
+    def __init__(self, profile, trace, name):
+        self.profile = profile
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.monotonic()
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.monotonic() - self.started
+        if self.profile is not None:
+            self.profile.stages.append((self.name, self.started - self.profile.started, seconds))
+        if self.trace is not None:
+            self.trace.add(self.name, self.started, seconds)
+        return False
+
+
+def request(label):
+    """
+    Context manager around a whole request.  Does nothing unless profiling is on.
+    """
+    if not state['enabled']:
+        return NO_PROFILE
+    return RequestProfile(label)
+
+
+def stage(name):
+    """
+    Context manager timing one stage of the current request, for the breakdown of slow requests and the trace
+    of the update
+    """
+    profile = getattr(current, 'profile', None)
+    trace = tracing.active()
+    if profile is None and trace is None:
+        return NO_PROFILE
+    return Stage(profile, trace, name)
+
+
+def queue_dump(item):
+    try:
+        dumps.put_nowait(item)
+    except queue.Full:
+        counters['dropped'] += 1
+
+
+def start_profiler(settings):
+    """
+    Turn profiling on if the config asks for it, let SIGUSR2 toggle it and start the thread writing the dumps
+    """
+    if settings.profile_sample > 0 or settings.profile_slow_ms > 0:
+        switch(True)
+    try:
+        signal.signal(signal.SIGUSR2, toggle)
+    except ValueError:
+        # Not the main thread: profiling can still be turned on by the config
+        logging.info("{}: SIGUSR2 profiling toggle not installed".format(datetime.datetime.utcnow()))
+    threading.Thread(target=dumper, daemon=True).start()
+
+
+def switch(enabled):
+    settings = get_settings()
+    sample, slow_ms = settings.profile_sample, settings.profile_slow_ms
+    if sample <= 0 and slow_ms <= 0:
+        sample, slow_ms = DEFAULT_SAMPLE, DEFAULT_SLOW_MS
+    state.update(enabled=enabled, sample=sample, slow_ms=slow_ms)
+    logging.info("{}: profiling {} (1 in {} requests sampled, slow above {}ms)".format(
+        datetime.datetime.utcnow(), 'on' if enabled else 'off', sample, slow_ms))
+
+
+def toggle(signum, frame):
+    switch(not state['enabled'])
+
+
+def dumper():
+    """
+    Write slow requests as they come and the aggregate of the sampled profiles every profile_interval seconds,
+    or as soon as profiling is switched off
+    """
+    settings = get_settings()
+    aggregate = None
+    while True:
+        try:
+            item = dumps.get(timeout=1)
+        except queue.Empty:
+            item = None
+        try:
+            if item is not None and item[0] == 'slow':
+                write_slow(*item[1:])
+            elif item is not None:
+                if aggregate is None:
+                    aggregate = pstats.Stats(item[1])
+                    started = time.monotonic()
+                else:
+                    aggregate.add(item[1])
+            if aggregate is not None and (not state['enabled'] or
+                                          time.monotonic() - started >= settings.profile_interval):
+                aggregate.dump_stats(dump_path('profile') + '.pstats')
+                counters['files'] += 1
+                aggregate = None
+        except Exception as e:
+            counters['errors'] += 1
+            logging.info("{}: Could not write profile: {}".format(datetime.datetime.utcnow(), e))
+
+
+def dump_path(kind):
+    settings = get_settings()
+    os.makedirs(settings.profile_dir, exist_ok=True)
+    name = '{}-{}-{}'.format(kind, datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'), os.getpid())
+    return os.path.join(settings.profile_dir, name)
+
+
+def write_slow(label, elapsed, stages, profiler):
+    """
+    A slow request's stage breakdown as JSON, next to its profile when the request held the profiler
+    """
+    path = dump_path('slow')
+    breakdown = {
+        'request': label,
+        'ms': round(elapsed * 1000, 3),
+        'stages': [{'stage': name, 'start_ms': round(start * 1000, 3), 'ms': round(seconds * 1000, 3)}
+                   for name, start, seconds in stages],
+        'profile': None
+    }
+    if profiler is not None:
+        pstats.Stats(profiler).dump_stats(path + '.pstats')
+        breakdown['profile'] = os.path.basename(path) + '.pstats'
+        counters['files'] += 1
+    with open(path + '.json', 'w') as dump:
+        json.dump(breakdown, dump, indent=2)
+    counters['files'] += 1
+
+
+def stats():
+    return dict(counters, enabled=state['enabled'], sample=state['sample'], slow_ms=state['slow_ms'],
+                backlog=dumps.qsize())
@@ -0,0 +1,222 @@
+import datetime
+import itertools
+import logging
+import time
+from decimal import Decimal
+
+import eventlet
+
+import modules.batching as batching
+import modules.clients as clients
+import modules.db as db
+import modules.tips as tips
+
+# Blocks asked for per account_history call
+PAGE_SIZE = 500
+
+# Discrepancy kinds, stored in reconcile_discrepancies.kind
+UNKNOWN_SEND = 'unknown_send'
+UNRECORDED_SEND = 'unrecorded_send'
+TIP_MISMATCH = 'tip_mismatch'
+FAILED_BUT_SENT = 'failed_but_sent'
+UNRECORDED_RECEIVE = 'unrecorded_receive'
+
+KINDS = (UNKNOWN_SEND, UNRECORDED_SEND, TIP_MISMATCH, FAILED_BUT_SENT, UNRECORDED_RECEIVE)
+
+
+def reconcile(concurrency, grace):
+    """
+    Match the blocks every user account published since its checkpoint against tip_list, withdrawals and airdrops,
+    write what the DB does not explain to reconcile_discrepancies and move the checkpoints forward.  Blocks younger
+    than grace seconds are left for the next run, so tips still being worked on are not reported.  Returns a summary.
+    """
+    started = time.monotonic()
+    summary = dict({kind: 0 for kind in KINDS}, accounts=0, changed=0, blocks=0, errors=0)
+    with db.database.connection_context():
+        accounts = {user.account: user.user_id for user in db.User.select(db.User.user_id, db.User.account)}
+        checkpoints = {checkpoint.account: checkpoint.head for checkpoint in db.ReconcileCheckpoint.select()}
+    summary['accounts'] = len(accounts)
+    users = {user_id: account for account, user_id in accounts.items()}
+
+    # One frontier lookup per batch of accounts finds the few that moved since their checkpoint
+    changed = []
+    account_list = list(accounts)
+    for start in range(0, len(account_list), batching.MAX_BATCH):
+        frontiers = clients.rpc.accounts_frontiers(account_list[start:start + batching.MAX_BATCH]) or {}
+        changed.extend(account for account, frontier in frontiers.items() if frontier != checkpoints.get(account))
+    summary['changed'] = len(changed)
+
+    cutoff = time.time() - grace
+    pool = eventlet.GreenPool(concurrency)
+    for account in changed:
+        pool.spawn_n(reconcile_account, account, checkpoints.get(account), accounts, users, cutoff, summary)
+    pool.waitall()
+    summary['seconds'] = round(time.monotonic() - started, 3)
+    return summary
+
+
+def baseline():
+    """
+    Move the checkpoint of every user account to its current frontier without checking the blocks before it, so the
+    first run on a bot with a long history only walks what is published afterwards.  Returns a summary.
+    """
+    started = time.monotonic()
+    with db.database.connection_context():
+        account_list = [user.account for user in db.User.select(db.User.account)]
+    summary = {'accounts': len(account_list), 'checkpoints': 0}
+    for start in range(0, len(account_list), batching.MAX_BATCH):
+        frontiers = clients.rpc.accounts_frontiers(account_list[start:start + batching.MAX_BATCH]) or {}
+        now = datetime.datetime.utcnow()
+        rows = [{'account': account, 'head': frontier, 'blocks': 0, 'updated_ts': now}
+                for account, frontier in frontiers.items()]
+        if not rows:
+            continue
+        with db.database.connection_context():
+            db.ReconcileCheckpoint.insert_many(rows).on_conflict(
+                conflict_target=[db.ReconcileCheckpoint.account],
+                preserve=[db.ReconcileCheckpoint.head, db.ReconcileCheckpoint.updated_ts]
+            ).execute()
+        summary['checkpoints'] += len(rows)
+    summary['seconds'] = round(time.monotonic() - started, 3)
+    return summary
+
+
+def reconcile_account(account, checkpoint, accounts, users, cutoff, summary):
+    try:
+        with db.database.connection_context():
+            blocks = list(itertools.takewhile(lambda block: settled(block, cutoff),
+                                              new_blocks(account, checkpoint)))
+            if not blocks:
+                return
+            found = match(account, accounts[account], blocks, accounts, users)
+            save(account, blocks, found)
+        summary['blocks'] += len(blocks)
+        for discrepancy in found:
+            summary[discrepancy['kind']] += 1
+    except Exception as e:
+        summary['errors'] += 1
+        logging.info("{}: Could not reconcile {}: {}".format(datetime.datetime.utcnow(), account, e))
+
+
+def new_blocks(account, checkpoint):
+    """
+    The account's blocks after checkpoint, oldest first, paging back from its frontier
+    """
+    blocks = []
+    head = None
+    while True:
+        params = {'account': account, 'count': PAGE_SIZE, 'raw': 'true'}
+        if head is not None:
+            params['head'] = head
+        page = clients.rpc.call('account_history', params)
+        history = page.get('history') or []
+        for block in history:
+            if block['hash'] == checkpoint:
+                return blocks[::-1]
+            blocks.append(block)
+        head = page.get('previous')
+        if not history or not head:
+            return blocks[::-1]
+
+
+def settled(block, cutoff):
+    # Blocks bootstrapped from other nodes have no local timestamp and are old enough anyway
+    return int(block.get('local_timestamp') or 0) <= cutoff
+
+
+def subtype(block):
+    return block.get('subtype') or block['type']
+
+
+def match(account, user_id, blocks, accounts, users):
+    """
+    Discrepancies between the account's blocks and the tips, withdrawals and airdrop payouts recorded for them
+    """
+    sends = [block for block in blocks if subtype(block) == 'send']
+    receives = [block for block in blocks if subtype(block) == 'receive']
+    sent_tips = tips_by_hash([block['hash'] for block in sends])
+    received_tips = tips_by_hash([block['link'] for block in receives if block.get('link')])
+    # Withdrawals and airdrop payouts are sends the bot made that are not tips
+    explained = set()
+    if sends:
+        hashes = [block['hash'] for block in sends]
+        explained = {withdrawal.send_hash for withdrawal in db.Withdrawal.select(db.Withdrawal.send_hash).where(
+            db.Withdrawal.send_hash << hashes)}
+        explained.update(payout.send_hash for payout in db.AirdropPayout.select(db.AirdropPayout.send_hash).where(
+            db.AirdropPayout.send_hash << hashes))
+
+    found = []
+    for block in sends:
+        tip = sent_tips.get(block['hash'])
+        if tip is None and (block['hash'] in explained or unrecorded_payout(account, block)):
+            continue
+        if tip is None:
+            tip = unrecorded_tip(user_id, block, accounts)
+            if tip is None:
+                found.append(discrepancy(account, block, UNKNOWN_SEND, None, "send to {}".format(block['account'])))
+            else:
+                found.append(discrepancy(account, block, UNRECORDED_SEND, tip.id,
+                                         "tip is {} without this send hash".format(tips.STATE_NAMES[tip.processed])))
+        elif int(tip.amount_raw or 0) != int(block['amount']) or users.get(tip.receiver_id) != block['account']:
+            found.append(discrepancy(account, block, TIP_MISMATCH, tip.id, "tip of {} to {}".format(
+                tip.amount_raw, users.get(tip.receiver_id))))
+        elif tip.processed == tips.FAILED:
+            found.append(discrepancy(account, block, FAILED_BUT_SENT, tip.id, "tip is failed"))
+
+    for block in receives:
+        tip = received_tips.get(block.get('link'))
+        if tip is not None and tip.processed in (tips.SENT, tips.FAILED):
+            found.append(discrepancy(account, block, UNRECORDED_RECEIVE, tip.id,
+                                     "tip is {}".format(tips.STATE_NAMES[tip.processed])))
+    return found
+
+
+def tips_by_hash(hashes):
+    if not hashes:
+        return {}
+    return {tip.send_hash: tip for tip in db.Tip.select().where(db.Tip.send_hash << hashes)}
+
+
+def unrecorded_tip(user_id, block, accounts):
+    """
+    A tip of this amount from user_id to the block's destination whose send hash was never stored, as left by a
+    worker that died between publishing the block and recording it
+    """
+    receiver_id = accounts.get(block['account'])
+    if receiver_id is None:
+        return None
+    return db.Tip.select().where(
+        (db.Tip.sender == user_id) & (db.Tip.receiver == receiver_id) & db.Tip.send_hash.is_null() &
+        (db.Tip.amount_raw == Decimal(block['amount']))).order_by(db.Tip.id).first()
+
+
+def unrecorded_payout(account, block):
+    """
+    Whether the block is an airdrop payout from account whose send hash was never stored.  Resuming the airdrop
+    sends it again with the same id, which returns this block and records it.
+    """
+    return db.AirdropPayout.select().join(db.Airdrop).where(
+        (db.Airdrop.source_account == account) & (db.AirdropPayout.account == block['account']) &
+        db.AirdropPayout.send_hash.is_null() & (db.AirdropPayout.amount_raw == Decimal(block['amount']))).exists()
+
+
+def discrepancy(account, block, kind, tip_id, detail):
+    return {'account': account, 'block_hash': block['hash'], 'kind': kind, 'tip': tip_id,
+            'amount_raw': Decimal(block['amount']), 'detail': detail[:255], 'created_ts': datetime.datetime.utcnow()}
+
+
+def save(account, blocks, found):
+    """
+    Write the discrepancies and the new checkpoint together, so an interrupted run neither loses nor repeats them
+    """
+    with db.database.atomic():
+        if found:
+            db.Discrepancy.insert_many(found).execute()
+        db.ReconcileCheckpoint.insert(
+            account=account, head=blocks[-1]['hash'], blocks=len(blocks), updated_ts=datetime.datetime.utcnow()
+        ).on_conflict(
+            conflict_target=[db.ReconcileCheckpoint.account],
+            update={db.ReconcileCheckpoint.head: blocks[-1]['hash'],
+                    db.ReconcileCheckpoint.blocks: db.ReconcileCheckpoint.blocks + len(blocks),
+                    db.ReconcileCheckpoint.updated_ts: datetime.datetime.utcnow()}
+        ).execute()
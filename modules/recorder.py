@@ -0,0 +1,162 @@
+import atexit
+import datetime
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+from modules.settings import get_settings
+
+# Updates waiting for the writer; when it falls this far behind further updates are dropped, never waited for
+QUEUE_SIZE = 10000
+
+# Pseudonymous ids stay positive 32 bit ints so they fit the user_id and member_id columns
+ID_RANGE = 2 ** 31 - 2
+
+MENTION = re.compile(r'@(\w+)')
+
+# Updates with their arrival time, read by the writer thread.  Both engines record through it: under eventlet
+# it is a green thread, under asyncio a native one.
+records = queue.Queue(QUEUE_SIZE)
+
+capture = {'file': None, 'path': None, 'opened': 0.0}
+capture_lock = threading.Lock()
+
+counters = {'recorded': 0, 'dropped': 0, 'files': 0, 'errors': 0}
+
+
+def enabled():
+    return get_settings().record_dir != ''
+
+
+def start_recorder(settings):
+    """
+    Start the thread that writes recorded updates to rotating gzip NDJSON files in record_dir
+    """
+    if not enabled():
+        return
+    os.makedirs(settings.record_dir, exist_ok=True)
+    threading.Thread(target=writer, daemon=True).start()
+    atexit.register(finish_capture)
+
+
+def record(update):
+    """
+    Queue a raw update for the capture.  Does nothing unless recording is enabled.
+    """
+    if not enabled() or update is None:
+        return
+    try:
+        records.put_nowait((time.time(), update))
+    except queue.Full:
+        counters['dropped'] += 1
+
+
+def writer():
+    while True:
+        try:
+            arrived, update = records.get(timeout=60)
+        except queue.Empty:
+            # Close an idle capture once it is due, so it is ready to be replayed
+            with capture_lock:
+                if capture['file'] is not None and expired(time.time()):
+                    close_capture()
+            continue
+        try:
+            line = json.dumps({'t': arrived, 'u': pseudonymise(update)}, separators=(',', ':')) + '\n'
+            with capture_lock:
+                rotate(arrived)
+                capture['file'].write(line.encode('utf-8'))
+            counters['recorded'] += 1
+        except Exception as e:
+            counters['errors'] += 1
+            logging.info("{}: Could not record update: {}".format(datetime.datetime.utcnow(), e))
+
+
+def rotate(now):
+    """
+    Start a new capture file when the current one is too old or too big.  Files are written under a .part name
+    and renamed once complete, so a replay never reads a file that is still growing.
+    """
+    settings = get_settings()
+    if capture['file'] is not None:
+        if not expired(now):
+            return
+        close_capture()
+
+    name = 'updates-{}-{}.ndjson.gz'.format(
+        datetime.datetime.utcfromtimestamp(now).strftime('%Y%m%dT%H%M%S'), os.getpid())
+    capture['path'] = os.path.join(settings.record_dir, name)
+    capture['file'] = gzip.open(capture['path'] + '.part', 'wb')
+    capture['opened'] = now
+    counters['files'] += 1
+
+
+def expired(now):
+    settings = get_settings()
+    return (now - capture['opened'] >= settings.record_rotate_minutes * 60 or
+            capture['file'].fileobj.tell() >= settings.record_rotate_mb * 1024 * 1024)
+
+
+def finish_capture():
+    with capture_lock:
+        close_capture()
+
+
+def close_capture():
+    if capture['file'] is None:
+        return
+    capture['file'].close()
+    os.rename(capture['path'] + '.part', capture['path'])
+    capture['file'] = None
+
+
+def record_key():
+    settings = get_settings()
+    return (settings.record_key or settings.telegram_key or '').encode('utf-8')
+
+
+def pseudonymous_id(user_id):
+    digest = hmac.new(record_key(), str(user_id).encode('utf-8'), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], 'big') % ID_RANGE + 1
+
+
+def pseudonymous_name(name):
+    # Usernames are matched case-insensitively, so every spelling of a name gets the same pseudonym
+    digest = hmac.new(record_key(), name.lower().encode('utf-8'), hashlib.sha256).hexdigest()
+    return 'user{}'.format(digest[:12])
+
+
+def pseudonymise(value):
+    """
+    Copy of an update with the ids and names of every user (and private chat) replaced by stable pseudonyms.
+    @mentions in texts get the same pseudonym as the username they point at, so recorded tips still resolve.
+    """
+    if isinstance(value, list):
+        return [pseudonymise(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+
+    copy = {key: pseudonymise(item) for key, item in value.items()}
+    if 'is_bot' in value or value.get('type') == 'private':
+        if 'id' in value:
+            copy['id'] = pseudonymous_id(value['id'])
+            if 'first_name' in value:
+                copy['first_name'] = 'user{}'.format(copy['id'])
+        if 'username' in value:
+            copy['username'] = pseudonymous_name(value['username'])
+        copy.pop('last_name', None)
+    for key in ('text', 'caption'):
+        if isinstance(value.get(key), str):
+            copy[key] = MENTION.sub(lambda match: '@' + pseudonymous_name(match.group(1)), value[key])
+    return copy
+
+
+def stats():
+    return dict(counters, backlog=records.qsize(), file=capture['path'])
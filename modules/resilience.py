@@ -0,0 +1,175 @@
+import datetime
+import logging
+import random
+import time
+
+import nano
+import requests
+
+# Node answers to these actions are retried even when the node replied with an error
+RETRY_ON_ERROR = {'work_generate'}
+
+# Actions that must never be repeated automatically: a second account_create makes a second account
+NO_RETRY = {'account_create'}
+
+# Seconds used as the base of the exponential, fully jittered retry backoff
+RETRY_BACKOFF = 0.25
+
+# Weight of the newest sample in the moving average of call latency
+EWMA_ALPHA = 0.3
+
+
+class NodeBusyError(Exception):
+    """
+    Raised instead of calling the node while its circuit breaker is open
+    """
+
+
+class CircuitBreaker():
+    """
+    Opens after `threshold` consecutive failures and fails fast for `cooldown` seconds.  After the cooldown a
+    single trial call is let through: success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.trips = 0
+        self.rejected = 0
+
+    def allow(self):
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = 'half_open'
+            self.trial_in_flight = False
+        if self.state == 'closed':
+            return True
+        if self.state == 'half_open' and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.threshold:
+            if self.state != 'open':
+                self.trips += 1
+                logging.info("{}: circuit breaker opened after {} failures".format(
+                    datetime.datetime.utcnow(), self.failures))
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'trips': self.trips,
+            'rejected': self.rejected
+        }
+
+
+class NodePolicy():
+    """
+    Per-node rules of the node clients of both engines: per-action timeouts, the retry budget, the circuit breaker,
+    call counters and the latency the node pool routes reads by
+    """
+
+    def __init__(self, host, settings):
+        self.host = host
+        self.rpc_timeout = settings.rpc_timeout
+        self.work_timeout = settings.work_timeout
+        self.retries = settings.rpc_retries
+        self.breaker = CircuitBreaker(settings.breaker_threshold, settings.breaker_cooldown)
+        self.counters = {}
+        # Health is updated by the node pool's probes; ewma is the smoothed latency of successful calls
+        self.healthy = True
+        self.ewma = None
+
+    def timeout(self, action):
+        if action == 'work_generate':
+            return self.work_timeout
+        return self.rpc_timeout
+
+    def retry_budget(self, action, params):
+        if action in NO_RETRY:
+            return 0
+        # A send is only idempotent when it carries an id
+        if action == 'send' and 'id' not in params:
+            return 0
+        return self.retries
+
+    def count(self, action, key):
+        counter = self.counters.setdefault(action, {'calls': 0, 'failures': 0, 'retries': 0})
+        counter[key] += 1
+
+    def observe(self, seconds):
+        if self.ewma is None:
+            self.ewma = seconds
+        else:
+            self.ewma = EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * self.ewma
+
+    def stats(self):
+        return {
+            'host': self.host,
+            'healthy': self.healthy,
+            'ewma_ms': round(self.ewma * 1000, 1) if self.ewma is not None else None,
+            'breaker': self.breaker.stats(),
+            'actions': self.counters
+        }
+
+
+class ResilientClient(NodePolicy, nano.rpc.Client):
+    """
+    Nano RPC client with per-action timeouts, jittered retries and a circuit breaker around every call
+    """
+
+    def __init__(self, host, settings):
+        nano.rpc.Client.__init__(self, host)
+        NodePolicy.__init__(self, host, settings)
+
+    def call(self, action, params=None):
+        params = params or {}
+        params['action'] = action
+        attempts = 1 + self.retry_budget(action, params)
+        error = None
+
+        for attempt in range(attempts):
+            if attempt > 0:
+                self.count(action, 'retries')
+                time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+            if not self.breaker.allow():
+                raise NodeBusyError("Node {} is busy, not calling {}".format(self.host, action))
+
+            self.count(action, 'calls')
+            call_start = time.monotonic()
+            try:
+                resp = self.session.post(self.host, json=params, timeout=self.timeout(action))
+                resp.raise_for_status()
+                result = resp.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                self.count(action, 'failures')
+                self.breaker.record_failure()
+                logging.info("{}: node call {} failed on attempt {}: {}".format(
+                    datetime.datetime.utcnow(), action, attempt + 1, e))
+                error = e
+                continue
+
+            self.breaker.record_success()
+            self.observe(time.monotonic() - call_start)
+            if 'error' not in result:
+                return result
+            error = nano.rpc.RPCException(result['error'])
+            if action not in RETRY_ON_ERROR:
+                raise error
+
+        raise error
@@ -0,0 +1,124 @@
+import configparser
+import functools
+import os
+
+
+class Settings():
+    """
+    Constants parsed from webhooks.ini.  Built once per process by get_settings().
+    """
+
+    def __init__(self, config):
+        self.config = config
+        section = config['webhooks']
+
+        # Telegram API
+        self.telegram_key = section.get('telegram_key')
+        self.bot_id_telegram = section.get('bot_id_telegram')
+        self.server_url = section.get('server_url', fallback='')
+        # Base URL of the Bot API, pointed at simulator.py for offline load tests
+        self.telegram_api = section.get('telegram_api', fallback='https://api.telegram.org').rstrip('/')
+
+        # Tip bot constants
+        self.min_tip = section.get('min_tip')
+        self.node_ip = section.get('node_ip')
+        self.wallet = section.get('wallet')
+        # Node wallets new accounts are spread over, comma separated; accounts without a stored wallet are in wallet
+        self.wallets = [wallet.strip() for wallet in section.get('wallets', fallback='').split(',')
+                        if wallet.strip()] or [self.wallet]
+
+        # Extra nodes that serve read-only RPC calls next to the wallet node, comma separated
+        self.read_nodes = [host.strip() for host in section.get('read_nodes', fallback='').split(',') if host.strip()]
+        self.node_probe_interval = section.getfloat('node_probe_interval', fallback=10)
+
+        # Node RPC resilience: timeouts in seconds, retries per call and circuit breaker limits
+        self.rpc_timeout = section.getfloat('rpc_timeout', fallback=10)
+        self.work_timeout = section.getfloat('work_timeout', fallback=30)
+        self.rpc_retries = section.getint('rpc_retries', fallback=2)
+        self.breaker_threshold = section.getint('breaker_threshold', fallback=5)
+        self.breaker_cooldown = section.getfloat('breaker_cooldown', fallback=30)
+
+        # Token buckets for expensive commands: tokens refilled per second and burst size, per sender and per chat
+        self.throttle_sender_rate = section.getfloat('throttle_sender_rate', fallback=0.2)
+        self.throttle_sender_burst = section.getint('throttle_sender_burst', fallback=5)
+        self.throttle_chat_rate = section.getfloat('throttle_chat_rate', fallback=1)
+        self.throttle_chat_burst = section.getint('throttle_chat_burst', fallback=20)
+        if self.throttle_sender_rate <= 0 or self.throttle_chat_rate <= 0:
+            raise ValueError("throttle_sender_rate and throttle_chat_rate must be greater than 0")
+
+        # Seconds to wait for more balance or frontier lookups to merge into one node call
+        self.batch_window = section.getfloat('batch_window', fallback=0.005)
+
+        # Number of withdrawals sent concurrently by the background executor
+        self.withdraw_concurrency = section.getint('withdraw_concurrency', fallback=4)
+
+        # Tip scheduler: seconds between passes, seconds before a stalled tip is retried and attempts per tip
+        self.tip_scheduler_interval = section.getfloat('tip_scheduler_interval', fallback=30)
+        self.tip_retry_after = section.getfloat('tip_retry_after', fallback=120)
+        self.tip_max_attempts = section.getint('tip_max_attempts', fallback=5)
+
+        # Start-up warm-up: seconds it may take (0 skips it) and days of activity whose users are preloaded
+        self.warmup_budget = section.getfloat('warmup_budget', fallback=30)
+        self.warmup_days = section.getint('warmup_days', fallback=7)
+
+        # Directory of the crash recovery journals of accepted updates; empty disables them
+        self.journal_dir = section.get('journal_dir', fallback='')
+
+        # Opt-in capture of raw updates for replays: directory (empty disables it), key of the HMAC pseudonyms of
+        # user ids and names (defaults to the bot token) and when to start a new file
+        self.record_dir = section.get('record_dir', fallback='')
+        self.record_key = section.get('record_key', fallback='')
+        self.record_rotate_mb = section.getfloat('record_rotate_mb', fallback=64)
+        self.record_rotate_minutes = section.getfloat('record_rotate_minutes', fallback=60)
+
+        # Profiling, also toggled at runtime with SIGUSR2: profile 1 in profile_sample requests (0 disables it),
+        # dump the stage timings and profile of requests slower than profile_slow_ms (0 disables it) and write the
+        # sampled profiles, aggregated over profile_interval seconds, to profile_dir
+        self.profile_sample = section.getint('profile_sample', fallback=0)
+        self.profile_slow_ms = section.getfloat('profile_slow_ms', fallback=0)
+        self.profile_interval = section.getfloat('profile_interval', fallback=300)
+        self.profile_dir = section.get('profile_dir', fallback='profiles')
+
+        # Stage timings of every update that is not answered by the triage fast path, as JSONL in trace_dir (empty
+        # disables them), starting a new file every trace_rotate_mb
+        self.trace_dir = section.get('trace_dir', fallback='')
+        self.trace_rotate_mb = section.getfloat('trace_rotate_mb', fallback=64)
+
+        # Chain reconciliation: accounts walked concurrently and seconds a block must age before it is checked
+        self.reconcile_concurrency = section.getint('reconcile_concurrency', fallback=8)
+        self.reconcile_grace = section.getfloat('reconcile_grace', fallback=3600)
+
+        # Sharded deployment: number of shard processes (`flask shard <index>`) the updates are spread over by chat,
+        # 0 to handle them in the worker that receives them, and the directory of the shards' Unix sockets
+        self.shards = section.getint('shards', fallback=0)
+        self.shard_socket_dir = section.get('shard_socket_dir', fallback='shards')
+
+        # Node HTTP callbacks are accepted on /callback/<callback_token>; empty disables them
+        self.callback_token = section.get('callback_token', fallback='')
+        self.deposit_receivers = section.getint('deposit_receivers', fallback=2)
+
+        # DB connection settings
+        self.db_host = section.get('host')
+        self.db_user = section.get('user')
+        self.db_pw = section.get('password')
+        self.db_schema = section.get('schema')
+        self.db_port = section.getint('port', fallback=5432)
+        self.db_connections = section.getint('db_connections', fallback=20)
+
+        # Read-only replicas (host or host:port, comma separated) with the primary's credentials, the replication lag
+        # in seconds beyond which one is skipped, which is also how long reads stay on the primary after a write they
+        # must see, and seconds between health probes
+        self.replica_hosts = [host.strip() for host in section.get('replica_hosts', fallback='').split(',')
+                              if host.strip()]
+        self.replica_max_lag = section.getfloat('replica_max_lag', fallback=5)
+        self.replica_probe_interval = section.getfloat('replica_probe_interval', fallback=10)
+
+
+@functools.lru_cache(maxsize=None)
+def get_settings():
+    """
+    Read the config file once and return the shared Settings object
+    """
+    config = configparser.ConfigParser()
+    config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+    return Settings(config)
@@ -0,0 +1,177 @@
+import bisect
+import datetime
+import hashlib
+import http.client
+import logging
+import os
+import socket
+from http import HTTPStatus
+
+import eventlet
+from eventlet import wsgi
+from eventlet.queue import LightQueue
+
+from modules.settings import get_settings
+
+# Points every shard gets on the hash ring, so the chat_ids spread evenly and adding a shard moves only its share
+VNODES = 64
+
+# Idle connections kept open to each shard by a router process
+IDLE_CONNECTIONS = 32
+
+# Seconds the router waits for a shard to handle an update before answering Telegram with an error
+FORWARD_TIMEOUT = 60
+
+# Shard index this process serves, None in a router (or unsharded) process
+state = {'shard': None}
+
+# The Ring over settings.shards, built on first use
+ring = {'ring': None}
+
+# shard index -> LightQueue of idle UnixConnections
+idle = {}
+
+counters = {'forwarded': 0, 'failed': 0, 'unkeyed': 0}
+forwarded = {}
+
+
+class UnixConnection(http.client.HTTPConnection):
+    """
+    HTTP to a shard's Unix socket; green once eventlet has monkey patched socket
+    """
+
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class Ring():
+    """
+    Consistent hash ring over the shard indexes
+    """
+
+    def __init__(self, shards, vnodes=VNODES):
+        points = sorted((key_hash('shard-{}-{}'.format(shard, vnode)), shard)
+                        for shard in range(shards) for vnode in range(vnodes))
+        self.hashes = [point[0] for point in points]
+        self.shards = [point[1] for point in points]
+
+    def shard_for(self, key):
+        index = bisect.bisect(self.hashes, key_hash(str(key))) % len(self.hashes)
+        return self.shards[index]
+
+
+def key_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def get_ring():
+    if ring['ring'] is None:
+        ring['ring'] = Ring(get_settings().shards)
+    return ring['ring']
+
+
+def routing():
+    """
+    True in the router of a sharded deployment: updates are forwarded instead of handled here
+    """
+    return get_settings().shards > 0 and state['shard'] is None
+
+
+def update_key(update):
+    """
+    The id an update is sharded by: the chat for group traffic, the sender for DMs and for updates without a
+    chat.  None when the update carries neither; those go to shard 0.
+    """
+    try:
+        for kind in ('message', 'edited_message', 'channel_post', 'my_chat_member', 'chat_member'):
+            message = update.get(kind)
+            if message is not None:
+                if message['chat']['type'] == 'private':
+                    return message['from']['id']
+                return message['chat']['id']
+        for kind in ('callback_query', 'inline_query', 'chosen_inline_result'):
+            if kind in update:
+                return update[kind]['from']['id']
+    except (AttributeError, KeyError, TypeError):
+        pass
+    return None
+
+
+def socket_path(shard):
+    return os.path.join(get_settings().shard_socket_dir, 'shard-{}.sock'.format(shard))
+
+
+def forward(update, body, path):
+    """
+    Hand the raw update to the shard owning its chat and relay the shard's answer.  A shard that is down or too
+    slow gets Telegram a 502, so Telegram delivers the update again later.  The update is only posted again when
+    the request could not be written, since a shard that read it may have handled it.
+    """
+    key = update_key(update)
+    if key is None:
+        counters['unkeyed'] += 1
+        shard = 0
+    else:
+        shard = get_ring().shard_for(key)
+
+    pool = idle.setdefault(shard, LightQueue(IDLE_CONNECTIONS))
+    while True:
+        reused = pool.qsize() > 0
+        connection = pool.get_nowait() if reused else UnixConnection(socket_path(shard), FORWARD_TIMEOUT)
+        try:
+            connection.request('POST', '/' + path, body, {'Content-Type': 'application/json'})
+        except ConnectionError:
+            connection.close()
+            if reused:
+                # An idle connection the shard closed, e.g. when it restarted
+                continue
+            error = "shard {} is down".format(shard)
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            error = str(e)
+        else:
+            try:
+                response = connection.getresponse()
+                answer = response.read()
+                break
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                error = str(e)
+        counters['failed'] += 1
+        logging.error("{}: Could not forward update to shard {}: {}".format(datetime.datetime.utcnow(), shard, error))
+        return '', HTTPStatus.BAD_GATEWAY
+
+    if pool.qsize() < IDLE_CONNECTIONS:
+        pool.put_nowait(connection)
+    else:
+        connection.close()
+    counters['forwarded'] += 1
+    forwarded[shard] = forwarded.get(shard, 0) + 1
+    return answer, response.status
+
+
+def serve_shard(app, shard):
+    """
+    Serve the app on the shard's Unix socket until the process is stopped
+    """
+    settings = get_settings()
+    if not 0 <= shard < settings.shards:
+        raise ValueError("Shard {} is not one of the {} configured".format(shard, settings.shards))
+    state['shard'] = shard
+    os.makedirs(settings.shard_socket_dir, exist_ok=True)
+    path = socket_path(shard)
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = eventlet.listen(path, family=socket.AF_UNIX)
+    logging.info("{}: shard {} of {} listening on {}".format(datetime.datetime.utcnow(), shard, settings.shards, path))
+    wsgi.server(listener, app, log_output=False)
+
+
+def stats():
+    return dict(counters, shard=state['shard'], shards=get_settings().shards, per_shard=dict(forwarded))
@@ -0,0 +1,400 @@
+import asyncio
+import json
+import random
+import re
+import secrets
+import time
+
+from aiohttp import ClientSession, web
+
+# Local stand-ins for the Banano node RPC and the Telegram Bot API, served by simulator.py and the benchmarks.
+# The bot is pointed at them through node_ip and telegram_api.
+
+ACCOUNT_ALPHABET = '13456789abcdefghijkmnopqrstuwxyz'
+ACCOUNT_PATTERN = re.compile(r'^(ban|nano|xrb)_[13][{}]{{59}}$'.format(ACCOUNT_ALPHABET))
+
+# Account every opening balance is sent from
+GENESIS = 'ban_1genesis' + '1' * 52
+
+# Bot API flood limits: messages per second to one private chat, per minute to one group, per second overall
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_PER_MINUTE = 20
+GLOBAL_RATE = 30
+
+
+def new_hash():
+    return secrets.token_hex(32).upper()
+
+
+def new_account():
+    return 'ban_1' + ''.join(random.choice(ACCOUNT_ALPHABET) for _ in range(59))
+
+
+class Ledger():
+    """
+    In-memory accounts and blocks.  Accounts the node has not seen yet are opened on first use, with
+    opening_balance waiting to be received from GENESIS, so the bot can run against an existing database.
+    """
+
+    def __init__(self, opening_balance):
+        self.opening_balance = opening_balance
+        self.accounts = {}
+        self.blocks = {}
+        self.wallets = {}
+        # (wallet, send id) -> hash, so a repeated send with the same id is not sent twice
+        self.send_ids = {}
+
+    def account(self, address):
+        state = self.accounts.get(address)
+        if state is None:
+            state = {'balance': 0, 'frontier': None, 'receivable': [], 'history': []}
+            self.accounts[address] = state
+            if self.opening_balance > 0:
+                self.add_block(GENESIS, 'send', address, self.opening_balance)
+        return state
+
+    def add_block(self, address, subtype, link, amount):
+        """
+        Append a block to the account's chain.  A send's link is the destination, a receive's the send hash.
+        """
+        block_hash = new_hash()
+        block = {'hash': block_hash, 'account': address, 'subtype': subtype, 'link': link, 'amount': amount,
+                 'local_timestamp': int(time.time())}
+        self.blocks[block_hash] = block
+        if address != GENESIS:
+            state = self.accounts[address]
+            block['previous'] = state['frontier']
+            state['frontier'] = block_hash
+            state['history'].append(block_hash)
+        if subtype == 'send':
+            self.account(link)['receivable'].append(block_hash)
+        return block
+
+    def wallet_accounts(self, wallet):
+        return self.wallets.setdefault(wallet, set())
+
+    def create_account(self, wallet):
+        address = new_account()
+        self.account(address)
+        self.wallet_accounts(wallet).add(address)
+        return address
+
+    def owns(self, wallet, address):
+        # Accounts opened on first use belong to every wallet, so an existing database needs no import step
+        return address in self.wallet_accounts(wallet) or not any(
+            address in accounts for accounts in self.wallets.values())
+
+    def move(self, source, wallet, addresses):
+        if not all(self.owns(source, address) for address in addresses):
+            raise ValueError('Account not found in wallet')
+        for address in addresses:
+            self.wallet_accounts(source).discard(address)
+            self.wallet_accounts(wallet).add(address)
+
+    def send(self, wallet, source, destination, amount, send_id):
+        if send_id is not None and (wallet, send_id) in self.send_ids:
+            return self.send_ids[(wallet, send_id)]
+        if not self.owns(wallet, source):
+            raise ValueError('Account not found in wallet')
+        state = self.account(source)
+        if amount > state['balance']:
+            raise ValueError('Insufficient balance')
+        state['balance'] -= amount
+        block_hash = self.add_block(source, 'send', destination, amount)['hash']
+        if send_id is not None:
+            self.send_ids[(wallet, send_id)] = block_hash
+        return block_hash
+
+    def receive(self, wallet, address, send_hash):
+        if not self.owns(wallet, address):
+            raise ValueError('Account not found in wallet')
+        state = self.account(address)
+        if send_hash not in state['receivable']:
+            raise ValueError('Block is not receivable')
+        state['receivable'].remove(send_hash)
+        amount = self.blocks[send_hash]['amount']
+        state['balance'] += amount
+        return self.add_block(address, 'receive', send_hash, amount)['hash']
+
+    def receivable_amount(self, address):
+        return sum(self.blocks[block_hash]['amount'] for block_hash in self.account(address)['receivable'])
+
+
+class SimulatedNode():
+    """
+    The node RPC actions the bot uses, over a Ledger.  Every call takes `latency` seconds, blocks another
+    `block_latency` and work `work_latency`.  failure_rate of the calls get an HTTP 500 and stall_rate of them
+    hang for `stall` seconds, to exercise the bot's timeouts, retries and circuit breaker.
+    """
+
+    def __init__(self, latency=0.0, block_latency=0.0, work_latency=0.0, failure_rate=0.0, stall_rate=0.0,
+                 stall=60.0, opening_balance=0, callback_url=None):
+        self.config = {'latency': latency, 'block_latency': block_latency, 'work_latency': work_latency,
+                       'failure_rate': failure_rate, 'stall_rate': stall_rate, 'stall': stall}
+        self.ledger = Ledger(opening_balance)
+        self.callback_url = callback_url
+        self.counters = {}
+        self.failures = {'failed': 0, 'stalled': 0, 'errors': 0}
+        self.session = None
+
+    async def rpc(self, request):
+        # The node reads the body as JSON whatever its content type
+        params = json.loads(await request.text())
+        action = params.get('action')
+        self.counters[action] = self.counters.get(action, 0) + 1
+
+        delay = self.config['latency']
+        if action in ('send', 'receive', 'account_create'):
+            delay += self.config['block_latency']
+        elif action == 'work_generate':
+            delay += self.config['work_latency']
+        if random.random() < self.config['stall_rate']:
+            self.failures['stalled'] += 1
+            delay = self.config['stall']
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if random.random() < self.config['failure_rate']:
+            self.failures['failed'] += 1
+            return web.Response(status=500, text='simulated failure')
+
+        handler = getattr(self, 'action_' + str(action), None)
+        if handler is None:
+            return web.json_response({'error': 'Unknown command'})
+        try:
+            return web.json_response(await handler(params))
+        except (KeyError, ValueError) as e:
+            self.failures['errors'] += 1
+            return web.json_response({'error': str(e)})
+
+    async def action_block_count(self, params):
+        return {'count': str(len(self.ledger.blocks)), 'unchecked': '0'}
+
+    async def action_account_create(self, params):
+        return {'account': self.ledger.create_account(params['wallet'])}
+
+    async def action_account_move(self, params):
+        self.ledger.move(params['source'], params['wallet'], params['accounts'])
+        return {'moved': '1'}
+
+    async def action_wallet_contains(self, params):
+        return {'exists': '1' if self.ledger.owns(params['wallet'], params['account']) else '0'}
+
+    async def action_validate_account_number(self, params):
+        return {'valid': '1' if ACCOUNT_PATTERN.match(params['account']) else '0'}
+
+    async def action_pending(self, params):
+        receivable = self.ledger.account(params['account'])['receivable']
+        return {'blocks': receivable[:int(params.get('count', len(receivable) or 1))]}
+
+    async def action_account_balance(self, params):
+        return {'balance': str(self.ledger.account(params['account'])['balance']),
+                'pending': str(self.ledger.receivable_amount(params['account']))}
+
+    async def action_accounts_balances(self, params):
+        return {'balances': {account: await self.action_account_balance({'account': account})
+                             for account in params['accounts']}}
+
+    async def action_accounts_frontiers(self, params):
+        frontiers = {account: self.ledger.account(account)['frontier'] for account in params['accounts']}
+        return {'frontiers': {account: frontier for account, frontier in frontiers.items() if frontier}}
+
+    async def action_work_generate(self, params):
+        return {'work': secrets.token_hex(8), 'hash': params['hash']}
+
+    async def action_send(self, params):
+        block_hash = self.ledger.send(params['wallet'], params['source'], params['destination'],
+                                      int(params['amount']), params.get('id'))
+        await self.callback(self.ledger.blocks[block_hash])
+        return {'block': block_hash}
+
+    async def action_receive(self, params):
+        return {'block': self.ledger.receive(params['wallet'], params['account'], params['block'])}
+
+    async def action_blocks_info(self, params):
+        blocks = {}
+        for block_hash in params['hashes']:
+            block = self.ledger.blocks[block_hash]
+            info = {'block_account': block['account'], 'amount': str(block['amount']), 'confirmed': 'true',
+                    'subtype': block['subtype'], 'local_timestamp': str(block['local_timestamp']),
+                    'contents': {'type': 'state', 'link_as_account': block['link']}}
+            if params.get('pending') in (True, 'true') and block['subtype'] == 'send':
+                info['pending'] = '1' if block_hash in self.ledger.account(block['link'])['receivable'] else '0'
+            blocks[block_hash] = info
+        return {'blocks': blocks}
+
+    async def action_account_history(self, params):
+        """
+        Newest first, paged with head like the real node.  With raw, receives carry the hash of their send as link.
+        """
+        history = self.ledger.account(params['account'])['history']
+        end = history.index(params['head']) + 1 if params.get('head') else len(history)
+        count = int(params.get('count', end))
+        page = list(reversed(history[max(0, end - count):end]))
+        entries = []
+        for block_hash in page:
+            block = self.ledger.blocks[block_hash]
+            other = block['link'] if block['subtype'] == 'send' else self.ledger.blocks[block['link']]['account']
+            entry = {'type': block['subtype'], 'account': other, 'amount': str(block['amount']), 'hash': block_hash,
+                     'local_timestamp': str(block['local_timestamp'])}
+            if params.get('raw') in (True, 'true'):
+                entry.update(type='state', subtype=block['subtype'], link=block['link'],
+                             previous=block['previous'] or '0' * 64)
+            entries.append(entry)
+        previous = self.ledger.blocks[page[-1]].get('previous') if page else None
+        return dict({'account': params['account'], 'history': entries}, **({'previous': previous} if previous else {}))
+
+    async def callback(self, block):
+        """
+        Push the block to the bot like the node's HTTP callback does
+        """
+        if self.callback_url is None:
+            return
+        payload = {'account': block['account'], 'hash': block['hash'], 'amount': str(block['amount']),
+                   'is_send': 'true', 'block': json.dumps({'type': 'state', 'link_as_account': block['link']})}
+        try:
+            if self.session is None:
+                self.session = ClientSession()
+            async with self.session.post(self.callback_url, json=payload) as resp:
+                await resp.read()
+        except Exception:
+            self.failures['errors'] += 1
+
+    async def control(self, request):
+        """
+        Change latency and failure injection while a load test runs
+        """
+        changes = await request.json()
+        self.config.update({key: float(value) for key, value in changes.items() if key in self.config})
+        return web.json_response(self.config)
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats())
+
+    def stats(self):
+        return {'config': self.config, 'actions': self.counters, 'failures': self.failures,
+                'accounts': len(self.ledger.accounts), 'blocks': len(self.ledger.blocks)}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/_sim/stats', self.get_stats)
+        app.router.add_post('/_sim/config', self.control)
+        app.router.add_post('/', self.rpc)
+        return app
+
+
+class TokenBucket():
+    """
+    Refills `rate` tokens per second up to `capacity`
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def has_token(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+
+class SimulatedTelegram():
+    """
+    sendMessage, setWebhook, deleteWebhook and getMe of the Bot API, with Telegram's flood limits: over-eager
+    callers get a 429 with retry_after like the real API.  Every call takes `latency` seconds.
+    """
+
+    def __init__(self, latency=0.0, flood_limits=True):
+        self.latency = latency
+        self.flood_limits = flood_limits
+        self.buckets = {}
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.counters = {}
+        self.sent = []
+        self.webhook = ''
+
+    def bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if chat_id > 0:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_RATE)
+            else:
+                bucket = TokenBucket(GROUP_CHAT_PER_MINUTE / 60.0, GROUP_CHAT_PER_MINUTE)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def flooded(self, chat_id):
+        """
+        Seconds to wait before chat_id may get another message, or 0
+        """
+        if not self.flood_limits:
+            return 0
+        for bucket in (self.global_bucket, self.bucket(chat_id)):
+            if not bucket.has_token():
+                return max(1, int((1 - bucket.tokens) / bucket.rate) + 1)
+        self.global_bucket.take()
+        self.bucket(chat_id).take()
+        return 0
+
+    async def call(self, request):
+        method = request.match_info['method']
+        self.counters[method] = self.counters.get(method, 0) + 1
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            retry_after = self.flooded(chat_id)
+            if retry_after:
+                self.counters['flood_limited'] = self.counters.get('flood_limited', 0) + 1
+                return web.json_response({'ok': False, 'error_code': 429,
+                                          'description': 'Too Many Requests: retry after {}'.format(retry_after),
+                                          'parameters': {'retry_after': retry_after}}, status=429)
+            self.sent.append({'chat_id': chat_id, 'text': params.get('text', '')})
+            return web.json_response({'ok': True, 'result': {
+                'message_id': len(self.sent), 'date': int(time.time()), 'text': params.get('text', ''),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Simulated Bot', 'username': 'SimulatedBot'}}})
+        if method == 'setWebhook':
+            self.webhook = params.get('url', '')
+            return web.json_response({'ok': True, 'result': True, 'description': 'Webhook was set'})
+        if method == 'deleteWebhook':
+            self.webhook = ''
+            return web.json_response({'ok': True, 'result': True})
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Simulated Bot',
+                                                             'username': 'SimulatedBot'}})
+        return web.json_response({'ok': False, 'error_code': 404, 'description': 'Not Found'}, status=404)
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats())
+
+    def stats(self):
+        return {'methods': self.counters, 'messages': len(self.sent), 'chats': len(self.buckets),
+                'webhook': self.webhook}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/_sim/stats', self.get_stats)
+        app.router.add_post('/bot{token}/{method}', self.call)
+        return app
+
+
+async def serve(app, host='127.0.0.1', port=0):
+    """
+    Serve app and return the runner and the base URL
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner, 'http://{}:{}'.format(host, runner.addresses[0][1])
@@ -1,46 +1,71 @@
-import configparser
 import logging
-import os
 import re
 import datetime
+from collections import OrderedDict
 from decimal import Decimal
 from peewee import fn
 
-import nano
-import pyqrcode
+import eventlet
 import telegram
-
+from eventlet.queue import LightQueue
+
+import modules.balances as balances
+import modules.clients as clients
+import modules.currency as currency
+import modules.db as db
+import modules.profiling as profiling
+import modules.users as users
 from modules.conversion import BananoConversions
+from modules.settings import get_settings
+
+# (chat_id, member_id) pairs known to be stored in chat_members, least recently seen first
+MEMBER_CACHE_SIZE = 100000
+member_cache = OrderedDict()
 
-# Read config and parse constants
-config = configparser.ConfigParser()
-config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
-logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
-# Telegram API
-TELEGRAM_KEY = config.get('webhooks', 'telegram_key')
+# Members waiting to be written by the background member writer
+member_queue = LightQueue()
+member_queued = set()
 
-# Constants
-MIN_TIP = config.get('webhooks', 'min_tip')
-NODE_IP = config.get('webhooks', 'node_ip')
+# Telegram errors that refuse a DM for good: the receiver blocked the bot, or the chat does not exist because they
+# never started one with it
+DM_REFUSED = (telegram.error.Unauthorized, telegram.error.BadRequest)
 
-# Connect to Telegram
-telegram_bot = telegram.Bot(token=TELEGRAM_KEY)
+# Reply sent instead of queueing more work on the node while its circuit breaker is open
+NODE_BUSY_TEXT = (
+    "The BANANO node is busy right now, so I couldn't process your request.  Please try again in a few "
+    "minutes.")
 
-# Connect to node
-rpc = nano.rpc.Client(NODE_IP)
+NO_TIP_ACCOUNT_TEXT = (
+    "You do not have an account with the bot.  Please send a DM to me with .register to set up an account.")
+SELF_TIP_TEXT = "Self tipping is not allowed.  Please use this bot to tip BANANO to other users!"
 
 
 def send_dm(receiver, message):
     """
-    Send the provided message to the provided receiver
+    Send the provided message to the provided receiver.  Returns False if Telegram did not take it.
     """
 
     try:
-        telegram_bot.sendMessage(chat_id=receiver, text=message)
+        return deliver_dm(receiver, message)
     except Exception as e:
         logging.info("{}: Send DM - Telegram ERROR: {}".format(
             datetime.datetime.utcnow(), e))
-        pass
+        return False
+
+
+def deliver_dm(receiver, message):
+    """
+    Send the provided message to the provided receiver.  Returns False if Telegram refused it for good, see
+    DM_REFUSED; raises on errors worth retrying, such as flood limits, timeouts and network errors.
+    """
+    try:
+        with profiling.stage('telegram_send'):
+            clients.telegram_bot.sendMessage(chat_id=receiver, text=message)
+    except DM_REFUSED as e:
+        logging.info("{}: Send DM - Telegram refused: {}".format(
+            datetime.datetime.utcnow(), e))
+        return False
+    return True
 
 
 def check_message_action(message):
@@ -73,33 +98,25 @@ def find_amount(input_text):
 	else:
 		raise Exception("couldn't find amount")
 
-def validate_tip_amount(message):
+def parse_tip_amount(message):
     """
-    Validate the message includes an amount to tip, and if that tip amount is greater than the minimum tip amount.
+    Read the tip amount from the message text into tip_amount, tip_amount_raw and tip_amount_text.  Returns None
+    for a valid amount, otherwise the reply to send ('' when there is nothing to tell the sender).
     """
-    logging.info("{}: in validate_tip_amount".format(datetime.datetime.utcnow()))
     try:
         message['tip_amount'] = find_amount(message['text'])
     except Exception:
         logging.info("{}: Tip amount was not a number: {}".format(
             datetime.datetime.utcnow(), message['text'][message['starting_point']]))
-        not_a_number_text = 'Looks like the value you entered to tip was not a number.  You can try to tip ' \
-                            'again using the format .tip 1234 @username'
-        send_reply(message, not_a_number_text)
+        return ('Looks like the value you entered to tip was not a number.  You can try to tip '
+                'again using the format .tip 1234 @username')
 
-        message['tip_amount'] = -1
-        return message
-
-    if int(message['tip_amount']) < int(MIN_TIP):
-        min_tip_text = (
-            "The minimum tip amount is {} BANANO.  Please update your tip amount and try again."
-            .format(MIN_TIP))
-        send_reply(message, min_tip_text)
-
-        message['tip_amount'] = -1
+    min_tip = get_settings().min_tip
+    if int(message['tip_amount']) < int(min_tip):
         logging.info("{}: User tipped less than {} BANANO.".format(
-            datetime.datetime.utcnow(), MIN_TIP))
-        return message
+            datetime.datetime.utcnow(), min_tip))
+        return ("The minimum tip amount is {} BANANO.  Please update your tip amount and try again."
+                .format(min_tip))
 
     try:
         message['tip_amount_raw'] = BananoConversions.banano_to_raw(message['tip_amount'])
@@ -108,8 +125,7 @@ def validate_tip_amount(message):
             "{}: Exception converting tip_amount to tip_amount_raw".format(
                 datetime.datetime.utcnow()))
         logging.info("{}: {}".format(datetime.datetime.utcnow(), e))
-        message['tip_amount'] = -1
-        return message
+        return ''
 
     # create a string to remove scientific notation from small decimal tips
     if str(message['tip_amount'])[0] == ".":
@@ -117,144 +133,110 @@ def validate_tip_amount(message):
     else:
         message['tip_amount_text'] = str(message['tip_amount'])
 
+    return None
+
+
+def validate_tip_amount(message):
+    """
+    Validate the message includes an amount to tip, and if that tip amount is greater than the minimum tip amount.
+    """
+    logging.info("{}: in validate_tip_amount".format(datetime.datetime.utcnow()))
+    error_text = parse_tip_amount(message)
+    if error_text is not None:
+        if error_text != '':
+            send_reply(message, error_text)
+        message['tip_amount'] = -1
     return message
 
 
+def tip_targets(message, request_json):
+    """
+    The members a tip message is aimed at, in order: the author of the replied-to message, or every @username
+    and text mention.  Each target is ('id', member_id, display name) or ('name', lower case username, display name).
+    """
+    if 'reply_to_message' in request_json['message']:
+        replied_to = request_json['message']['reply_to_message']['from']
+        return [('id', int(replied_to['id']), replied_to.get('first_name'))]
+
+    targets = []
+    for item in message['text'].split():
+        if str(item).startswith("@") and str(item).lower() != str(message['sender_screen_name']).lower():
+            targets.append(('name', item[1:].lower(), item))
+    for mention in request_json['message'].get('entities', []):
+        if mention.get('type') == 'text_mention':
+            targets.append(('id', int(mention['user']['id']), mention['user'].get('first_name')))
+    return targets
+
+
+def missing_user_text(display_name):
+    return ("Couldn't send tip. In order to tip {}, they need to have sent at least one message in the group."
+            .format(display_name))
+
+
+def set_total_tip_amount(message, receiver_count):
+    message['total_tip_amount'] = message['tip_amount']
+    if receiver_count > 0 and message['tip_amount'] != -1:
+        message['total_tip_amount'] *= receiver_count
+
+
+def add_receiver(users_to_tip, member_id, member_name):
+    """
+    Add a tip target found in the chat to the receivers, once however often they were mentioned
+    """
+    if not any(receiver['receiver_id'] == member_id for receiver in users_to_tip):
+        users_to_tip.append({'receiver_id': member_id, 'receiver_screen_name': member_name,
+                             'receiver_account': None, 'receiver_register': None})
+
+
 def set_tip_list(message, users_to_tip, request_json):
-    import modules.db as db
     """
     Loop through the message starting after the tip amount and identify any users that were tagged for a tip.  Add the
     user object to the users_to_tip dict to process the tips.
     """
     logging.info("{}: in set_tip_list.".format(datetime.datetime.utcnow()))
-
-    # Identify the first user to string multi tips.  Once a non-user is mentioned, end the user list
-
-    first_user_flag = False
-
     logging.info("trying to set tiplist in telegram: {}".format(message))
 
-    if 'reply_to_message' in request_json['message']:
-        if len(users_to_tip) == 0:
-            try:
-                user = db.TelegramChatMember.select().where(
-                    (db.TelegramChatMember.chat_id == int(message['chat_id'])) & 
-                    (db.TelegramChatMember.member_id == int(request_json['message']['reply_to_message']['from']['id']))).get()
-                receiver_id = user.member_id
-                receiver_screen_name = user.member_name
-
-                user_dict = {'receiver_id': receiver_id, 'receiver_screen_name': receiver_screen_name,
-                                'receiver_account': None, 'receiver_register': None}
-                users_to_tip.append(user_dict)
-            except db.TelegramChatMember.DoesNotExist:
-                logging.info("User not found in DB: chat ID:{} - member name:{}".
-                                format(message['chat_id'], request_json['message']['reply_to_message']['from']['first_name']))
-                missing_user_message = (
-                    "Couldn't send tip. In order to tip {}, they need to have sent at least "
-                    "one message in the group."
-                    .format(request_json['message']['reply_to_message']['from']
-                                                                    ['first_name']))
-                send_reply(message, missing_user_message)
-                users_to_tip.clear()
-                return message, users_to_tip
-    else:
-        for item in message['text'].split():
-            if str(item).startswith("@") and str(item).lower() != str(message['sender_screen_name']).lower():
-                try:
-                    user = db.TelegramChatMember.select().where(
-                        (db.TelegramChatMember.chat_id == int(message['chat_id'])) & 
-                        (fn.lower(db.TelegramChatMember.member_name) == item[1:].lower())).get()
-                    receiver_id = user.member_id
-                    receiver_screen_name = user.member_name
-                    duplicate_user = False
-
-                    for u_index in range(0, len(users_to_tip)):
-                        if users_to_tip[u_index]['receiver_id'] == receiver_id:
-                            duplicate_user = True
-
-                    if not duplicate_user:
-                        if not first_user_flag:
-                            first_user_flag = True
-                        logging.info("User tipped via searching the string for mentions")
-                        user_dict = {'receiver_id': receiver_id, 'receiver_screen_name': receiver_screen_name,
-                                        'receiver_account': None, 'receiver_register': None}
-                        users_to_tip.append(user_dict)
-                except db.TelegramChatMember.DoesNotExist:
-                    logging.info("User not found in DB: chat ID:{} - member name:{}".
-                                    format(message['chat_id'], item[1:]))
-                    missing_user_message = (
-                        "Couldn't send tip. In order to tip {}, they need to have sent at least "
-                        "one message in the group."
-                        .format(item))
-                    send_reply(message, missing_user_message)
-                    users_to_tip.clear()
-                    return message, users_to_tip
+    for kind, key, display_name in tip_targets(message, request_json):
         try:
-            text_mentions = request_json['message']['entities']
-            for mention in text_mentions:
-                if mention['type'] == 'text_mention':
-                    try:
-                        user = db.TelegramChatMember.select().where(
-                            (db.TelegramChatMember.chat_id == int(message['chat_id'])) & 
-                            (db.TelegramChatMember.member_id == int(mention['user']['id']))).get()
-                        receiver_id = user.member_id
-                        receiver_screen_name = user.member_name
-                        logging.info("telegram user added via mention list.")
-                        logging.info("mention: {}".format(mention))
-
-                        user_dict = {'receiver_id': receiver_id, 'receiver_screen_name': receiver_screen_name,
-                                        'receiver_account': None, 'receiver_register': None}
-                        users_to_tip.append(user_dict)
-                    except db.TelegramChatMember.DoesNotExist:
-                        logging.info("User not found in DB: chat ID:{} - member name:{}".
-                                        format(message['chat_id'], mention['user']['first_name']))
-                        missing_user_message = (
-                            "Couldn't send tip. In order to tip {}, they need to have sent at least "
-                            "one message in the group."
-                            .format(item))
-                        send_reply(message, missing_user_message)
-                        users_to_tip.clear()
-                        return message, users_to_tip
-        except:
-            pass
+            user = db.read(target_query(int(message['chat_id']), kind, key), one=True,
+                           key=('chat', int(message['chat_id'])))
+        except db.TelegramChatMember.DoesNotExist:
+            logging.info("User not found in DB: chat ID:{} - member name:{}".
+                         format(message['chat_id'], display_name))
+            send_reply(message, missing_user_text(display_name))
+            users_to_tip.clear()
+            return message, users_to_tip
+
+        add_receiver(users_to_tip, user.member_id, user.member_name)
 
     logging.info("{}: Users_to_tip: {}".format(datetime.datetime.utcnow(), users_to_tip))
-    message['total_tip_amount'] = message['tip_amount']
-    if len(users_to_tip) > 0 and message['tip_amount'] != -1:
-        message['total_tip_amount'] *= len(users_to_tip)
+    set_total_tip_amount(message, len(users_to_tip))
 
     return message, users_to_tip
 
 
 def validate_sender(message):
-    import modules.db as db
-    import modules.currency as currency
     """
     Validate that the sender has an account with the tip bot, and has enough NANO to cover the tip.
     """
     logging.info("{}: validating sender".format(datetime.datetime.utcnow()))
     logging.info("sender id: {}".format(message['sender_id']))
     try:
-        user = db.User.select().where(db.User.user_id == int(message['sender_id'])).get()
+        user = users.get_user(message['sender_id'])
         message['sender_account'] = user.account
         message['sender_register'] = user.register
 
         if message['sender_register'] != 1:
-            db.User.update(register=1).where(
-                (db.User.user_id == int(message['sender_id'])) &
-                (db.User.register == 0)).execute()
+            users.mark_registered(message['sender_id'])
 
         currency.receive_pending(message['sender_account'])
-        message['sender_balance_raw'] = rpc.account_balance(
-            account='{}'.format(message['sender_account']))
+        # Never the cached balance: the tip is checked against it
+        message['sender_balance_raw'] = balances.fresh_balance(message['sender_account'])
         message['sender_balance'] = BananoConversions.raw_to_banano(message['sender_balance_raw']['balance'])
 
         return message
     except db.User.DoesNotExist:
-        no_account_text = (
-            "You do not have an account with the bot.  Please send a DM to me with .register to set up "
-            "an account.")
-        send_reply(message, no_account_text)
+        send_reply(message, NO_TIP_ACCOUNT_TEXT)
 
         logging.info("{}: User tried to send a tip without an account.".format(
             datetime.datetime.utcnow()))
@@ -266,12 +248,8 @@ def validate_total_tip_amount(message):
     Validate that the sender has enough Nano to cover the tip to all users
     """
     logging.info("{}: validating total tip amount".format(datetime.datetime.utcnow()))
-    if message['sender_balance_raw']['balance'] < BananoConversions.banano_to_raw(message['total_tip_amount']):
-        not_enough_text = (
-            "You do not have enough BANANO to cover this {} BANANO tip.  Please check your balance by "
-            "sending a DM to me with .balance and retry.".format(
-                message['total_tip_amount']))
-        send_reply(message, not_enough_text)
+    if not covers_total(message):
+        send_reply(message, not_enough_text(message))
 
         logging.info(
             "{}: User tried to send more than in their account.".format(
@@ -282,16 +260,64 @@ def validate_total_tip_amount(message):
     return message
 
 
+def covers_total(message):
+    """
+    True when the sender's balance covers the tip to every receiver
+    """
+    return message['sender_balance_raw']['balance'] >= BananoConversions.banano_to_raw(message['total_tip_amount'])
+
+
+def not_enough_text(message):
+    return ("You do not have enough BANANO to cover this {} BANANO tip.  Please check your balance by "
+            "sending a DM to me with .balance and retry.".format(message['total_tip_amount']))
+
+
+def tip_success_text(message, receiver_count):
+    """
+    Reply to the sender once every tip is sent, or None when nobody was tipped
+    """
+    if receiver_count >= 2:
+        return "You have successfully sent your {} BAN tips.".format(message['tip_amount_text'])
+    if receiver_count == 1:
+        return "You have successfully sent your {} BAN tip.".format(message['tip_amount_text'])
+    return None
+
+
+def tip_received_text(sender_screen_name, tip_amount_text):
+    return ("@{0} just sent you a {1} BANANO tip! Reply to this DM with .balance to see your new balance.  If you "
+            "have not registered an account, send a reply with .register to get started, or .help to see a list of "
+            "commands! Learn more about BANANO at https://banano.cc".format(sender_screen_name, tip_amount_text))
+
+
+def target_query(chat_id, kind, key):
+    """
+    The chat member a tip_targets() target points at
+    """
+    if kind == 'id':
+        member_match = db.TelegramChatMember.member_id == key
+    else:
+        member_match = fn.lower(db.TelegramChatMember.member_name) == key
+    return db.TelegramChatMember.select().where((db.TelegramChatMember.chat_id == chat_id) & member_match)
+
+def member_query(chat_id, member_id):
+    return db.TelegramChatMember.select().where(
+        (db.TelegramChatMember.chat_id == chat_id) & (db.TelegramChatMember.member_id == member_id))
+
+def delete_member_query(chat_id, member_id):
+    return db.TelegramChatMember.delete().where(
+        (db.TelegramChatMember.chat_id == chat_id) & (db.TelegramChatMember.member_id == member_id))
+
 def send_reply(message, text):
-    telegram_bot.sendMessage(chat_id=message['chat_id'], text=text)
+    with profiling.stage('telegram_send'):
+        clients.telegram_bot.sendMessage(chat_id=message['chat_id'], text=text)
 
 
 def check_telegram_member(chat_id, chat_name, member_id, member_name):
-    import modules.db as db
+    key = member_key(chat_id, member_id)
+    if seen_member(key):
+        return
     try:
-        db.TelegramChatMember.select().where(
-            (db.TelegramChatMember.chat_id == chat_id) &
-            (db.TelegramChatMember.member_id == member_id)).get()
+        db.read(member_query(chat_id, member_id), one=True, key=('chat', key[0]))
     except db.TelegramChatMember.DoesNotExist:
         logging.info("{}: User {}-{} not found in DB, inserting".format(
             datetime.datetime.utcnow(), chat_id, member_name))
@@ -303,6 +329,95 @@ def check_telegram_member(chat_id, chat_name, member_id, member_name):
             created_ts=datetime.datetime.utcnow()
         )
         chat_member.save(force_insert=True)
+        db.wrote(('chat', key[0]))
+    cache_telegram_member(key)
+
+def member_key(chat_id, member_id):
+    return (int(chat_id), int(member_id))
+
+def seen_member(key):
+    """
+    True when the member is cached as stored, which also makes it the most recently seen
+    """
+    if key not in member_cache:
+        return False
+    member_cache.move_to_end(key)
+    return True
+
+def claim_member(key):
+    """
+    True for the caller that should record a member that is neither cached nor queued for the member writer yet
+    """
+    if seen_member(key) or key in member_queued:
+        return False
+    member_queued.add(key)
+    return True
+
+def cache_telegram_member(key):
+    member_cache[key] = True
+    if len(member_cache) > MEMBER_CACHE_SIZE:
+        member_cache.popitem(last=False)
+
+def touch_telegram_member(chat_id, chat_title, member_id, member_name):
+    """
+    Record that a member spoke in a chat without touching the DB on the request path.  Members that are not
+    cached yet are handed to the background member writer.
+    """
+    if claim_member(member_key(chat_id, member_id)):
+        member_queue.put((chat_id, chat_title, member_id, member_name))
+
+def start_member_writer():
+    eventlet.spawn(member_writer)
+
+def member_writer():
+    while True:
+        chat_id, chat_title, member_id, member_name = member_queue.get()
+        try:
+            with db.database.connection_context():
+                check_telegram_member(chat_id, re.sub('\W+', ' ', chat_title), member_id, member_name)
+        except Exception as e:
+            logging.info("{}: Could not record member {} of chat {}: {}".format(
+                datetime.datetime.utcnow(), member_id, chat_id, e))
+        finally:
+            member_queued.discard(member_key(chat_id, member_id))
+
+def get_screen_name(user_json):
+    """
+    Telegram username, or first and last name for users without one
+    """
+    if 'username' in user_json:
+        return user_json['username']
+    screen_name = user_json.get('first_name', '')
+    if 'last_name' in user_json:
+        screen_name = screen_name + ' ' + user_json['last_name']
+    return screen_name
+
+def parse_private_message(request_json):
+    """
+    The message dict of a direct message to the bot
+    """
+    message = {
+        'sender_id': request_json['message']['from']['id'],
+        'sender_screen_name': get_screen_name(request_json['message']['from']),
+        'dm_id': request_json['update_id'],
+        'text': request_json['message']['text']
+    }
+    message['dm_array'] = message['text'].split(" ")
+    message['dm_action'] = message['dm_array'][0].lower() # TODO: use regex!
+    return message
+
+def parse_group_message(request_json):
+    """
+    The message dict of a text message in a group, with the text normalized for command parsing
+    """
+    return {
+        'sender_id': request_json['message']['from']['id'],
+        'sender_screen_name': get_screen_name(request_json['message']['from']),
+        'id': request_json['message']['message_id'],
+        'chat_id': request_json['message']['chat']['id'],
+        'chat_name': re.sub('\W+', ' ', request_json['message']['chat']['title']),
+        'text': request_json['message']['text'].replace('\n', ' ').lower()
+    }
 
 def send_account_message(account_text, message, account):
     """
@@ -0,0 +1,202 @@
+import datetime
+import logging
+import time
+from collections import OrderedDict
+
+import modules.db as db
+from modules.settings import get_settings
+
+# Database checks between two sweeps of the buckets that have refilled completely, which are the same as no bucket
+# at all
+PRUNE_EVERY = 1000
+
+THROTTLED_TEXT = "You're sending commands too quickly.  Please wait a moment and try again."
+CHAT_THROTTLED_TEXT = "This chat is sending tips too quickly.  Please wait a moment and try again."
+
+# Reply and counter of a throttled bucket, in the order of bucket_specs()
+THROTTLED = ((THROTTLED_TEXT, 'throttled_sender'), (CHAT_THROTTLED_TEXT, 'throttled_chat'))
+
+# The buckets live in the throttle_buckets table, so every worker and shard process draws from the same ones.
+# REFILL_SQL creates or refills the buckets of one check and locks them until its transaction ends.  A bucket
+# refills `rate` tokens per second up to `capacity`; `notified` remembers that the owner was already told they are
+# throttled, so only the first throttled request of a burst gets a reply.
+REFILL_SQL = (
+    "INSERT INTO throttle_buckets AS bucket (key, tokens, rate, capacity, updated, notified) VALUES {} "
+    "ON CONFLICT (key) DO UPDATE SET "
+    "tokens = LEAST(EXCLUDED.capacity, bucket.tokens + GREATEST(0, EXCLUDED.updated - bucket.updated) * EXCLUDED.rate), "
+    "rate = EXCLUDED.rate, capacity = EXCLUDED.capacity, updated = EXCLUDED.updated "
+    "RETURNING key, tokens, notified")
+REFILL_VALUES = "(%s, %s, %s, %s, %s, FALSE)"
+TAKE_SQL = (
+    "UPDATE throttle_buckets AS bucket SET tokens = bucket.tokens - claim.tokens, notified = FALSE "
+    "FROM (VALUES {}) AS claim (key, tokens) WHERE bucket.key = claim.key")
+TAKE_VALUES = "(%s, %s::double precision)"
+NOTIFY_SQL = "UPDATE throttle_buckets SET notified = TRUE WHERE key = %s"
+PRUNE_SQL = "DELETE FROM throttle_buckets WHERE updated + capacity / NULLIF(rate, 0) < %s"
+
+# Each process claims tokens of the shared buckets ahead of its checks, up to LEASE_SHARE of a bucket's capacity at
+# once, so a busy chat's row is locked once per claim instead of by every check.  Claimed tokens left unused after
+# LEASE_SECONDS are dropped, which can only throttle more.  A bucket found empty cannot refill before its next token
+# is due, so until then its checks are throttled without a query.
+LEASE_SHARE = 0.25
+LEASE_SECONDS = 10
+# Buckets remembered per process, least recently used first
+LOCAL_BUCKETS = 100000
+# key -> {'tokens': claimed tokens left, 'expires': end of the claim, 'empty_until': time of the next token}
+claims = OrderedDict()
+
+counters = {'allowed': 0, 'throttled_sender': 0, 'throttled_chat': 0, 'replies': 0, 'local': 0, 'claims': 0}
+
+
+def bucket_specs(sender_id, chat_id=None):
+    """
+    (key, rate, capacity) of the sender's bucket and, for group messages, the chat's bucket
+    """
+    settings = get_settings()
+    specs = [('sender:{}'.format(int(sender_id)), settings.throttle_sender_rate, settings.throttle_sender_burst)]
+    if chat_id is not None:
+        specs.append(('chat:{}'.format(int(chat_id)), settings.throttle_chat_rate, settings.throttle_chat_burst))
+    return specs
+
+
+def refill_params(specs, now):
+    params = []
+    for key, rate, capacity in specs:
+        params.extend((key, float(capacity), float(rate), capacity, now))
+    return params
+
+
+def take_params(takes):
+    return [value for take in takes for value in take]
+
+
+def remember(key):
+    entry = claims.get(key)
+    if entry is None:
+        entry = claims[key] = {'tokens': 0, 'expires': 0.0, 'empty_until': 0.0}
+        if len(claims) > LOCAL_BUCKETS:
+            claims.popitem(last=False)
+    else:
+        claims.move_to_end(key)
+    return entry
+
+
+def held(key, now):
+    """
+    Tokens this process claimed from the bucket and may still use
+    """
+    entry = claims.get(key)
+    if entry is None or entry['expires'] <= now:
+        return 0
+    return max(entry['tokens'], 0)
+
+
+def take_local(specs):
+    for key, _, _ in specs:
+        if key in claims:
+            claims[key]['tokens'] -= 1
+
+
+def local_check(specs, now):
+    """
+    Decide a check from the tokens this process claimed, without the database.  Returns (reply, claim): claim lists
+    the specs of the buckets to refill from the database when this process cannot decide alone, otherwise reply is
+    as for check().
+    """
+    claim = []
+    for (key, rate, capacity), (_, counter) in zip(specs, THROTTLED):
+        entry = claims.get(key)
+        if entry is not None and entry['empty_until'] > now:
+            # The owner heard when the bucket ran out, and it has no token yet
+            counters[counter] += 1
+            counters['local'] += 1
+            return '', []
+        if entry is None or entry['tokens'] < 1 or entry['expires'] <= now:
+            claim.append((key, rate, capacity))
+    if not claim:
+        take_local(specs)
+        counters['allowed'] += 1
+        counters['local'] += 1
+    return None, claim
+
+
+def settle(specs, claim, refilled, now, sender_id, chat_id=None):
+    """
+    Decide a check local_check() could not, from the buckets of claim refilled by the database (key -> (tokens,
+    notified)) and the tokens this process holds.  Returns (reply, takes, notify): takes lists the (key, tokens) to
+    take from the shared buckets, notify the key to mark notified.
+    """
+    counters['claims'] += 1
+    available = {}
+    for key, _, _ in specs:
+        tokens, notified = refilled.get(key, (0, False))
+        available[key] = (tokens + held(key, now), notified)
+    reply, take, notify = decide(specs, available, sender_id, chat_id)
+    takes = []
+    for key, rate, capacity in claim:
+        tokens = refilled[key][0]
+        if held(key, now) >= 1:
+            # Other checks of this process claimed tokens while this one waited for the database
+            continue
+        entry = remember(key)
+        if tokens < 1:
+            entry['empty_until'] = now + (1 - tokens) / rate
+        elif take:
+            lease = max(1, min(int(tokens), int(capacity * LEASE_SHARE)))
+            takes.append((key, lease))
+            entry.update(tokens=lease, expires=now + LEASE_SECONDS, empty_until=0.0)
+    if take:
+        take_local(specs)
+    return reply, takes, notify
+
+
+def decide(specs, refilled, sender_id, chat_id=None):
+    """
+    Decide a check from the refilled buckets (key -> (tokens, notified)).  Returns (reply, keys to take a token
+    from, key to mark notified): reply is None when the request may go ahead, otherwise the reply to send, or ''
+    when the owner was already told.
+    """
+    for (key, _, _), (text, counter), owner in zip(specs, THROTTLED, (sender_id, chat_id)):
+        tokens, notified = refilled[key]
+        if tokens < 1:
+            counters[counter] += 1
+            if notified:
+                return '', [], None
+            counters['replies'] += 1
+            logging.info("{}: throttled {}".format(datetime.datetime.utcnow(), owner))
+            return text, [], key
+    counters['allowed'] += 1
+    return None, [key for key, _, _ in specs], None
+
+
+def due_for_prune():
+    return counters['claims'] % PRUNE_EVERY == 0
+
+
+def check(sender_id, chat_id=None):
+    """
+    Take a token from the sender's bucket and, for group messages, the chat's bucket.  Returns None when the
+    request may go ahead, otherwise the reply to send, or '' when the sender was already told.  Only goes to the
+    database when the tokens this process claimed cannot decide it.
+    """
+    specs = bucket_specs(sender_id, chat_id)
+    now = time.time()
+    reply, claim = local_check(specs, now)
+    if not claim:
+        return reply
+    with db.database.atomic():
+        cursor = db.database.execute_sql(REFILL_SQL.format(', '.join([REFILL_VALUES] * len(claim))),
+                                         refill_params(claim, now))
+        refilled = {key: (tokens, notified) for key, tokens, notified in cursor.fetchall()}
+        reply, takes, notify = settle(specs, claim, refilled, now, sender_id, chat_id)
+        if takes:
+            db.database.execute_sql(TAKE_SQL.format(', '.join([TAKE_VALUES] * len(takes))), take_params(takes))
+        if notify is not None:
+            db.database.execute_sql(NOTIFY_SQL, (notify,))
+    if due_for_prune():
+        db.database.execute_sql(PRUNE_SQL, (now,))
+    return reply
+
+
+def stats():
+    return dict(counters)
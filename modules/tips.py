@@ -0,0 +1,220 @@
+import datetime
+import logging
+import time
+
+import eventlet
+import nano
+from peewee import fn
+
+import modules.actors as actors
+import modules.batching as batching
+import modules.clients as clients
+import modules.currency as currency
+import modules.db as db
+import modules.users as users
+from modules.conversion import BananoConversions
+from modules.resilience import NodeBusyError
+from modules.settings import get_settings
+
+# Tip states, stored in tip_list.processed.  A tip only ever moves forward; rows written before the
+# lifecycle existed are SENT without a send_hash and are left alone.  UNNOTIFIED tips reached the receiver's
+# account but Telegram refused the DM, e.g. because the receiver never started a chat with the bot; nothing more is
+# done for them.  Only a tip that was never sent can be FAILED.
+CREATED = 0
+WORK_READY = 1
+SENT = 2
+RECEIVED = 3
+NOTIFIED = 4
+CONFIRMED = 5
+UNNOTIFIED = 6
+FAILED = 9
+
+STATE_NAMES = {
+    CREATED: 'created',
+    WORK_READY: 'work_ready',
+    SENT: 'sent',
+    RECEIVED: 'received',
+    NOTIFIED: 'notified',
+    CONFIRMED: 'confirmed',
+    UNNOTIFIED: 'unnotified',
+    FAILED: 'failed'
+}
+
+# Errors that show the node refused a send, so its block was never published.  Any other error, e.g. a timeout or a
+# database error after the send, may hide a published block: such a tip is sent again with the same id instead,
+# which gets its hash back from the node.
+REFUSED = (nano.rpc.RPCException, NodeBusyError)
+
+# Largest number of tips looked at by one scheduler pass
+SCAN_LIMIT = 500
+
+counters = dict({name: 0 for name in STATE_NAMES.values()}, retried=0, passes=0)
+backlog = {}
+started = time.monotonic()
+
+
+def start_scheduler(settings):
+    """
+    Spawn the green thread that retries stalled tips and tracks their confirmation
+    """
+    eventlet.spawn(scheduler)
+
+
+def scheduler():
+    while True:
+        eventlet.sleep(get_settings().tip_scheduler_interval)
+        try:
+            with db.database.connection_context():
+                # Only one process per database advances tips, the others sit the pass out
+                with db.leader_lock('tip-scheduler') as leader:
+                    if leader:
+                        advance_tips()
+        except Exception as e:
+            logging.info("{}: Tip scheduler error: {}".format(datetime.datetime.utcnow(), e))
+
+
+def create_tip(message, users_to_tip, tip_index):
+    """
+    Record the tip as CREATED.  Returns None when the update was delivered before and its tip is recorded already.
+    """
+    tip = db.set_db_data_tip(message, users_to_tip, tip_index, CREATED)
+    if tip is not None:
+        counters[STATE_NAMES[CREATED]] += 1
+    return tip
+
+
+def advance(tip_id, state, **fields):
+    """
+    Move the tip forward to state.  Moving to a state the tip has already reached is a no-op, which makes every
+    step safe to repeat.
+    """
+    updated = advance_query(tip_id, state, datetime.datetime.utcnow(), **fields).execute()
+    if updated:
+        counters[STATE_NAMES[state]] += 1
+    return updated
+
+
+def record_failure(tip_id, refused=False):
+    """
+    Count a failed step.  The scheduler retries the tip until it runs out of attempts.  Then a tip that never got
+    work is FAILED, and so is a WORK_READY one whose send the node refused; any other WORK_READY tip may have been
+    published and is left for reconciliation.  A sent one keeps its state, its funds wait in the receiver's account
+    for their next receive.
+    """
+    attempt_query(tip_id, datetime.datetime.utcnow()).execute()
+    fail(tip_id, exhausted(get_settings().tip_max_attempts, refused))
+
+
+def exhausted(max_attempts, refused=False):
+    # The tips record_failure() gives up on
+    condition = db.Tip.attempts >= max_attempts
+    if not refused:
+        condition &= db.Tip.processed == CREATED
+    return condition
+
+
+def fail(tip_id, condition=None):
+    """
+    Give up on a tip whose send block was not published
+    """
+    if fail_query(tip_id, condition).execute():
+        counters[STATE_NAMES[FAILED]] += 1
+        logging.info("{}: Tip {} failed for good".format(datetime.datetime.utcnow(), tip_id))
+
+
+def advance_query(tip_id, state, updated_ts, **fields):
+    return db.Tip.update(processed=state, updated_ts=updated_ts, **fields).where(
+        (db.Tip.id == tip_id) & (db.Tip.processed < state))
+
+
+def attempt_query(tip_id, updated_ts):
+    return db.Tip.update(attempts=db.Tip.attempts + 1, updated_ts=updated_ts).where(db.Tip.id == tip_id)
+
+
+def fail_query(tip_id, condition=None):
+    query = db.Tip.update(processed=FAILED).where((db.Tip.id == tip_id) & (db.Tip.processed < SENT))
+    if condition is not None:
+        query = query.where(condition)
+    return query
+
+
+def advance_tips():
+    counters['passes'] += 1
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=get_settings().tip_retry_after)
+    stalled = db.Tip.select().where(
+        (db.Tip.processed << [CREATED, WORK_READY, SENT, RECEIVED]) &
+        (db.Tip.updated_ts < cutoff) & (db.Tip.attempts < get_settings().tip_max_attempts) &
+        ((db.Tip.processed < SENT) | db.Tip.send_hash.is_null(False))).order_by(db.Tip.id).limit(SCAN_LIMIT)
+    for tip in stalled:
+        if not retry_tip(tip):
+            break
+    confirm_tips()
+    count_backlog()
+
+
+def retry_tip(tip):
+    """
+    Repeat the steps the tip has not finished yet.  Returns False when the node is busy and the pass should stop.
+    """
+    counters['retried'] += 1
+    try:
+        sender = users.get_user(tip.sender_id)
+        receiver = users.get_user(tip.receiver_id)
+        if tip.processed < SENT:
+            actors.run_for_account(sender.account, currency.send_tip_block, tip.id)
+        if tip.processed < RECEIVED:
+            currency.receive_tip(tip.id, receiver.account)
+        tip_amount_text = str(BananoConversions.raw_to_banano(tip.amount_raw))
+        currency.notify_tip(tip.id, receiver.user_id, sender.user_name, tip_amount_text)
+    except NodeBusyError:
+        return False
+    except Exception as e:
+        logging.info("{}: Retrying tip {} failed: {}".format(datetime.datetime.utcnow(), tip.id, e))
+        record_failure(tip.id, refused=isinstance(e, REFUSED))
+    return True
+
+
+def confirm_tips():
+    """
+    Mark notified tips CONFIRMED once their send block is confirmed and no longer pending at the receiver.  Sends
+    that are still pending get another receive.
+    """
+    notified = list(db.Tip.select(db.Tip.id, db.Tip.send_hash, db.Tip.receiver).where(
+        (db.Tip.processed == NOTIFIED) & db.Tip.send_hash.is_null(False)).order_by(db.Tip.id).limit(SCAN_LIMIT))
+    for start in range(0, len(notified), batching.MAX_BATCH):
+        chunk = notified[start:start + batching.MAX_BATCH]
+        try:
+            blocks = clients.rpc.blocks_info([tip.send_hash for tip in chunk], pending=True)
+        except Exception as e:
+            logging.info("{}: Could not check tip confirmations: {}".format(datetime.datetime.utcnow(), e))
+            continue
+        for tip in chunk:
+            info = blocks.get(tip.send_hash)
+            if info is None:
+                continue
+            if info.get('pending'):
+                currency.receive_pending(users.get_user(tip.receiver_id).account)
+            elif str(info.get('confirmed', '')).lower() == 'true':
+                advance(tip.id, CONFIRMED)
+
+
+def count_backlog():
+    open_states = [CREATED, WORK_READY, SENT, RECEIVED, NOTIFIED]
+    rows = db.read(db.Tip.select(db.Tip.processed, fn.COUNT(db.Tip.id).alias('tips')).where(
+        (db.Tip.processed << open_states) &
+        ((db.Tip.processed < SENT) | db.Tip.send_hash.is_null(False))).group_by(db.Tip.processed))
+    counts = {row.processed: row.tips for row in rows}
+    backlog.clear()
+    backlog.update({STATE_NAMES[state]: counts.get(state, 0) for state in open_states})
+
+
+def stats():
+    """
+    Tips per open state as of the last scheduler pass, transition counters and confirmation throughput
+    """
+    elapsed = time.monotonic() - started
+    return {
+        'backlog': dict(backlog),
+        'counters': dict(counters),
+        'confirmed_per_minute': counters['confirmed'] * 60 / elapsed if elapsed else 0.0
+    }
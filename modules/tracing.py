@@ -0,0 +1,200 @@
+import atexit
+import contextlib
+import datetime
+import functools
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from modules.settings import get_settings
+
+# Traces waiting for the writer; when it falls this far behind further traces are dropped, never waited for
+QUEUE_SIZE = 10000
+
+# Seconds the writer keeps lines in its buffer while no new trace comes in
+FLUSH_INTERVAL = 1
+
+# Finished traces, read by the writer thread
+traces = queue.Queue(QUEUE_SIZE)
+
+# The trace of the update handled by the current green thread, or carried over to it (see bind())
+current = threading.local()
+
+sink = {'file': None, 'path': None}
+
+counters = {'traced': 0, 'written': 0, 'dropped': 0, 'files': 0, 'errors': 0}
+
+NO_TRACE = contextlib.nullcontext()
+
+
+class Trace():
+    """
+    Spans of one update: (stage, start and duration in seconds from the start of the update)
+    """
+
+    def __init__(self, update_id, kind):
+        self.update_id = update_id
+        self.kind = kind
+        self.spans = []
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.started = time.monotonic()
+        current.trace = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.monotonic() - self.started
+        current.trace = None
+        counters['traced'] += 1
+        record = {'u': self.update_id, 'k': self.kind, 't': round(self.wall, 3), 'ms': round(elapsed * 1000, 3),
+                  's': [[name, round(start * 1000, 3), round(seconds * 1000, 3)]
+                        for name, start, seconds in self.spans]}
+        if exc_type is not None:
+            record['e'] = exc_type.__name__
+        try:
+            traces.put_nowait(record)
+        except queue.Full:
+            counters['dropped'] += 1
+        return False
+
+    def add(self, name, started, seconds):
+        self.spans.append((name, started - self.started, seconds))
+
+
+def enabled():
+    return get_settings().trace_dir != ''
+
+
+def update(update, kind):
+    """
+    Context manager tracing the stages (see profiling.stage()) of one update.  Does nothing unless tracing is on.
+    """
+    if not enabled():
+        return NO_TRACE
+    update_id = update.get('update_id') if isinstance(update, dict) else None
+    return Trace(update_id, kind)
+
+
+def active():
+    return getattr(current, 'trace', None)
+
+
+@contextlib.contextmanager
+def bind(trace):
+    """
+    Record the stages of the current green thread into trace, e.g. work an actor does for the update
+    """
+    previous = active()
+    current.trace = trace
+    try:
+        yield
+    finally:
+        current.trace = previous
+
+
+def carry(func):
+    """
+    Wrap func to run with the current green thread's trace, for green threads spawned while handling an update
+    """
+    trace = active()
+    if trace is None:
+        return func
+
+    @functools.wraps(func)
+    def traced(*args, **kwargs):
+        with bind(trace):
+            return func(*args, **kwargs)
+    return traced
+
+
+def start_tracer(settings):
+    """
+    Start the thread that appends finished traces to rotating JSONL files in trace_dir
+    """
+    if not enabled():
+        return
+    os.makedirs(settings.trace_dir, exist_ok=True)
+    threading.Thread(target=writer, daemon=True).start()
+    atexit.register(close_sink)
+
+
+def writer():
+    while True:
+        try:
+            record = traces.get(timeout=FLUSH_INTERVAL)
+        except queue.Empty:
+            if sink['file'] is not None:
+                sink['file'].flush()
+            continue
+        try:
+            rotate()
+            sink['file'].write(json.dumps(record, separators=(',', ':')) + '\n')
+            counters['written'] += 1
+        except Exception as e:
+            counters['errors'] += 1
+            logging.info("{}: Could not write trace: {}".format(datetime.datetime.utcnow(), e))
+
+
+def rotate():
+    settings = get_settings()
+    if sink['file'] is not None:
+        if sink['file'].tell() < settings.trace_rotate_mb * 1024 * 1024:
+            return
+        close_sink()
+    name = 'traces-{}-{}.jsonl'.format(datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'), os.getpid())
+    sink['path'] = os.path.join(settings.trace_dir, name)
+    sink['file'] = open(sink['path'], 'a')
+    counters['files'] += 1
+
+
+def close_sink():
+    if sink['file'] is not None:
+        sink['file'].close()
+        sink['file'] = None
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def summarize(paths, kind=None):
+    """
+    Per-stage latency of the traces in paths (files or directories), optionally only updates of one triage kind.
+    Returns rows of (stage, count, p50, p90, p99, max, total) in milliseconds, the whole update first and the
+    stages by total time spent in them.
+    """
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(os.path.join(path, 'traces-*.jsonl'))) if os.path.isdir(path) else [path])
+
+    samples = {}
+    for path in files:
+        with open(path) as lines:
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of a file still being written
+                    continue
+                if kind is not None and record.get('k') != kind:
+                    continue
+                samples.setdefault('update', []).append(record['ms'])
+                for name, _, ms in record['s']:
+                    samples.setdefault(name, []).append(ms)
+
+    rows = []
+    for name, values in samples.items():
+        values.sort()
+        rows.append((name, len(values), percentile(values, 0.5), percentile(values, 0.9), percentile(values, 0.99),
+                     values[-1], sum(values)))
+    rows.sort(key=lambda row: (row[0] != 'update', -row[6]))
+    return rows
+
+
+def stats():
+    return dict(counters, backlog=traces.qsize(), path=sink['path'])
@@ -0,0 +1,72 @@
+import modules.social as social
+from modules.settings import get_settings
+
+# Triage outcomes, in the order they are checked
+OTHER = 'other'
+DIRECT = 'direct'
+FORWARDED = 'forwarded'
+SERVICE = 'service'
+NON_TEXT = 'non_text'
+BOT_SENDER = 'bot_sender'
+CHATTER = 'chatter'
+TIP = 'tip'
+
+# Outcomes answered by the fast path; everything else takes the full telegram_event path
+FAST_PATH = {OTHER, FORWARDED, NON_TEXT, BOT_SENDER, CHATTER}
+
+# Fast path outcomes that still count as the sender being active in the chat
+TOUCHES_MEMBER = {FORWARDED, NON_TEXT, CHATTER}
+
+SERVICE_KEYS = {'new_chat_member', 'left_chat_member', 'group_chat_created'}
+TIP_PREFIXES = ('.tip ', '.b ')
+
+counters = {outcome: 0 for outcome in (OTHER, DIRECT, FORWARDED, SERVICE, NON_TEXT, BOT_SENDER, CHATTER, TIP)}
+counters['unclassified'] = 0
+
+
+def classify_update(update):
+    """
+    Cheaply classify a raw Telegram update without touching the DB.  Returns None when the update is malformed,
+    so the full path can deal with it.
+    """
+    try:
+        message = update.get('message')
+        if message is None:
+            return OTHER
+        chat_type = message['chat']['type']
+        if chat_type == 'private':
+            return DIRECT
+        if chat_type != 'group' and chat_type != 'supergroup':
+            return OTHER
+        if 'forward_from' in message:
+            return FORWARDED
+        if 'text' not in message:
+            if SERVICE_KEYS & message.keys():
+                return SERVICE
+            return NON_TEXT
+        sender = message['from']
+        if sender.get('is_bot') or str(sender['id']) == str(get_settings().bot_id_telegram):
+            return BOT_SENDER
+        if not message['text'].replace('\n', ' ').lower().startswith(TIP_PREFIXES):
+            return CHATTER
+        return TIP
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+
+def count(outcome):
+    counters[outcome if outcome is not None else 'unclassified'] += 1
+
+
+def fast_path(outcome, update):
+    """
+    Handle a non-actionable update.  The only side effect is touching the membership cache.
+    """
+    if outcome in TOUCHES_MEMBER:
+        message = update['message']
+        social.touch_telegram_member(message['chat']['id'], message['chat'].get('title', ''),
+                                     message['from']['id'], social.get_screen_name(message['from']))
+
+
+def stats():
+    return dict(counters)
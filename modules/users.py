@@ -0,0 +1,140 @@
+import datetime
+import threading
+import time
+
+import modules.db as db
+
+# Seconds a user row stays in the process-wide cache
+USER_TTL = 300
+
+# Postgres channel announcing every user whose row changed, to every process caching it; heard by the listener of
+# balances.listen()
+CHANNEL = 'users'
+NOTIFY_SQL = "SELECT pg_notify('users', %s)"
+
+# user_id -> (user_name, account, register, wallet, expires) shared by every green thread in the process
+user_cache = {}
+
+# Request-scoped identity map, green thread local once eventlet has monkey patched threading
+identity = threading.local()
+
+counters = {'identity_hits': 0, 'hits': 0, 'misses': 0, 'invalidations': 0, 'notifications': 0}
+
+
+def begin_request():
+    identity.users = {}
+
+
+def end_request():
+    identity.users = None
+
+
+def get_user(user_id):
+    """
+    Return the db.User for user_id from the request identity map, the process cache or the DB, in that order.
+    Raises db.User.DoesNotExist like a query would.
+    """
+    user_id = int(user_id)
+    users = getattr(identity, 'users', None)
+    if users is not None and user_id in users:
+        counters['identity_hits'] += 1
+        return users[user_id]
+
+    user = cached_user(user_id)
+    if user is None:
+        user = db.read(user_query(user_id), one=True, key=('user', user_id))
+        cache_user(user)
+
+    if users is not None:
+        users[user_id] = user
+    return user
+
+
+def user_query(user_id):
+    return db.User.select().where(db.User.user_id == user_id)
+
+
+def register_query(user_id):
+    return db.User.update(register=1).where((db.User.user_id == user_id) & (db.User.register == 0))
+
+
+def cached_user(user_id):
+    """
+    Return the db.User for user_id from the process cache, or None when it has to be read from the DB
+    """
+    cached = user_cache.get(user_id)
+    if cached is None or cached[4] <= time.monotonic():
+        counters['misses'] += 1
+        return None
+    counters['hits'] += 1
+    return db.User(user_id=user_id, user_name=cached[0], account=cached[1], register=cached[2], wallet=cached[3])
+
+
+def cache_user(user, ttl=USER_TTL):
+    user_cache[user.user_id] = (user.user_name, user.account, user.register, user.wallet,
+                                time.monotonic() + ttl)
+
+
+def drop(user_id):
+    """
+    Forget the user in this process
+    """
+    user_id = int(user_id)
+    counters['invalidations'] += 1
+    user_cache.pop(user_id, None)
+    users = getattr(identity, 'users', None)
+    if users is not None:
+        users.pop(user_id, None)
+
+
+def invalidate(user_id):
+    """
+    Called by every code path that changes a user row.  Every other process drops the user too once the
+    surrounding transaction, if any, commits.
+    """
+    drop(user_id)
+    db.database.execute_sql(NOTIFY_SQL, (str(int(user_id)),))
+
+
+def heard(user_id):
+    """
+    Another process changed the user's row
+    """
+    counters['notifications'] += 1
+    drop(user_id)
+
+
+def mark_registered(user_id):
+    """
+    Flag an existing account as registered with the tip bot
+    """
+    register_query(int(user_id)).execute()
+    db.wrote(('user', int(user_id)))
+    invalidate(user_id)
+
+
+def create_user(user_id, user_name, account, register, wallet):
+    """
+    Insert a new user row for an account created in wallet.  Returns the number of rows inserted, like Model.save().
+    """
+    user = db.User(
+        user_id = int(user_id),
+        user_name = user_name,
+        account = account,
+        register = register,
+        created_ts = datetime.datetime.utcnow(),
+        wallet = wallet
+    )
+    inserted = user.save(force_insert=True)
+    db.wrote(('user', int(user_id)))
+    invalidate(user_id)
+    return inserted
+
+
+def stats():
+    lookups = counters['identity_hits'] + counters['hits'] + counters['misses']
+    return {
+        'cached_users': len(user_cache),
+        'counters': dict(counters),
+        'hit_rate': (lookups - counters['misses']) / lookups if lookups else 0.0
+    }
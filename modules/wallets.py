@@ -0,0 +1,145 @@
+import contextlib
+import datetime
+import hashlib
+import logging
+
+import nano
+
+import modules.clients as clients
+import modules.db as db
+import modules.users as users
+from modules.settings import get_settings
+
+# Node error for a wallet-bound call naming a wallet that does not hold the account
+NOT_IN_WALLET = 'account not found in wallet'
+
+# Accounts moved per account_move call, all locked for the length of one transaction
+MOVE_BATCH = 100
+
+# account -> node wallet holding its key, shared by every green thread in the process.  An account only changes
+# wallet when shard() moves it, and call() notices that the node no longer finds it where the cache says.
+owners = {}
+
+
+def assign(user_id):
+    """
+    The wallet a new account of user_id is created in: a stable hash of the id over the configured wallets
+    """
+    wallets = get_settings().wallets
+    digest = hashlib.blake2b(str(int(user_id)).encode('utf-8'), digest_size=8).digest()
+    return wallets[int.from_bytes(digest, 'big') % len(wallets)]
+
+
+def create_account(user_id, work=True):
+    """
+    Create an account for user_id in its wallet.  Returns (account, wallet).
+    """
+    wallet = assign(user_id)
+    account = clients.rpc.account_create(wallet="{}".format(wallet), work=work)
+    owners[account] = wallet
+    return account, wallet
+
+
+def owner(account):
+    """
+    The wallet holding account: the one stored with its user, or the default wallet for accounts created before
+    wallets were sharded and for accounts no user owns (e.g. an airdrop source)
+    """
+    wallet = owners.get(account)
+    if wallet is None:
+        wallet = stored(account)
+        owners[account] = wallet
+    return wallet
+
+
+def stored(account):
+    # The primary answers: a replica could still hold the wallet from before a move
+    user = wallet_query(account).first()
+    return (user.wallet if user is not None else None) or get_settings().wallet
+
+
+def wallet_query(account):
+    return db.User.select(db.User.wallet).where(db.User.account == account)
+
+
+def remember(account, wallet):
+    owners[account] = wallet or get_settings().wallet
+
+
+def moved(error):
+    return NOT_IN_WALLET in str(error).lower()
+
+
+def call(wallet_account, method, **params):
+    """
+    Run a wallet-bound RPC method (send, receive) in the wallet holding wallet_account.  When the node does not find
+    the account there, because shard() moved it since its owner was cached, the owner is read again and the call
+    repeated once.
+    """
+    wallet = owner(wallet_account)
+    try:
+        return getattr(clients.rpc, method)(wallet="{}".format(wallet), **params)
+    except nano.rpc.RPCException as e:
+        if not moved(e):
+            raise
+        owners.pop(wallet_account, None)
+        if owner(wallet_account) == wallet:
+            raise
+        logging.info("{}: {} moved from wallet {} to {}".format(
+            datetime.datetime.utcnow(), wallet_account, wallet, owners[wallet_account]))
+        return getattr(clients.rpc, method)(wallet="{}".format(owners[wallet_account]), **params)
+
+
+def shard(batch=MOVE_BATCH, record_only=False):
+    """
+    Give every user without a stored wallet one.  Their accounts are all in the default wallet: each is moved with
+    account_move to the wallet assign() picks, or with record_only stays there and only the column is filled in.
+    Every batch is moved while its accounts are locked and recorded in the same transaction, so no send or receive
+    runs against the old wallet halfway and an interrupted run is simply started again.  Returns a summary.
+    """
+    settings = get_settings()
+    summary = {'users': 0, 'moved': 0, 'recorded': 0, 'errors': 0}
+    with db.database.connection_context():
+        unassigned = [(user.user_id, user.account) for user in db.User.select(db.User.user_id, db.User.account).where(
+            db.User.wallet.is_null()).order_by(db.User.user_id)]
+    summary['users'] = len(unassigned)
+
+    targets = {}
+    for user_id, account in unassigned:
+        target = settings.wallet if record_only else assign(user_id)
+        targets.setdefault(target, []).append((user_id, account))
+    for target, owned in targets.items():
+        for start in range(0, len(owned), batch):
+            chunk = owned[start:start + batch]
+            try:
+                with db.database.connection_context():
+                    shard_batch(settings.wallet, target, chunk, summary)
+            except Exception as e:
+                summary['errors'] += len(chunk)
+                logging.info("{}: Could not move {} accounts to wallet {}: {}".format(
+                    datetime.datetime.utcnow(), len(chunk), target, e))
+    return summary
+
+
+def shard_batch(source, target, chunk, summary):
+    with contextlib.ExitStack() as locks:
+        for _, account in chunk:
+            locks.enter_context(db.account_lock(account))
+        if target != source:
+            accounts = [account for _, account in chunk]
+            try:
+                clients.rpc.account_move(source=source, wallet=target, accounts=accounts)
+            except nano.rpc.RPCException as e:
+                if not moved(e):
+                    raise
+                # A run that died between the move and its commit left some of them in the target already
+                accounts = [account for account in accounts if not clients.rpc.wallet_contains(target, account)]
+                if accounts:
+                    clients.rpc.account_move(source=source, wallet=target, accounts=accounts)
+            summary['moved'] += len(accounts)
+        db.User.update(wallet=target).where(db.User.user_id << [user_id for user_id, _ in chunk]).execute()
+        for user_id, _ in chunk:
+            users.invalidate(user_id)
+        summary['recorded'] += len(chunk)
+    for user_id, account in chunk:
+        owners[account] = target
@@ -0,0 +1,179 @@
+import datetime
+import logging
+import time
+
+import eventlet
+from peewee import SQL, Tuple, fn
+
+import modules.batching as batching
+import modules.clients as clients
+import modules.currency as currency
+import modules.db as db
+import modules.social as social
+import modules.users as users
+import modules.wallets as wallets
+
+# Rows read from the DB per chunk
+CHUNK_SIZE = 1000
+
+# Seconds warmed users stay cached.  Longer than users.USER_TTL so the warm-up outlasts the first minutes of traffic;
+# the fields that change are safe to read stale: mark_registered() is idempotent and wallets.call() finds a moved
+# account's wallet again.
+WARM_USER_TTL = 3600
+
+# Most active tip senders whose frontiers are loaded and whose next work is precomputed
+WORK_ACCOUNTS = 500
+
+# work_generate calls running at once while precomputing
+WORK_CONCURRENCY = 4
+
+progress = {'ready': False, 'users': 0, 'members': 0, 'frontiers': 0, 'work_queued': 0, 'seconds': 0.0,
+            'timed_out': False}
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised when the warm-up runs past its time budget
+    """
+
+
+def start_warmup(settings):
+    """
+    Prime the caches in the background.  The worker serves traffic meanwhile but only reports ready once done.
+    """
+    if settings.warmup_budget <= 0:
+        progress['ready'] = True
+        return
+    eventlet.spawn(warm_up, settings)
+
+
+def warm_up(settings):
+    started = time.monotonic()
+    deadline = started + settings.warmup_budget
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=settings.warmup_days)
+    # Readiness does not wait for the work, and only one process per database computes it
+    eventlet.spawn(warm_work, cutoff)
+    try:
+        with db.database.connection_context():
+            warm_users(cutoff, deadline)
+            warm_members(cutoff, deadline)
+    except BudgetExceeded:
+        progress['timed_out'] = True
+        logging.info("{}: Warm-up ran out of its {}s budget".format(
+            datetime.datetime.utcnow(), settings.warmup_budget))
+    except Exception as e:
+        logging.info("{}: Warm-up failed: {}".format(datetime.datetime.utcnow(), e))
+    finally:
+        progress['seconds'] = time.monotonic() - started
+        progress['ready'] = True
+        log_progress('finished')
+
+
+def log_progress(step):
+    logging.info("{}: Warm-up {}: {} users, {} chat members, {} frontiers, {} work precomputations queued".format(
+        datetime.datetime.utcnow(), step, progress['users'], progress['members'], progress['frontiers'],
+        progress['work_queued']))
+
+
+def check_budget(deadline):
+    # Yield between chunks so the warm-up never holds up requests
+    eventlet.sleep(0)
+    if time.monotonic() > deadline:
+        raise BudgetExceeded()
+
+
+def pages(query, *order, descending=False):
+    """
+    Stream the rows of query CHUNK_SIZE at a time through db.read(), paging on the unique order of the fields
+    """
+    query = query.order_by(*[field.desc() if descending else field for field in order]).limit(CHUNK_SIZE)
+    page = db.read(query)
+    while page:
+        yield page
+        if len(page) < CHUNK_SIZE:
+            return
+        last = Tuple(*[getattr(page[-1], field.name) for field in order])
+        page = db.read(query.where(Tuple(*order) < last if descending else Tuple(*order) > last))
+
+
+def active_user_ids(cutoff):
+    """
+    Users that sent or received a tip since cutoff
+    """
+    return (db.Tip.select(db.Tip.sender).where(db.Tip.created_ts >= cutoff) |
+            db.Tip.select(db.Tip.receiver).where(db.Tip.created_ts >= cutoff))
+
+
+def warm_users(cutoff, deadline):
+    query = db.User.select().where(
+        (db.User.user_id << active_user_ids(cutoff)) | (db.User.created_ts >= cutoff))
+    for page in pages(query, db.User.user_id):
+        for user in page:
+            users.cache_user(user, WARM_USER_TTL)
+            wallets.remember(user.account, user.wallet)
+        progress['users'] += len(page)
+        log_progress('users')
+        check_budget(deadline)
+
+
+def warm_members(cutoff, deadline):
+    """
+    Cache the newest memberships of active users, at most as many as the member cache holds.  They are cached
+    oldest first, so the newest are the last the cache evicts.
+    """
+    member = db.TelegramChatMember
+    query = member.select(member.id, member.chat_id, member.member_id, member.created_ts).where(
+        (member.member_id << active_user_ids(cutoff)) | (member.created_ts >= cutoff))
+    keys = []
+    try:
+        for page in pages(query, member.created_ts, member.id, descending=True):
+            keys.extend((int(row.chat_id), int(row.member_id)) for row in page[:social.MEMBER_CACHE_SIZE - len(keys)])
+            progress['members'] = len(keys)
+            log_progress('chat members')
+            if len(keys) >= social.MEMBER_CACHE_SIZE:
+                break
+            check_budget(deadline)
+    finally:
+        for key in reversed(keys):
+            social.cache_telegram_member(key)
+
+
+def warm_work(cutoff):
+    """
+    Load the frontiers of the busiest senders in batches and precompute the work for their next block into the
+    shared work_cache table, which every process's get_pow() reads.  The process holding the lock does it for all
+    of them; one starting later only computes what is missing for a frontier that has moved since.
+    """
+    try:
+        with db.database.connection_context():
+            with db.leader_lock('warmup-work') as leader:
+                if not leader:
+                    return
+                senders = db.read(db.Tip.select(db.Tip.sender, fn.COUNT(db.Tip.id).alias('tips')).where(
+                    db.Tip.created_ts >= cutoff).group_by(db.Tip.sender).order_by(SQL('tips').desc()).limit(
+                    WORK_ACCOUNTS))
+                accounts = [users.get_user(tip.sender_id).account for tip in senders]
+                for start in range(0, len(accounts), batching.MAX_BATCH):
+                    # Frontiers feed PoW, so like the batched loader they come from the wallet node
+                    frontiers = clients.rpc.wallet_node.accounts_frontiers(accounts[start:start + batching.MAX_BATCH])
+                    progress['frontiers'] += len(frontiers)
+                    stored = {row.account: row.frontier for row in db.WorkCache.select().where(
+                        db.WorkCache.account << list(frontiers))}
+                    missing = {account: frontier_hash for account, frontier_hash in frontiers.items()
+                               if stored.get(account) != frontier_hash}
+                    progress['work_queued'] += len(missing)
+                    log_progress('frontiers')
+                    precompute_work(missing)
+    except Exception as e:
+        logging.info("{}: Work warm-up failed: {}".format(datetime.datetime.utcnow(), e))
+
+
+def precompute_work(frontiers):
+    pool = eventlet.GreenPool(WORK_CONCURRENCY)
+    for account, frontier_hash in frontiers.items():
+        pool.spawn_n(currency.share_work, account, frontier_hash)
+    pool.waitall()
+
+
+def stats():
+    return dict(progress)
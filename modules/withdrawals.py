@@ -0,0 +1,253 @@
+import datetime
+import logging
+import time
+from decimal import Decimal
+
+import eventlet
+import nano
+from eventlet.queue import LightQueue
+
+import modules.actors as actors
+import modules.balances as balances
+import modules.batching as batching
+import modules.clients as clients
+import modules.currency as currency
+import modules.db as db
+import modules.social as social
+import modules.wallets as wallets
+from modules.conversion import BananoConversions
+from modules.resilience import NodeBusyError
+from modules.settings import get_settings
+
+# Withdrawal states, stored in withdrawals.status.  A withdrawal becomes SENDING once its amount is decided and
+# committed, right before its send; a SENDING withdrawal is sent again as decided, never validated again.
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+# Withdrawal ids waiting for a free executor green thread
+pending = LightQueue()
+
+INVALID_ADDRESS_TEXT = (
+    "The account address you provided is invalid.  Please double check and resend your request.")
+TOO_MUCH_TEXT = (
+    "You do not have that much BAN in your account.  To withdraw your full amount, send .withdraw <account>")
+
+counters = {'queued': 0, 'sending': 0, 'sent': 0, 'failed': 0, 'retried': 0}
+latency = {'total': 0.0, 'max': 0.0}
+started = time.monotonic()
+
+
+def start_executor(settings):
+    """
+    Spawn the bounded pool of executor green threads and resume withdrawals left over by a previous worker
+    """
+    for _ in range(settings.withdraw_concurrency):
+        eventlet.spawn(executor)
+    eventlet.spawn(resume_withdrawals)
+
+
+def executor():
+    while True:
+        withdrawal_id = pending.get()
+        try:
+            with db.database.connection_context():
+                process_withdrawal(withdrawal_id)
+        except Exception as e:
+            logging.info("{}: Withdrawal {} executor error: {}".format(
+                datetime.datetime.utcnow(), withdrawal_id, e))
+
+
+def resume_withdrawals():
+    try:
+        with db.database.connection_context():
+            for withdrawal in leftovers_query():
+                pending.put(withdrawal.id)
+    except Exception as e:
+        logging.info("{}: Could not resume queued withdrawals: {}".format(
+            datetime.datetime.utcnow(), e))
+
+
+def leftovers_query():
+    # Withdrawals a stopped process queued or started sending
+    return db.Withdrawal.select(db.Withdrawal.id).where(
+        db.Withdrawal.status << [QUEUED, SENDING]).order_by(db.Withdrawal.id)
+
+
+def queue_withdrawal(user, receiver_account, amount_raw):
+    """
+    Record the withdrawal and hand it to the executor.  amount_raw of None withdraws the full balance.
+    """
+    now = datetime.datetime.utcnow()
+    withdrawal = db.Withdrawal.create(
+        user=user,
+        sender_account=user.account,
+        receiver_account=receiver_account,
+        amount_raw=amount_raw,
+        status=QUEUED,
+        created_ts=now,
+        updated_ts=now)
+    db.wrote(('user', user.user_id))
+    counters[QUEUED] += 1
+    pending.put(withdrawal.id)
+    return withdrawal
+
+
+def set_status(withdrawal, status, send_hash=None, error=None):
+    withdrawal.status = status
+    withdrawal.send_hash = send_hash
+    withdrawal.error = error
+    withdrawal.updated_ts = datetime.datetime.utcnow()
+    withdrawal.save()
+    db.wrote(('user', withdrawal.user_id))
+    counters[status] += 1
+
+
+def process_withdrawal(withdrawal_id):
+    withdrawal = db.Withdrawal.get_by_id(withdrawal_id)
+    if withdrawal.status not in (QUEUED, SENDING):
+        return
+    try:
+        actors.run_for_account(withdrawal.sender_account, send_withdrawal, withdrawal_id)
+    except NodeBusyError:
+        # Leave the node alone until the breaker has cooled down, then try again
+        retry_later(withdrawal_id)
+    except Exception as e:
+        withdrawal = db.Withdrawal.get_by_id(withdrawal_id)
+        if resend(withdrawal.status, e):
+            logging.info("{}: Withdrawal {} may have been sent, sending it again later: {}".format(
+                datetime.datetime.utcnow(), withdrawal_id, e))
+            retry_later(withdrawal_id)
+            return
+        logging.info("{}: Withdrawal {} failed: {}".format(
+            datetime.datetime.utcnow(), withdrawal_id, e))
+        set_status(withdrawal, FAILED, error=str(e)[:255])
+        social.send_dm(withdrawal.user_id, failed_text(withdrawal_id))
+
+
+def retry_later(withdrawal_id):
+    counters['retried'] += 1
+    eventlet.spawn_after(get_settings().breaker_cooldown, pending.put, withdrawal_id)
+
+
+def resend(status, error):
+    """
+    Whether a withdrawal whose send raised error is sent again later instead of failing.  Once it is SENDING its
+    block may have been published, and only a refusal by the node proves it was not.  The send is repeated with
+    the same id, so a published block is not sent twice: the node returns its hash.
+    """
+    return status == SENDING and not isinstance(error, nano.rpc.RPCException)
+
+
+def failed_text(withdrawal_id):
+    return "Your withdraw request #{} could not be sent.  Please try again later.".format(withdrawal_id)
+
+
+def withdrawn_text(withdraw_amount_raw, send_hash):
+    return "You have successfully withdrawn {} BANANO!  Hash: {}".format(
+        BananoConversions.raw_to_banano(withdraw_amount_raw), send_hash)
+
+
+def check_withdrawal(sender_account, amount_raw, receiver_valid, balance):
+    """
+    Decide how much to withdraw.  Returns (amount_raw, None), or (None, reason) when the withdrawal is rejected.
+    """
+    if not receiver_valid:
+        return None, INVALID_ADDRESS_TEXT
+    if balance == 0:
+        return None, ("You have 0 balance in your account.  Please deposit to your address {} to "
+                      "send more tips!".format(sender_account))
+    if amount_raw is None:
+        return balance, None
+    if Decimal(int(amount_raw)) > Decimal(balance):
+        return None, TOO_MUCH_TEXT
+    return int(amount_raw), None
+
+
+def fail_withdrawal(withdrawal, reason_text):
+    set_status(withdrawal, FAILED, error=reason_text[:255])
+    social.send_dm(withdrawal.user_id, reason_text)
+    logging.info("{}: Withdrawal {} rejected: {}".format(
+        datetime.datetime.utcnow(), withdrawal.id, reason_text))
+
+
+def send_withdrawal(withdrawal_id):
+    """
+    Validate a queued withdrawal against the sender's balance and send it while holding the sender's lock.  The
+    amount is committed with the SENDING state before the send; a withdrawal resumed in SENDING skips the
+    validation and is sent again as decided.
+    """
+    withdrawal = db.Withdrawal.get_by_id(withdrawal_id)
+    sender_account = withdrawal.sender_account
+    if withdrawal.status == QUEUED:
+        currency.receive_pending(sender_account)
+    currency.prepare_pow(sender_account)
+    with db.account_lock(sender_account):
+        # Re-read under the lock: another worker may have finished this withdrawal already
+        withdrawal = db.Withdrawal.get_by_id(withdrawal_id)
+        if withdrawal.status == QUEUED:
+            balance_return = batching.account_balance(sender_account)
+
+            receiver_valid = clients.rpc.validate_account_number(withdrawal.receiver_account) != 0
+            withdraw_amount_raw, reason_text = check_withdrawal(
+                sender_account, withdrawal.amount_raw, receiver_valid, balance_return['balance'])
+            if reason_text is not None:
+                fail_withdrawal(withdrawal, reason_text)
+                return
+            withdrawal.amount_raw = withdraw_amount_raw
+            set_status(withdrawal, SENDING)
+        elif withdrawal.status != SENDING:
+            return
+        withdraw_amount_raw = int(withdrawal.amount_raw)
+
+        # The id makes the send idempotent if a withdrawal is resumed after a restart
+        work = currency.get_pow(sender_account)
+        if work == '':
+            logging.info("{}: processed without work".format(
+                datetime.datetime.utcnow()))
+            send_hash = wallets.call(
+                sender_account, 'send',
+                source="{}".format(sender_account),
+                destination="{}".format(withdrawal.receiver_account),
+                amount=withdraw_amount_raw,
+                id="withdraw-{}".format(withdrawal.id))
+        else:
+            logging.info("{}: processed with work: {}".format(
+                datetime.datetime.utcnow(), work))
+            send_hash = wallets.call(
+                sender_account, 'send',
+                source="{}".format(sender_account),
+                destination="{}".format(withdrawal.receiver_account),
+                amount=withdraw_amount_raw,
+                work=work,
+                id="withdraw-{}".format(withdrawal.id))
+
+        balances.invalidate(sender_account)
+        currency.precache_work(sender_account, send_hash)
+        set_status(withdrawal, SENT, send_hash=send_hash)
+        record_latency(withdrawal.created_ts, withdrawal.updated_ts)
+
+    social.send_dm(withdrawal.user_id, withdrawn_text(withdraw_amount_raw, send_hash))
+    logging.info("{}: Withdraw {} processed.  Hash: {}".format(
+        datetime.datetime.utcnow(), withdrawal.id, send_hash))
+
+
+def record_latency(created_ts, sent_ts):
+    seconds = (sent_ts - created_ts).total_seconds()
+    latency['total'] += seconds
+    latency['max'] = max(latency['max'], seconds)
+
+
+def stats():
+    """
+    Executor backlog, outcome counters, queue-to-send latency and throughput
+    """
+    elapsed = time.monotonic() - started
+    return {
+        'backlog': pending.qsize(),
+        'counters': dict(counters),
+        'avg_latency': latency['total'] / counters[SENT] if counters[SENT] else 0.0,
+        'max_latency': latency['max'],
+        'sent_per_minute': counters[SENT] * 60 / elapsed if elapsed else 0.0
+    }
@@ -0,0 +1,60 @@
+"""
+Serve the simulated Banano node RPC and Telegram Bot API on localhost for offline load tests.
+
+Point the bot at them through its config (node_ip: http://127.0.0.1:7072, telegram_api: http://127.0.0.1:8081)
+and post updates to it.  Latency and failure injection can be changed while the test runs:
+
+    python simulator.py --latency 0.2 --failure-rate 0.01 --opening-balance 1000000000000000000000000000000
+    curl -d '{"stall_rate": 0.05}' http://127.0.0.1:7072/_sim/config
+    curl http://127.0.0.1:7072/_sim/stats http://127.0.0.1:8081/_sim/stats
+"""
+import argparse
+import asyncio
+import json
+
+from modules.simulator import SimulatedNode, SimulatedTelegram, serve
+
+
+async def run(args):
+    node = SimulatedNode(latency=args.latency, block_latency=args.block_latency, work_latency=args.work_latency,
+                         failure_rate=args.failure_rate, stall_rate=args.stall_rate, stall=args.stall,
+                         opening_balance=args.opening_balance, callback_url=args.callback_url)
+    telegram = SimulatedTelegram(latency=args.telegram_latency, flood_limits=not args.no_flood_limits)
+    node_runner, node_url = await serve(node.app(), args.host, args.node_port)
+    telegram_runner, telegram_url = await serve(telegram.app(), args.host, args.telegram_port)
+    print("node_ip: {}\ntelegram_api: {}".format(node_url, telegram_url))
+    try:
+        while True:
+            await asyncio.sleep(args.report)
+            print(json.dumps({'node': node.stats(), 'telegram': telegram.stats()}, sort_keys=True))
+    finally:
+        await telegram_runner.cleanup()
+        await node_runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--node-port', type=int, default=7072)
+    parser.add_argument('--telegram-port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every node call takes')
+    parser.add_argument('--block-latency', type=float, default=0.0, help='extra seconds to publish a block')
+    parser.add_argument('--work-latency', type=float, default=0.0, help='extra seconds to generate work')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of node calls answered with 500')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='fraction of node calls that hang')
+    parser.add_argument('--stall', type=float, default=60.0, help='seconds a stalled node call hangs')
+    parser.add_argument('--opening-balance', type=int, default=0,
+                        help='raw receivable for every account the node has not seen yet')
+    parser.add_argument('--callback-url', help="the bot's /callback/<token> URL, to push sent blocks to it")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='seconds every Bot API call takes')
+    parser.add_argument('--no-flood-limits', action='store_true', help='never answer sendMessage with 429')
+    parser.add_argument('--report', type=float, default=10.0, help='seconds between printed stats')
+    args = parser.parse_args()
+    try:
+        asyncio.get_event_loop().run_until_complete(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
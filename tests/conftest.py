@@ -0,0 +1,38 @@
+import configparser
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.settings import Settings, get_settings
+
+
+def make_settings(**values):
+    """
+    Settings parsed from a webhooks.ini holding only values, the rest at their defaults
+    """
+    config = configparser.ConfigParser()
+    config['webhooks'] = {key: str(value) for key, value in values.items()}
+    return Settings(config)
+
+
+@pytest.fixture(scope='session')
+def database():
+    """
+    The Postgres database of MY_CONF_DIR/webhooks.ini, which should be a scratch copy, with the tables created.
+    Tests that need it are skipped when it is not configured or cannot be reached.
+    """
+    if 'MY_CONF_DIR' not in os.environ:
+        pytest.skip('MY_CONF_DIR is not set')
+    import peewee
+    import modules.db as db
+
+    db.init_db(get_settings())
+    try:
+        db.create_tables()
+        db.migrate_tables()
+    except peewee.OperationalError as e:
+        pytest.skip('Postgres is not reachable: {}'.format(e))
+    return db.database
@@ -0,0 +1,149 @@
+"""
+Resuming an airdrop with modules/airdrop.py: payouts already sent are not sent again, failed ones are retried and
+a run stops after too many failures in a row.  The node is a fake that, like the real one, returns the first block
+for a send repeated with the same id.  Needs the Postgres database of MY_CONF_DIR.
+"""
+import datetime
+
+import nano
+import pytest
+
+import modules.airdrop as airdrop
+import modules.clients as clients
+import modules.db as db
+import modules.wallets as wallets
+
+NAME = 'test-airdrop-resume'
+SOURCE = 'ban_1airdropsource' + '1' * 46
+ROWS = 5
+
+
+class FakeNode():
+    """
+    Publishes sends by their id, refusing the sends to the lines in `refuse` and crashing the run on the line in
+    `crash`.  calls holds the line of every send, published or not.
+    """
+
+    def __init__(self, refuse=(), crash=None):
+        self.refuse = set(refuse)
+        self.crash = crash
+        self.published = {}
+        self.calls = []
+
+    def call(self, wallet_account, method, source, destination, amount, id, work=None):
+        assert (wallet_account, method, source) == (SOURCE, 'send', SOURCE)
+        line = int(id.rsplit('-', 1)[1])
+        self.calls.append(line)
+        if line == self.crash:
+            raise RuntimeError('worker died')
+        if line in self.refuse:
+            raise nano.rpc.RPCException('Insufficient balance')
+        return self.published.setdefault(id, '{:064X}'.format(len(self.published) + 1))
+
+    def accounts_frontiers(self, accounts):
+        return {account: '0' * 64 for account in accounts}
+
+    def work_generate(self, frontier_hash, use_peers=False):
+        return 'work'
+
+
+@pytest.fixture
+def drop(database, monkeypatch):
+    """
+    An airdrop of ROWS queued payouts to accounts, removed again afterwards
+    """
+    monkeypatch.setattr(airdrop, 'check_funds', lambda source, total_raw: None)
+    with database.connection_context():
+        clean_up()
+        now = datetime.datetime.utcnow()
+        drop = db.Airdrop.create(name=NAME, source_account=SOURCE, rows=ROWS, total_raw=ROWS, created_ts=now)
+        db.AirdropPayout.insert_many([
+            {'airdrop': drop.id, 'line': line, 'account': 'ban_1payout{}'.format(line) + '1' * 52, 'amount_raw': 1,
+             'status': airdrop.QUEUED, 'updated_ts': now} for line in range(1, ROWS + 1)]).execute()
+        yield drop
+        clean_up()
+
+
+def clean_up():
+    drop = airdrop.find(NAME)
+    if drop is not None:
+        db.AirdropPayout.delete().where(db.AirdropPayout.airdrop == drop.id).execute()
+        drop.delete_instance()
+
+
+def use(monkeypatch, node):
+    monkeypatch.setattr(clients, 'rpc', node, raising=False)
+    monkeypatch.setattr(wallets, 'call', node.call)
+
+
+def run(drop):
+    return airdrop.run(drop, False, lambda progress: None)
+
+
+def statuses(drop):
+    return [payout.status for payout in db.AirdropPayout.select().where(
+        db.AirdropPayout.airdrop == drop.id).order_by(db.AirdropPayout.line)]
+
+
+def test_a_resumed_airdrop_sends_only_what_is_left(drop, monkeypatch):
+    use(monkeypatch, FakeNode(crash=3))
+    with pytest.raises(RuntimeError):
+        run(drop)
+    assert statuses(drop) == [airdrop.SENT, airdrop.SENT] + [airdrop.QUEUED] * 3
+
+    node = FakeNode()
+    use(monkeypatch, node)
+    progress = run(drop)
+    assert node.calls == [3, 4, 5]
+    assert progress['sent'] == 3 and progress['queued'] == 3
+    assert statuses(drop) == [airdrop.SENT] * ROWS
+
+
+def test_a_send_published_before_a_crash_is_recorded_not_repeated(drop, monkeypatch):
+    node = FakeNode()
+    use(monkeypatch, node)
+    # The node published line 1, then the worker died before recording it
+    payout = db.AirdropPayout.get((db.AirdropPayout.airdrop == drop.id) & (db.AirdropPayout.line == 1))
+    first_hash = airdrop.send(drop, payout, 'work')
+
+    run(drop)
+    payout = db.AirdropPayout.get_by_id(payout.id)
+    assert payout.status == airdrop.SENT and payout.send_hash == first_hash
+    assert len(node.published) == ROWS
+
+
+def test_failed_payouts_are_retried_on_resume(drop, monkeypatch):
+    node = FakeNode(refuse=[2, 4])
+    use(monkeypatch, node)
+    progress = run(drop)
+    assert progress['failed'] == 2
+    # A refused send is tried once more with the node's own work before it counts as failed
+    assert node.calls == [1, 2, 2, 3, 4, 4, 5]
+    assert statuses(drop) == [airdrop.SENT, airdrop.FAILED, airdrop.SENT, airdrop.FAILED, airdrop.SENT]
+    assert db.AirdropPayout.get((db.AirdropPayout.airdrop == drop.id) &
+                                (db.AirdropPayout.line == 2)).error == 'Insufficient balance'
+
+    # Without a requeue a resumed run has nothing to do
+    node = FakeNode()
+    use(monkeypatch, node)
+    assert run(drop)['queued'] == 0 and node.calls == []
+
+    assert airdrop.requeue_failed(drop) == 2
+    run(drop)
+    assert node.calls == [2, 4]
+    assert statuses(drop) == [airdrop.SENT] * ROWS
+
+
+def test_a_run_stops_after_too_many_failures_in_a_row(drop, monkeypatch):
+    monkeypatch.setattr(airdrop, 'MAX_CONSECUTIVE_FAILURES', 2)
+    use(monkeypatch, FakeNode(refuse=range(1, ROWS + 1)))
+    with pytest.raises(nano.rpc.RPCException):
+        run(drop)
+    assert statuses(drop) == [airdrop.FAILED, airdrop.FAILED] + [airdrop.QUEUED] * 3
+
+    node = FakeNode()
+    use(monkeypatch, node)
+    airdrop.requeue_failed(drop)
+    run(drop)
+    assert node.calls == [1, 2, 3, 4, 5]
+    assert statuses(drop) == [airdrop.SENT] * ROWS
@@ -0,0 +1,175 @@
+"""
+Read routing, WRITE_PIN and circuit breaker failover of the node pool, against several simulated nodes.  Each node
+keeps its own ledger, so a read answered by a read node instead of the wallet node shows in the result.
+"""
+import asyncio
+import contextlib
+
+import aiohttp
+import pytest
+
+import modules.aioclients as aioclients
+import modules.nodepool as nodepool
+from modules.resilience import NodeBusyError
+from modules.simulator import SimulatedNode, serve
+
+from conftest import make_settings
+
+WALLET = 'w'
+SOURCE = 'ban_1source' + '1' * 53
+DESTINATION = 'ban_1destination' + '1' * 48
+
+# Raw every account opens with, received before it is sent from
+OPENING_BALANCE = 1000
+
+
+@contextlib.asynccontextmanager
+async def node_pool(*simulated, **values):
+    """
+    An AsyncNodePool with the first simulated node as the wallet node and the others as read nodes
+    """
+    runners = []
+    urls = []
+    for node in simulated:
+        runner, url = await serve(node.app())
+        runners.append(runner)
+        urls.append(url)
+    settings = make_settings(node_ip=urls[0], read_nodes=','.join(urls[1:]), rpc_retries=0, rpc_timeout=2,
+                             breaker_threshold=2, breaker_cooldown=60, **values)
+    aioclients.session = aiohttp.ClientSession()
+    try:
+        yield aioclients.AsyncNodePool(settings)
+    finally:
+        await aioclients.session.close()
+        for runner in runners:
+            await runner.cleanup()
+
+
+def calls(node, action):
+    return node.counters.get(action, 0)
+
+
+async def fund(pool, account):
+    # Receive the account's opening balance on the wallet node
+    pending = await pool.wallet_node.call('pending', {'account': account})
+    for block in pending['blocks']:
+        await pool.receive(WALLET, account, block)
+
+
+def test_reads_go_to_the_fastest_healthy_node():
+    async def scenario():
+        wallet, slow, fast = SimulatedNode(latency=0.05), SimulatedNode(latency=0.05), SimulatedNode()
+        async with node_pool(wallet, slow, fast) as pool:
+            for _ in range(10):
+                await pool.accounts_balances([SOURCE])
+            # Every node is measured once, then the fast one answers the rest
+            assert calls(wallet, 'accounts_balances') == 1
+            assert calls(slow, 'accounts_balances') == 1
+            assert calls(fast, 'accounts_balances') == 8
+
+            await pool.account_create(WALLET)
+            assert calls(wallet, 'account_create') == 1
+            assert calls(fast, 'account_create') == 0 and calls(slow, 'account_create') == 0
+
+    asyncio.run(scenario())
+
+
+def test_reads_of_a_written_account_stay_on_the_wallet_node(monkeypatch):
+    monkeypatch.setattr(nodepool, 'WRITE_PIN', 0.3)
+
+    async def scenario():
+        wallet, reader = SimulatedNode(opening_balance=OPENING_BALANCE), SimulatedNode(
+            opening_balance=OPENING_BALANCE)
+        async with node_pool(wallet, reader) as pool:
+            # Measure the wallet node as the slower one, so unpinned reads go to the read node
+            wallet.config['latency'] = 0.05
+            await pool.accounts_balances([SOURCE])
+            await pool.accounts_balances([SOURCE])
+            wallet.config['latency'] = 0.0
+            await fund(pool, SOURCE)
+            await pool.send(WALLET, SOURCE, DESTINATION, 100, 'pin-test')
+
+            # The read node never saw the send: only the wallet node knows the new balances
+            balances = await pool.accounts_balances([SOURCE, DESTINATION])
+            assert balances[SOURCE] == {'balance': OPENING_BALANCE - 100, 'pending': 0}
+            assert balances[DESTINATION]['pending'] == OPENING_BALANCE + 100
+            assert pool.counters['pinned_reads'] >= 1
+
+            # Accounts nobody wrote are still read from the read node
+            served = calls(reader, 'accounts_balances')
+            await pool.accounts_balances(['ban_1other' + '1' * 54])
+            assert calls(reader, 'accounts_balances') == served + 1
+
+            await asyncio.sleep(0.35)
+            pool.prune_pins()
+            assert await pool.accounts_balances([SOURCE]) == {SOURCE: {'balance': 0, 'pending': OPENING_BALANCE}}
+            assert calls(reader, 'accounts_balances') == served + 2
+
+    asyncio.run(scenario())
+
+
+def test_pinned_accounts_heard_about_from_elsewhere():
+    async def scenario():
+        wallet, reader = SimulatedNode(latency=0.05), SimulatedNode()
+        async with node_pool(wallet, reader) as pool:
+            await pool.accounts_balances([SOURCE])
+            await pool.accounts_balances([SOURCE])
+            pool.pin(DESTINATION)
+            served = calls(wallet, 'accounts_balances')
+            await pool.accounts_balances([DESTINATION])
+            assert calls(wallet, 'accounts_balances') == served + 1
+
+    asyncio.run(scenario())
+
+
+def test_failing_read_node_fails_over_and_opens_its_breaker():
+    async def scenario():
+        wallet, broken = SimulatedNode(latency=0.05), SimulatedNode(failure_rate=1.0)
+        async with node_pool(wallet, broken) as pool:
+            # The broken node never gets a latency sample, so it is tried before the wallet node until its breaker
+            # opens, and those reads fail over
+            for _ in range(5):
+                assert SOURCE in await pool.accounts_balances([SOURCE])
+            read_node = pool.nodes[1]
+            assert read_node.breaker.state == 'open'
+            # Two failures opened the breaker; after that the node is not called at all
+            assert calls(broken, 'accounts_balances') == 2
+            assert calls(wallet, 'accounts_balances') == 5
+            assert pool.read_candidates() == [pool.wallet_node]
+
+    asyncio.run(scenario())
+
+
+def test_unhealthy_nodes_are_skipped_until_they_recover():
+    async def scenario():
+        wallet, reader = SimulatedNode(), SimulatedNode()
+        async with node_pool(wallet, reader) as pool:
+            read_node = pool.nodes[1]
+            pool.probed(read_node, ConnectionError('probe failed'))
+            for _ in range(3):
+                await pool.accounts_balances([SOURCE])
+            assert calls(reader, 'accounts_balances') == 0
+
+            pool.probed(pool.wallet_node, ConnectionError('probe failed'))
+            # With no healthy node left, reads still go to the wallet node
+            assert pool.read_candidates() == [pool.wallet_node]
+
+            pool.probed(read_node)
+            await pool.accounts_balances([SOURCE])
+            assert calls(reader, 'accounts_balances') == 1
+
+    asyncio.run(scenario())
+
+
+def test_wallet_calls_do_not_fail_over():
+    async def scenario():
+        wallet, reader = SimulatedNode(failure_rate=1.0), SimulatedNode()
+        async with node_pool(wallet, reader) as pool:
+            for _ in range(2):
+                with pytest.raises(aiohttp.ClientError):
+                    await pool.account_create(WALLET)
+            with pytest.raises(NodeBusyError):
+                await pool.account_create(WALLET)
+            assert calls(reader, 'account_create') == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,169 @@
+"""
+The tip lifecycle of modules/tips.py: states only move forward, a tip is FAILED only when its send was refused or
+never got work, and a DM Telegram refuses leaves it UNNOTIFIED.  Needs the Postgres database of MY_CONF_DIR.
+"""
+import datetime
+
+import nano
+import pytest
+import requests
+import telegram
+
+import modules.actors as actors
+import modules.clients as clients
+import modules.currency as currency
+import modules.db as db
+import modules.tips as tips
+from modules.resilience import NodeBusyError
+from modules.settings import get_settings
+
+SENDER_ID = 300000961
+RECEIVER_ID = 300000962
+DM_ID = 99961
+
+
+@pytest.fixture
+def tip(database):
+    """
+    A CREATED tip between two test users, removed again afterwards
+    """
+    with database.connection_context():
+        clean_up()
+        now = datetime.datetime.utcnow()
+        for user_id in (SENDER_ID, RECEIVER_ID):
+            db.User.create(user_id=user_id, user_name='user{}'.format(user_id), account='ban_tips{}'.format(user_id),
+                           register=1, created_ts=now)
+        tip = tips.create_tip(tip_message(), [{'receiver_id': RECEIVER_ID}], 0)
+        yield tip
+        clean_up()
+
+
+def tip_message():
+    return {'id': DM_ID, 'tip_id': 1, 'sender_id': SENDER_ID, 'text': ['.tip', '1'], 'tip_amount': 1,
+            'tip_amount_raw': 10 ** 29}
+
+
+def clean_up():
+    db.Tip.delete().where(db.Tip.sender << [SENDER_ID, RECEIVER_ID]).execute()
+    db.User.delete().where(db.User.user_id << [SENDER_ID, RECEIVER_ID]).execute()
+
+
+def state(tip):
+    return db.Tip.get_by_id(tip.id).processed
+
+
+def exhaust(tip, **kwargs):
+    for _ in range(get_settings().tip_max_attempts):
+        tips.record_failure(tip.id, **kwargs)
+
+
+class FakeBot():
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+
+    def sendMessage(self, chat_id, text):
+        if self.error is not None:
+            raise self.error
+        self.sent.append((chat_id, text))
+
+
+def test_an_update_delivered_twice_records_its_tip_once(tip):
+    assert tip is not None
+    assert tips.create_tip(tip_message(), [{'receiver_id': RECEIVER_ID}], 0) is None
+    assert db.Tip.select().where(db.Tip.dm_id == DM_ID).count() == 1
+
+
+def test_states_only_move_forward(tip):
+    assert tips.advance(tip.id, tips.WORK_READY) == 1
+    assert tips.advance(tip.id, tips.SENT, send_hash='A' * 64) == 1
+    assert tips.advance(tip.id, tips.SENT, send_hash='B' * 64) == 0
+    assert tips.advance(tip.id, tips.WORK_READY) == 0
+    assert state(tip) == tips.SENT
+    assert db.Tip.get_by_id(tip.id).send_hash == 'A' * 64
+
+
+def test_a_tip_without_work_fails_once_out_of_attempts(tip):
+    for _ in range(get_settings().tip_max_attempts - 1):
+        tips.record_failure(tip.id)
+    assert state(tip) == tips.CREATED
+    tips.record_failure(tip.id)
+    assert state(tip) == tips.FAILED
+
+
+def test_a_tip_that_may_have_been_sent_is_not_failed(tip):
+    tips.advance(tip.id, tips.WORK_READY)
+    exhaust(tip)
+    assert state(tip) == tips.WORK_READY
+
+
+def test_a_refused_send_fails_the_tip(tip):
+    tips.advance(tip.id, tips.WORK_READY)
+    exhaust(tip, refused=True)
+    assert state(tip) == tips.FAILED
+
+
+def test_a_sent_tip_never_fails(tip):
+    tips.advance(tip.id, tips.SENT, send_hash='A' * 64)
+    exhaust(tip, refused=True)
+    tips.fail(tip.id)
+    assert state(tip) == tips.SENT
+
+
+@pytest.mark.parametrize('error, refused', [
+    (requests.exceptions.ReadTimeout('node timed out'), False),
+    (ConnectionError('database went away'), False),
+    (nano.rpc.RPCException('Insufficient balance'), True),
+])
+def test_retries_fail_only_refused_sends(tip, monkeypatch, error, refused):
+    def send(account, func, *args):
+        tips.advance(tip.id, tips.WORK_READY)
+        raise error
+
+    monkeypatch.setattr(actors, 'run_for_account', send)
+    for _ in range(get_settings().tip_max_attempts):
+        tips.retry_tip(db.Tip.get_by_id(tip.id))
+    assert state(tip) == (tips.FAILED if refused else tips.WORK_READY)
+
+
+def test_a_busy_node_stops_the_pass_without_counting_an_attempt(tip, monkeypatch):
+    def busy(account, func, *args):
+        raise NodeBusyError('breaker open')
+
+    monkeypatch.setattr(actors, 'run_for_account', busy)
+    assert tips.retry_tip(db.Tip.get_by_id(tip.id)) is False
+    assert db.Tip.get_by_id(tip.id).attempts == 0
+    assert state(tip) == tips.CREATED
+
+
+def test_a_delivered_dm_notifies_the_tip(tip, monkeypatch):
+    bot = FakeBot()
+    monkeypatch.setattr(clients, 'telegram_bot', bot, raising=False)
+    tips.advance(tip.id, tips.RECEIVED)
+    assert currency.notify_tip(tip.id, RECEIVER_ID, 'sender', '1') is True
+    assert state(tip) == tips.NOTIFIED
+    assert bot.sent[0][0] == RECEIVER_ID
+
+
+def test_a_refused_dm_leaves_the_tip_unnotified_for_good(tip, monkeypatch):
+    monkeypatch.setattr(clients, 'telegram_bot', FakeBot(telegram.error.Unauthorized('bot was blocked')),
+                        raising=False)
+    tips.advance(tip.id, tips.RECEIVED)
+    assert currency.notify_tip(tip.id, RECEIVER_ID, 'sender', '1') is False
+    assert state(tip) == tips.UNNOTIFIED
+    # Nothing moves an UNNOTIFIED tip on
+    tips.advance(tip.id, tips.NOTIFIED)
+    tips.advance(tip.id, tips.CONFIRMED)
+    assert state(tip) == tips.UNNOTIFIED
+
+
+def test_a_dm_that_failed_for_now_is_retried(tip, monkeypatch):
+    monkeypatch.setattr(clients, 'telegram_bot', FakeBot(telegram.error.TimedOut()), raising=False)
+    tips.advance(tip.id, tips.RECEIVED)
+    with pytest.raises(telegram.error.TimedOut):
+        currency.notify_tip(tip.id, RECEIVER_ID, 'sender', '1')
+    assert state(tip) == tips.RECEIVED
+
+    monkeypatch.setattr(clients, 'telegram_bot', FakeBot())
+    assert currency.notify_tip(tip.id, RECEIVER_ID, 'sender', '1') is True
+    assert state(tip) == tips.NOTIFIED
@@ -1,70 +1,314 @@
 from eventlet import monkey_patch
 monkey_patch()
 
-import configparser
-import os
 import logging
-import telegram
 import datetime
 from http import HTTPStatus
 import click
+import os
 import re
 
-from flask import Flask, render_template, request, g
+import nano
+from flask import Blueprint, Flask, current_app, render_template, request, g, jsonify
 
+import modules.actors as actors
+import modules.airdrop as airdrop
+import modules.balances as balances
+import modules.batching as batching
+import modules.clients as clients
 import modules.db as db
-
-# Read config and parse constants
-config = configparser.ConfigParser()
-config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
-logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
-
-# Telegram API
-TELEGRAM_KEY = config.get('webhooks', 'telegram_key')
-
-# IDs
-BOT_ID_TELEGRAM = config.get('webhooks', 'bot_id_telegram')
-SERVER_URL = config.get('webhooks', 'server_url')
-
-# Set up Flask routing
-app = Flask(__name__)
+import modules.deposits as deposits
+import modules.journal as journal
+import modules.orchestration as orchestration
+import modules.profiling as profiling
+import modules.reconcile as reconcile
+import modules.recorder as recorder
+import modules.sharding as sharding
+import modules.social as social
+import modules.throttle as throttle
+import modules.tips as tips
+import modules.tracing as tracing
+import modules.triage as triage
+import modules.users as users
+import modules.wallets as wallets
+import modules.warmup as warmup
+import modules.withdrawals as withdrawals
+from modules.conversion import BananoConversions
+from modules.resilience import NodeBusyError
+from modules.settings import get_settings
+
+# Routes and CLI commands are registered on the app built by create_app()
+bp = Blueprint('webhooks', __name__, cli_group=None)
+
+
+# Set once the background services of this process are running
+services = {'started': False}
+
+
+def create_app(serve=False):
+    """
+    App factory: parse the config once, connect the shared clients and register the routes.  A process that takes
+    updates passes serve=True (see tipbot.service) to start the background services as well; the CLI commands get
+    the app without them.
+    """
+    settings = get_settings()
+    logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+    db.init_db(settings)
+    clients.init_clients(settings)
+    if serve:
+        start_services(settings)
+
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    return app
+
+
+def start_services(settings):
+    """
+    Start the green threads and threads of a serving process: probes, listeners, executors, the tip scheduler,
+    the journal and the warm-up
+    """
+    if services['started']:
+        return
+    services['started'] = True
+    db.start_replica_probes(settings)
+    clients.rpc.start_probes()
+    balances.start_listener(settings)
+    withdrawals.start_executor(settings)
+    deposits.start_receivers(settings)
+    social.start_member_writer()
+    tips.start_scheduler(settings)
+    journal.start_journal(settings, replay_update)
+    recorder.start_recorder(settings)
+    profiling.start_profiler(settings)
+    tracing.start_tracer(settings)
+    warmup.start_warmup(settings)
 
 # Request handlers -- these two hooks are provided by flask and we will use them
-# to create and tear down a database connection on each request.
-@app.before_request
+# to tear down the database connection on each request.  The connection is opened
+# lazily by the first query, so requests that never query the DB never connect.
+@bp.before_app_request
 def before_request():
     g.db = db.database
-    g.db.connect()
+    users.begin_request()
 
-@app.after_request
+@bp.after_app_request
 def after_request(response):
-    g.db.close()
+    users.end_request()
+    if not g.db.is_closed():
+        g.db.close()
     return response
 
-# Connect to Telegram
-telegram_bot = telegram.Bot(token=TELEGRAM_KEY)
-
-@app.cli.command('telegram_webhook')
+@bp.cli.command('telegram_webhook')
 def telegram_webhook():
     # 443, 80, 88, 8443
-    response = telegram_bot.setWebhook(SERVER_URL)
+    response = clients.telegram_bot.setWebhook(get_settings().server_url)
     if response:
         logging.info("Webhook setup successfully")
     else:
         logging.info("Error {}".format(response))
     return response
 
-@app.cli.command('dbinit')
+@bp.cli.command('dbinit')
 def dbinit():
-    import modules.db as db
     db.create_tables()
+    db.migrate_tables()
+
+@bp.cli.command('reconcile')
+@click.option('--concurrency', type=int, help='accounts walked at once (reconcile_concurrency)')
+@click.option('--grace', type=float, help='seconds a block must age before it is checked (reconcile_grace)')
+@click.option('--baseline', is_flag=True, help='only move the checkpoints to the current frontiers')
+def reconcile_chain(concurrency, grace, baseline):
+    """
+    Match the blocks published since the last run against the tips and withdrawals in the DB
+    """
+    if baseline:
+        summary = reconcile.baseline()
+        click.echo("{checkpoints} of {accounts} accounts checkpointed at their frontier in {seconds}s".format(
+            **summary))
+        return
+    settings = get_settings()
+    summary = reconcile.reconcile(concurrency or settings.reconcile_concurrency,
+                                  settings.reconcile_grace if grace is None else grace)
+    click.echo("{accounts} accounts, {changed} changed, {blocks} new blocks checked in {seconds}s, "
+               "{errors} errors".format(**summary))
+    for kind in reconcile.KINDS:
+        if summary[kind]:
+            click.echo("{}: {}".format(kind, summary[kind]))
+
+@bp.cli.command('shard_wallets')
+@click.option('--batch', type=int, default=wallets.MOVE_BATCH, help='accounts moved per account_move call')
+@click.option('--record-only', is_flag=True, help='store the default wallet instead of moving the accounts')
+def shard_wallets(batch, record_only):
+    """
+    Move the accounts of users without a stored wallet from the default wallet to the wallets they hash to
+    """
+    summary = wallets.shard(batch, record_only)
+    click.echo("{users} users without a wallet, {moved} accounts moved, {recorded} recorded, {errors} errors".format(
+        **summary))
+
+@bp.cli.command('traces')
+@click.argument('paths', nargs=-1, type=click.Path(exists=True))
+@click.option('--kind', help='only updates of this triage outcome, e.g. tip or direct')
+def trace_report(paths, kind):
+    """
+    Per-stage latency percentiles of the update traces in PATHS (files or directories, trace_dir by default)
+    """
+    rows = tracing.summarize(paths or [get_settings().trace_dir], kind)
+    if not rows:
+        raise click.ClickException("No traces found")
+    click.echo("{:<20} {:>8} {:>10} {:>10} {:>10} {:>10} {:>7}".format(
+        'stage', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'share'))
+    total = rows[0][6] if rows[0][0] == 'update' else sum(row[6] for row in rows)
+    for name, count, p50, p90, p99, longest, spent in rows:
+        click.echo("{:<20} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>6.1f}%".format(
+            name, count, p50, p90, p99, longest, 100 * spent / total if total else 0))
+
+@bp.cli.command('shard')
+@click.argument('index', type=int)
+def shard(index):
+    """
+    Run as shard INDEX of a sharded deployment, taking the updates the router forwards over its Unix socket
+    """
+    try:
+        # The flask CLI built the app without the background services
+        start_services(get_settings())
+        sharding.serve_shard(current_app._get_current_object(), index)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+@bp.cli.command('airdrop')
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--source', required=True, help='account of the bot wallet the payouts are sent from')
+@click.option('--name', help='name of the airdrop, used to resume it (defaults to the CSV file name)')
+@click.option('--notify', is_flag=True, help='DM the recipients given by Telegram user id')
+@click.option('--dry-run', is_flag=True, help='only validate the CSV and check the funds')
+def airdrop_payouts(csv_path, source, name, notify, dry_run):
+    """
+    Pay every (Telegram user id or account, BANANO amount) row of a CSV from one account.  Running the same
+    airdrop again resumes it where it stopped.
+    """
+    name = name or os.path.basename(csv_path)
+    with db.database.connection_context():
+        drop = airdrop.find(name)
+        if drop is None:
+            plan = airdrop.validate(csv_path)
+            click.echo("{} payouts of {} BANANO in total, {} recipients need a new account".format(
+                plan['rows'], BananoConversions.raw_to_banano(plan['total_raw']), len(plan['new_users'])))
+            for error in plan['errors']:
+                click.echo(error)
+            if plan['error_count']:
+                raise click.ClickException("{} problems in {}, nothing was sent".format(plan['error_count'], csv_path))
+            try:
+                airdrop.check_funds(source, plan['total_raw'])
+            except (ValueError, nano.rpc.RPCException, NodeBusyError) as e:
+                raise click.ClickException(str(e))
+            if dry_run:
+                return
+            drop = airdrop.load(name, csv_path, source, plan)
+        elif drop.source_account != source:
+            raise click.ClickException("Airdrop {} is paid from {}".format(name, drop.source_account))
+        else:
+            click.echo("Resuming airdrop {}".format(name))
+            if not dry_run:
+                click.echo("{} failed payouts queued again".format(airdrop.requeue_failed(drop)))
+        if dry_run:
+            return
+
+        try:
+            airdrop.run(drop, notify, lambda progress: click.echo(
+                "{sent} of {queued} sent, {failed} failed, {sends_per_second:.1f} sends/s".format(**progress)))
+        except (ValueError, nano.rpc.RPCException, NodeBusyError) as e:
+            # The run stopped after too many failed sends in a row; running it again retries them
+            raise click.ClickException(str(e))
 
 # Flask routing
-@app.route('/', defaults={'path': ''}, methods=["POST"])
-@app.route('/<path:path>', methods=["POST"])
+@bp.route('/stats', methods=["GET"])
+def stats():
+    return jsonify({
+        'actors': actors.stats(),
+        'balances': balances.stats(),
+        'batching': batching.stats(),
+        'db': db.stats(),
+        'node': clients.rpc.stats(),
+        'profiling': profiling.stats(),
+        'withdrawals': withdrawals.stats(),
+        'deposits': deposits.stats(),
+        'journal': journal.stats(),
+        'recorder': recorder.stats(),
+        'sharding': sharding.stats(),
+        'triage': triage.stats(),
+        'throttle': throttle.stats(),
+        'tips': tips.stats(),
+        'tracing': tracing.stats(),
+        'users': users.stats(),
+        'warmup': warmup.stats()
+    })
+
+@bp.route('/ready', methods=["GET"])
+def ready():
+    """
+    Readiness check for the load balancer: 503 until the warm-up has primed the caches
+    """
+    if not warmup.progress['ready']:
+        return 'warming up', HTTPStatus.SERVICE_UNAVAILABLE
+    return 'ok'
+
+@bp.route('/callback/<token>', methods=["POST"])
+def node_callback(token):
+    """
+    Block callback from the node (callback_address/callback_target in the node config)
+    """
+    if not deposits.callbacks_enabled() or token != get_settings().callback_token:
+        return '', HTTPStatus.NOT_FOUND
+    try:
+        deposits.handle_callback(request.get_json(force=True))
+    except Exception as e:
+        logging.error('Node callback error: {}'.format(e))
+    return 'ok'
+
+@bp.route('/', defaults={'path': ''}, methods=["POST"])
+@bp.route('/<path:path>', methods=["POST"])
 def telegram_event(path):
-    import modules.social as social
-    import modules.orchestration as orchestration
+    update = request.get_json(silent=True)
+    if sharding.routing():
+        return sharding.forward(update, request.get_data(), path)
+
+    # Triage first: most group traffic is not a tip and never needs the DB, the node or a log line
+    recorder.record(update)
+    outcome = triage.classify_update(update)
+    triage.count(outcome)
+    with profiling.request(outcome):
+        if outcome in triage.FAST_PATH:
+            try:
+                triage.fast_path(outcome, update)
+            except Exception as e:
+                logging.error('Fast path error: {}'.format(e))
+            return 'ok'
+
+        with tracing.update(update, outcome):
+            with profiling.stage('journal'):
+                accepted = journal.accept(update)
+            if not accepted:
+                return 'ok'
+            try:
+                return process_update(update)
+            finally:
+                journal.finish()
+
+def replay_update(update):
+    """
+    Process an update left unfinished by a dead worker, outside of any request
+    """
+    with db.database.connection_context():
+        users.begin_request()
+        try:
+            process_update(update)
+        finally:
+            users.end_request()
+
+def process_update(request_json):
     try:
         message = {
             # id:                     ID of the received message - Error logged through None value
@@ -94,64 +338,41 @@ def telegram_event(path):
             #    receiver_register:      Registration status with Tip Bot of receiver account
         ]
 
-        request_json = request.get_json()
         logging.info("request_json: {}".format(request_json))
 
         if 'message' in request_json.keys():
             if request_json['message']['chat']['type'] == 'private':
                 logging.info(
                     "Direct message received in Telegram.  Processing.")
-                message['sender_id'] = request_json['message']['from']['id']
-
-                if 'username' in request_json['message']['from']:
-                        message['sender_screen_name'] = request_json['message']['from']['username']
-                else:
-                    if 'first_name' in request_json['message']['from']:
-                        message['sender_screen_name'] = request_json['message']['from']['first_name']
-                    if 'last_name' in request_json['message']['from']:
-                        message['sender_screen_name'] = \
-                            message['sender_screen_name'] + ' ' + request_json['message']['from']['last_name']
-
-                message['dm_id'] = request_json['update_id']
-                message['text'] = request_json['message']['text']
-                message['dm_array'] = message['text'].split(" ")
-                message['dm_action'] = message['dm_array'][0].lower() # TODO: use regex!
+                with profiling.stage('parse'):
+                    message.update(social.parse_private_message(request_json))
 
                 logging.info("{}: action identified: {}".format(
                     datetime.datetime.utcnow(), message['dm_action']))
 
-                orchestration.parse_action(message)
+                with profiling.stage('direct_message'):
+                    orchestration.parse_action(message)
 
             elif (request_json['message']['chat']['type'] == 'supergroup'
                   or request_json['message']['chat']['type'] == 'group'):
                 if 'forward_from' in request_json['message']:
                     return '', HTTPStatus.OK
                 if 'text' in request_json['message']:
-                    message['sender_id'] = request_json['message']['from'][
-                        'id']
-                    if 'username' in request_json['message']['from']:
-                            message['sender_screen_name'] = request_json['message']['from']['username']
-                    else:
-                        if 'first_name' in request_json['message']['from']:
-                            message['sender_screen_name'] = request_json['message']['from']['first_name']
-                        if 'last_name' in request_json['message']['from']:
-                            message['sender_screen_name'] = \
-                                message['sender_screen_name'] + ' ' + request_json['message']['from']['last_name']
-
-                    message['id'] = request_json['message']['message_id']
-                    message['chat_id'] = request_json['message']['chat']['id']
-                    chat_name = re.sub('\W+',' ', request_json['message']['chat'][
-                        'title'] )
-                    message['chat_name'] = chat_name
-
-
-                    social.check_telegram_member(
-                        message['chat_id'], message['chat_name'],
-                        message['sender_id'], message['sender_screen_name'])
+                    with profiling.stage('parse'):
+                        message.update(social.parse_group_message(request_json))
+
+                    # Throttle before the member check and any node work; triage already made sure this is a tip
+                    with profiling.stage('throttle'):
+                        throttled_text = throttle.check(message['sender_id'], message['chat_id'])
+                    if throttled_text is not None:
+                        if throttled_text != '':
+                            social.send_reply(message, throttled_text)
+                        return '', HTTPStatus.OK
 
-                    message['text'] = request_json['message']['text']
-                    message['text'] = message['text'].replace('\n', ' ')
-                    message['text'] = message['text'].lower()
+                    with profiling.stage('member'):
+                        social.check_telegram_member(
+                            message['chat_id'], message['chat_name'],
+                            message['sender_id'], message['sender_screen_name'])
 
                     message = social.check_message_action(message)
                     if message['action'] is None:
@@ -165,9 +386,11 @@ def telegram_event(path):
                         return '', HTTPStatus.OK
 
                     if message['action'] != -1 and str(
-                            message['sender_id']) != str(BOT_ID_TELEGRAM):
+                            message['sender_id']) != str(get_settings().bot_id_telegram):
                         try:
                             orchestration.tip_process(message, users_to_tip, request_json)
+                        except NodeBusyError:
+                            social.send_reply(message, social.NODE_BUSY_TEXT)
                         except Exception as e:
                             logging.info("Exception: {}".format(e))
                             raise e
@@ -186,7 +409,7 @@ def telegram_event(path):
                         member_name = None
 
                     chat_member = db.TelegramChatMember(
-                        char_id = chat_id,
+                        chat_id = chat_id,
                         chat_name = chat_name,
                         member_id = member_id,
                         member_name = member_name,
@@ -208,11 +431,8 @@ def telegram_event(path):
                         "member {}-{} left chat {}-{}, removing from DB.".
                         format(member_id, member_name, chat_id, chat_name))
 
-                    chat_member = db.TelegramChatMember.select().where(
-                                                (db.TelegramChatMember.chat_id == chat_id) & 
-                                                (db.TelegramChatMember.member_id == member_id))
-                    if chat_member.count() > 0:
-                        chat_member.delete_instance()
+                    social.member_cache.pop((int(chat_id), int(member_id)), None)
+                    social.delete_member_query(chat_id, member_id).execute()
 
                 elif 'group_chat_created' in request_json['message']:
                     chat_id = request_json['message']['chat']['id']
@@ -245,5 +465,9 @@ def telegram_event(path):
         return 'ok'
 
 if __name__ == "__main__":
+    # Create and migrate the tables before the services start using them
+    app = create_app()
     db.create_tables()
+    db.migrate_tables()
+    start_services(get_settings())
     app.run()